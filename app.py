@@ -6,12 +6,21 @@ from dateutil import parser as dtparse
 import streamlit as st
 from streamlit_cookies_manager import EncryptedCookieManager
 from dotenv import load_dotenv, find_dotenv
-import subprocess
 import time
 import pandas as pd
 
-from backend.crew_manager import ejecutar_agentes_cita
-from backend.db import init_db, get_user_by_email, upsert_user_token, get_all_appointments, get_all_users
+from backend.jobs import submit_turno, get_job, recuperar_jobs
+from backend.proveedores import (
+    PROVEEDORES, proveedor_por_etiqueta, modelos_ollama, mantener_caliente, guardar_api_key
+)
+from backend.calendar_sync import start_background_sync, get_mirrored_events
+from backend.credenciales import (
+    start_background_refresh, guardar_credenciales, obtener_credenciales, CredencialesNoDisponibles
+)
+from backend.db import (
+    init_db, upsert_user_token,
+    dashboard_kpis, dashboard_demanda_por_tipo, dashboard_ultimas_citas, verificar_estadisticas
+)
 from backend.services import (
     add_appointment,
     list_appointments,
@@ -19,20 +28,25 @@ from backend.services import (
     set_event_id_for_appointment,
     find_appointment,
     update_appointment,
-    procesar_pdf_rag
+    ingerir_pdf,
+    migrar_coleccion_legado
 )
 from backend.google_calendar import (
     create_event as gc_create_event, 
     update_event as gc_update_event, 
-    delete_event as gc_delete_event
+    delete_event as gc_delete_event,
+    invalidate_service
 )
 from models.appointment import Appointment
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
 
 load_dotenv(find_dotenv())
 init_db()
+migrar_coleccion_legado()
+start_background_sync()
+start_background_refresh()
+recuperar_jobs()
 
 cookies = EncryptedCookieManager(
     prefix="agenda_",
@@ -51,8 +65,6 @@ SCOPES = [
     "openid",
 ]
 
-os.makedirs("tokens", exist_ok=True)
-
 st.set_page_config(page_title="Bot de Citas (IA + Calendar)", page_icon="🗓️", layout="wide")
 st.title("🤖 Bot de Citas con IA y Google Calendar")
 
@@ -80,13 +92,16 @@ with st.sidebar:
         if email_en_cookie:
             st.session_state.user_email = email_en_cookie
 
-    # Recuperar token de la base de datos (AHORA EN FORMATO JSON OFICIAL)
+    # Recuperar las credenciales del almacén (en memoria tras la primera vez)
     if st.session_state.get("user_email") and not st.session_state.get("creds"):
-        user = get_user_by_email(st.session_state.user_email)
-        if user and user.get("token_path") and os.path.exists(user["token_path"]):
-            st.session_state.creds = Credentials.from_authorized_user_file(user["token_path"], SCOPES)
-            st.session_state.token_path = user["token_path"]
+        try:
+            st.session_state.creds = obtener_credenciales(st.session_state.user_email)
+            st.session_state.token_path = st.session_state.user_email
             st.session_state.usuario_id = st.session_state.user_email
+        except CredencialesNoDisponibles:
+            pass
+        except Exception as e:
+            st.warning(f"⚠️ No se pudieron cargar tus credenciales de Google: {e}")
 
     if not st.session_state.get("user_email"):
         if st.button("🔌 Conectar Google Calendar", use_container_width=True):
@@ -100,12 +115,10 @@ with st.sidebar:
                 nombre = user_info.get("name", "Usuario")
                 usuario_id = email
                 
-                # GUARDAMOS EN .JSON
-                token_path = f"tokens/{email.replace('@', '_at_')}.json"
-                with open(token_path, "w", encoding="utf-8") as f:
-                    f.write(creds.to_json())
-                    
-                upsert_user_token(usuario_id, nombre, email, token_path)
+                # Las credenciales se guardan en el almacén, con el email como clave
+                token_path = email
+                guardar_credenciales(token_path, creds)
+                upsert_user_token(usuario_id, nombre, email)
                 
                 st.session_state.creds = creds
                 st.session_state.user_email = email
@@ -122,9 +135,11 @@ with st.sidebar:
     else:
         st.info(f"👤 {st.session_state.user_email}")
         if st.button("Cerrar sesión", use_container_width=True):
+            if st.session_state.get("token_path"):
+                invalidate_service(st.session_state.token_path)
             st.session_state.cookies["user_email"] = ""
             st.session_state.cookies.save()
-            for key in ["creds","user_email","user_name","token_path","usuario_id"]:
+            for key in ["creds","user_email","user_name","token_path","usuario_id","jobs_pendientes"]:
                 st.session_state.pop(key, None)
             st.rerun()
 
@@ -136,10 +151,26 @@ with st.sidebar:
         if st.session_state.get("pdf_filename") != uploaded_pdf.name:
             with st.spinner("Memorizando..."):
                 pdf_bytes = uploaded_pdf.read()
-                if procesar_pdf_rag(pdf_bytes, uploaded_pdf.name):
+                barra = st.progress(0.0, text="Leyendo páginas...")
+
+                def _progreso(leidas, total, chunks):
+                    barra.progress(min(leidas / total, 1.0) if total else 0.0,
+                                   text=f"Página {leidas}/{total} · {chunks} fragmentos vectorizados")
+
+                try:
+                    resumen = ingerir_pdf(pdf_bytes, uploaded_pdf.name,
+                                          st.session_state.get("user_email") or None, progreso=_progreso)
+                    barra.empty()
                     st.session_state.pdf_filename = uploaded_pdf.name
-                    st.success(f"✅ {uploaded_pdf.name} cargado.")
-                else:
+                    if resumen["estado"] == "sin_cambios":
+                        st.info(f"ℹ️ {uploaded_pdf.name} ya estaba cargado.")
+                    else:
+                        st.success(
+                            f"✅ {uploaded_pdf.name} cargado "
+                            f"({resumen['paginas_cambiadas']} páginas, {resumen['chunks_nuevos']} fragmentos nuevos)."
+                        )
+                except Exception as e:
+                    print(f"Error en RAG: {e}")
                     st.error("❌ Error al procesar.")
         else:
             st.caption(f"✓ Documento activo: {uploaded_pdf.name}")
@@ -147,19 +178,25 @@ with st.sidebar:
     st.markdown("---")
 
     with st.expander("⚙️ Configuración IA"):
-        provider = st.radio("Proveedor", ["Groq (cloud)", "Ollama (local)"], index=0)
-        if provider.startswith("Ollama"):
-            try:
-                result = subprocess.run(["ollama", "list"], capture_output=True, text=True)
-                lines = result.stdout.strip().split("\n")[1:]
-                modelos_locales = [line.split()[0] for line in lines if line.strip()]
-                model_name = st.selectbox("Modelo local", modelos_locales if modelos_locales else ["⚠️ Sin modelos"])
-                if st.button("🔄 Refrescar"): st.rerun()
-            except:
-                model_name = st.text_input("Modelo Ollama", value="llama3.2:1b")
+        provider = st.radio("Proveedor", [nombre for nombre, _ in PROVEEDORES.values()], index=0)
+        proveedor_id = proveedor_por_etiqueta(provider)
+        opciones_ia = {"provider": proveedor_id}
+        if proveedor_id == "ollama":
+            # Lista cacheada de la API de Ollama (sin lanzar procesos en cada rerun)
+            refrescar = st.button("🔄 Refrescar")
+            modelos_locales = modelos_ollama(forzar=refrescar)
+            if modelos_locales:
+                model_name = st.selectbox("Modelo local", modelos_locales)
+            else:
+                model_name = st.text_input("Modelo Ollama", value=PROVEEDORES["ollama"][1])
+            # Carga el modelo en segundo plano para que el primer turno no espere
+            mantener_caliente(model_name)
         else:
-            model_name = st.text_input("Modelo Groq", value="llama-3.3-70b-versatile")
+            model_name = st.text_input("Modelo Groq", value=PROVEEDORES["groq"][1])
             api_key = st.text_input("API KEY", type="password", value=os.getenv("GROQ_API_KEY", ""))
+            if api_key and api_key != os.getenv("GROQ_API_KEY"):
+                opciones_ia["api_key_ref"] = guardar_api_key(api_key)
+        opciones_ia["model"] = model_name
 
     with st.expander("🛡️ Acceso Admin"):
         modo_admin = st.toggle("Activar Dashboard")
@@ -188,15 +225,14 @@ with st.sidebar:
 if st.session_state.get("is_admin"):
     st.title("📊 Panel de Control General (BI)")
     
-    # Obtener datos
-    todas_citas = get_all_appointments()
-    todos_usuarios = get_all_users()
+    # Obtener datos (agregados en SQLite y cacheados hasta la próxima escritura)
+    kpis = dashboard_kpis()
     
     # 1. KPIs (Métricas principales)
     col1, col2, col3 = st.columns(3)
-    col1.metric("👥 Usuarios Totales", len(todos_usuarios))
-    col2.metric("📅 Citas Agendadas", len(todas_citas))
-    col3.metric("📈 Promedio Citas/Usuario", round(len(todas_citas)/len(todos_usuarios), 1) if todos_usuarios else 0)
+    col1.metric("👥 Usuarios Totales", kpis["usuarios"])
+    col2.metric("📅 Citas Agendadas", kpis["citas"])
+    col3.metric("📈 Promedio Citas/Usuario", kpis["promedio_citas_usuario"])
     
     st.markdown("---")
     
@@ -205,21 +241,32 @@ if st.session_state.get("is_admin"):
     
     with col_chart:
         st.subheader("Demanda por Servicio")
-        if todas_citas:
-            df_citas = pd.DataFrame(todas_citas)
-            conteo_servicios = df_citas['tipo'].value_counts()
+        demanda = dashboard_demanda_por_tipo()
+        if demanda:
+            conteo_servicios = pd.DataFrame(demanda).set_index('tipo')['total']
             st.bar_chart(conteo_servicios)
         else:
             st.info("No hay datos suficientes para el gráfico.")
             
     with col_table:
         st.subheader("Últimas citas registradas")
-        if todas_citas:
-            df_mostrar = pd.DataFrame(todas_citas)[['fecha', 'hora', 'tipo', 'usuario_id']]
-            st.dataframe(df_mostrar.head(10), use_container_width=True)
+        ultimas = dashboard_ultimas_citas(10)
+        if ultimas:
+            df_mostrar = pd.DataFrame(ultimas)
+            st.dataframe(df_mostrar, use_container_width=True)
         else:
             st.info("La agenda está vacía.")
 
+    with st.expander("🔎 Consistencia de las estadísticas"):
+        st.caption("Compara los contadores del panel con las tablas de citas y usuarios.")
+        if st.button("Verificar y reparar"):
+            deriva = verificar_estadisticas(reparar=True)
+            if deriva:
+                st.warning("Se encontró deriva y se reconstruyeron las estadísticas.")
+                st.json({tabla: {str(c): list(v) for c, v in d.items()} for tabla, d in deriva.items()})
+            else:
+                st.success("✅ Las estadísticas cuadran con los datos.")
+
 else:
     left, right = st.columns((7,5))
 
@@ -258,32 +305,53 @@ else:
                 "content": user_msg
             })
             st.session_state.system_messages = []
+            with chat_container:
+                with st.chat_message("user"):
+                    st.markdown(user_msg)
 
-            # 2) Llamar a nuestro equipo de Agentes de CrewAI
+            # 2) Encolar el turno para nuestro equipo de Agentes de CrewAI.
+            # Se ejecuta en segundo plano: un rerun no lo bloquea ni lo repite.
             email_actual = st.session_state.get("user_email", "usuario@desconocido.com")
-            
+            historial_reciente = st.session_state.local_chat_history[-5:]
+            texto_contexto = "HISTORIAL DE LA CONVERSACIÓN:\n"
+            for msg in historial_reciente:
+                texto_contexto += f"- {msg['role']}: {msg['content']}\n"
+
+            # Cola de turnos: un mensaje enviado mientras otro sigue en curso
+            # no pisa al anterior, cada respuesta se muestra por orden
+            st.session_state.setdefault("jobs_pendientes", []).append(
+                submit_turno(texto_contexto, email_actual, **opciones_ia)
+            )
+
+        # 3) Si hay turnos en curso (de este run o de uno anterior), mostrar el
+        # progreso del más antiguo; el rerun del final pasa al siguiente
+        if st.session_state.get("jobs_pendientes"):
+            job_id = st.session_state.jobs_pendientes[0]
             with chat_container:
                 with st.chat_message("assistant"):
-                    with st.spinner("🤖 Los agentes están analizando y procesando tu solicitud..."):
-                        try:
-                            historial_reciente = st.session_state.local_chat_history[-5:]
-                            texto_contexto = "HISTORIAL DE LA CONVERSACIÓN:\n"
-                            for msg in historial_reciente:
-                                texto_contexto += f"- {msg['role']}: {msg['content']}\n"
-
-                            respuesta_agentes = ejecutar_agentes_cita(texto_contexto, email_actual)
-                        except Exception as e:
-                            respuesta_agentes = f"❌ Lo siento, mis agentes tuvieron un error: {str(e)}"
-                    
-                    st.markdown(respuesta_agentes)
-
-            # 3) Añadir al historial
+                    estado = st.status("🤖 Los agentes están analizando tu solicitud...", expanded=False)
+                    parcial = st.empty()
+                    job = get_job(job_id)
+                    while job and job["estado"] in ("pendiente", "ejecutando"):
+                        if job["etapa"]:
+                            estado.update(label=job["etapa"])
+                        parcial.markdown(job["parcial"] or "")
+                        time.sleep(0.25)
+                        job = get_job(job_id)
+
+                    respuesta_agentes = job["resultado"] if job else "❌ No se encontró el trabajo."
+                    parcial.markdown(respuesta_agentes)
+                    estado.update(
+                        label="✅ Listo" if job and job["estado"] == "terminado" else "❌ Error",
+                        state="complete" if job and job["estado"] == "terminado" else "error"
+                    )
+
+            # 4) Añadir al historial
             st.session_state.local_chat_history.append({
                 "role": "assistant",
                 "content": respuesta_agentes
             })
-
-            import time 
+            st.session_state.jobs_pendientes.pop(0)
             st.session_state.calendar_timestamp = int(time.time())
 
             st.rerun()
@@ -303,6 +371,12 @@ else:
                 )
             except Exception as e:
                 st.warning(f"No se pudo cargar calendario: {e}")
+
+            proximos = get_mirrored_events(st.session_state.user_email, limit=5)
+            if proximos:
+                st.subheader("⏭️ Próximos eventos")
+                for ev in proximos:
+                    st.caption(f"• {ev['resumen']} — {ev['inicio']}")
         else:
             st.info("Inicia sesión para ver tu calendario.")
         
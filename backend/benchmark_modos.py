@@ -0,0 +1,122 @@
+# backend/benchmark_modos.py
+"""
+Benchmark de los modos de ejecución de ejecutar_agentes_cita.
+
+Mide por modo la latencia, los tokens consumidos y si se eligió la
+herramienta correcta, sobre un conjunto fijo de conversaciones en español.
+Se ejecuta contra una base de datos temporal y sin credenciales de Google,
+así que las herramientas fallan al llegar a Calendar pero la elección de
+herramienta queda registrada igualmente.
+
+Uso:
+    python -m backend.benchmark_modos --modos crew single function_calling
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from backend import db
+
+EMAIL = "benchmark@botcitas.local"
+
+# (historial, herramienta esperada o None si el bot debe preguntar)
+CONVERSACIONES = [
+    ("- user: Quiero una cita para el dentista el próximo jueves a las 10", "agendar_cita_tool"),
+    ("- user: Resérvame una revisión de la vista mañana a las 17:30", "agendar_cita_tool"),
+    ("- user: Necesito cita para una analítica\n- assistant: ¿Qué día y a qué hora?\n- user: El lunes a las 9", "agendar_cita_tool"),
+    ("- user: ¿Qué citas tengo esta semana?", "consultar_calendario_tool"),
+    ("- user: Enséñame mi calendario", "consultar_calendario_tool"),
+    ("- user: ¿Qué huecos tengo libres el jueves?", "consultar_disponibilidad_tool"),
+    ("- user: Cambia mi cita del dentista al viernes a las 12", "modificar_cita_tool"),
+    ("- user: Mejor pasa la revisión al 20 de noviembre a las 11", "modificar_cita_tool"),
+    ("- user: Cancela la cita del fisioterapeuta", "eliminar_cita_tool"),
+    ("- user: ¿Cuánto tiempo de ayuno hace falta antes del análisis?", "consultar_pdf_tool"),
+    ("- user: ¿Qué dice el documento sobre la preparación de la colonoscopia?", "consultar_pdf_tool"),
+    ("- user: Cancela todas mis citas del 15/12/2026", "gestionar_citas_lote_tool"),
+    ("- user: Quiero pedir una cita", None),
+]
+
+
+@contextmanager
+def _espiar_herramientas(usadas: List[str]):
+    """Anota el nombre de cada herramienta que se ejecuta."""
+    from backend.crew_manager import HERRAMIENTAS
+    originales = [(h, h.func) for h in HERRAMIENTAS]
+
+    def _envolver(nombre, func):
+        def _espia(*args, **kwargs):
+            usadas.append(nombre)
+            return func(*args, **kwargs)
+        return _espia
+
+    for h in HERRAMIENTAS:
+        h.func = _envolver(h.func.__name__, h.func)
+    try:
+        yield
+    finally:
+        for h, func in originales:
+            h.func = func
+
+
+def _acierto(usadas: List[str], esperada: Optional[str]) -> bool:
+    if esperada is None:
+        return not usadas
+    return bool(usadas) and set(usadas) == {esperada}
+
+
+def ejecutar_benchmark(modos: List[str], provider: str, model: str, repeticiones: int = 1) -> Dict[str, Dict]:
+    from backend.crew_manager import ejecutar_turno
+
+    resultados = {}
+    for modo in modos:
+        latencias, tokens, aciertos = [], [], 0
+        for _ in range(repeticiones):
+            for historial, esperada in CONVERSACIONES:
+                usadas: List[str] = []
+                with _espiar_herramientas(usadas):
+                    inicio = time.perf_counter()
+                    try:
+                        turno = ejecutar_turno(historial, EMAIL, provider, model, 0.0, modo, usar_router=False)
+                        tokens.append(turno["tokens"])
+                    except Exception as e:
+                        print(f"⚠️ [{modo}] {historial[:40]!r}: {e}")
+                    latencias.append(time.perf_counter() - inicio)
+                aciertos += _acierto(usadas, esperada)
+
+        n = len(CONVERSACIONES) * repeticiones
+        resultados[modo] = {
+            "latencia_media_s": statistics.mean(latencias),
+            "latencia_p95_s": sorted(latencias)[int(0.95 * (len(latencias) - 1))],
+            "tokens_medios": statistics.mean(tokens) if tokens else 0,
+            "acierto_herramienta": aciertos / n,
+        }
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara los modos de ejecución del bot.")
+    parser.add_argument("--modos", nargs="+", default=["crew", "single", "function_calling"])
+    parser.add_argument("--provider", default="groq")
+    parser.add_argument("--model", default="llama-3.3-70b-versatile")
+    parser.add_argument("--repeticiones", type=int, default=1)
+    args = parser.parse_args()
+
+    # Base de datos desechable (sin credenciales de Google): nada toca datos reales
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    os.environ.setdefault("CREW_VERBOSE", "0")
+    db.init_db()
+
+    resultados = ejecutar_benchmark(args.modos, args.provider, args.model, args.repeticiones)
+
+    print(f"\n{'modo':<18}{'media (s)':>10}{'p95 (s)':>10}{'tokens':>10}{'acierto':>10}")
+    for modo, r in resultados.items():
+        print(f"{modo:<18}{r['latencia_media_s']:>10.2f}{r['latencia_p95_s']:>10.2f}"
+              f"{r['tokens_medios']:>10.0f}{r['acierto_herramienta']:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# backend/benchmark_rag.py
+"""
+Benchmark de recuperación del RAG: vector, BM25, híbrido (RRF) e híbrido
+con reordenado.
+
+Ingiere los PDFs indicados en una base de datos y un vector store
+temporales y, para cada pregunta, comprueba si algún fragmento devuelto
+contiene el texto esperado. Mide acierto@k, MRR y latencia (con las cachés
+vacías en cada pregunta, así que la latencia incluye el embedding).
+
+El fichero de preguntas es un JSON con una lista de objetos:
+    [{"pregunta": "¿Cuántas horas de ayuno?", "esperado": "ocho horas"}, ...]
+
+Uso:
+    python -m backend.benchmark_rag --pdf normativa.pdf --preguntas preguntas.json
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+
+from backend import db
+from backend import services
+
+EMAIL = "benchmark@botcitas.local"
+
+# (nombre, modo, rerank)
+CONFIGURACIONES = [
+    ("vector", "vector", "0"),
+    ("bm25", "bm25", "0"),
+    ("hibrido", "hibrido", "0"),
+    ("hibrido+rerank", "hibrido", "heuristico"),
+]
+
+
+def _posicion(docs: list, esperado: str) -> int:
+    """Posición (1..k) del primer fragmento que contiene lo esperado, o 0."""
+    objetivo = services._plegar(esperado)
+    for i, doc in enumerate(docs, 1):
+        if objetivo in services._plegar(doc.page_content):
+            return i
+    return 0
+
+
+def ejecutar_benchmark(preguntas: List[Dict], k: int = 3, rerank_modelo: str = "") -> Dict[str, Dict]:
+    configuraciones = list(CONFIGURACIONES)
+    if rerank_modelo:
+        configuraciones.append(("hibrido+cross-encoder", "hibrido", rerank_modelo))
+
+    resultados = {}
+    for nombre, modo, rerank in configuraciones:
+        latencias, aciertos, rr = [], 0, []
+        for p in preguntas:
+            services._cache_embeddings.clear()
+            services._cache_resultados.clear()
+            inicio = time.perf_counter()
+            docs = services.buscar_fragmentos(p["pregunta"], k=k, usuario_id=EMAIL, modo=modo, rerank=rerank)
+            latencias.append(time.perf_counter() - inicio)
+            pos = _posicion(docs, p["esperado"])
+            aciertos += pos > 0
+            rr.append(1.0 / pos if pos else 0.0)
+
+        resultados[nombre] = {
+            f"acierto@{k}": aciertos / len(preguntas),
+            "mrr": statistics.mean(rr),
+            "latencia_media_ms": 1000 * statistics.mean(latencias),
+            "latencia_p95_ms": 1000 * sorted(latencias)[int(0.95 * (len(latencias) - 1))],
+        }
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara las estrategias de recuperación del RAG.")
+    parser.add_argument("--pdf", nargs="+", required=True, help="PDFs de muestra a ingerir")
+    parser.add_argument("--preguntas", required=True, help="JSON con [{pregunta, esperado}]")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--rerank-modelo", default="", help="cross-encoder opcional a comparar")
+    args = parser.parse_args()
+
+    with open(args.preguntas, encoding="utf-8") as f:
+        preguntas = json.load(f)
+
+    # Base de datos y vector store desechables: nada toca datos reales
+    tmp = tempfile.mkdtemp()
+    db.DB_PATH = os.path.join(tmp, "benchmark.db")
+    services.DB_VECTOR_PATH = os.path.join(tmp, "chroma")
+    services.VERSION_FILE = os.path.join(services.DB_VECTOR_PATH, ".version_{coleccion}")
+    db.init_db()
+
+    for ruta in args.pdf:
+        inicio = time.perf_counter()
+        with open(ruta, "rb") as f:
+            resumen = services.ingerir_pdf(f.read(), os.path.basename(ruta), EMAIL)
+        print(f"📄 {ruta}: {resumen['chunks_nuevos']} chunks en {time.perf_counter() - inicio:.1f}s")
+
+    resultados = ejecutar_benchmark(preguntas, args.k, args.rerank_modelo)
+
+    print(f"\n{'estrategia':<24}{f'acierto@{args.k}':>12}{'mrr':>8}{'media (ms)':>12}{'p95 (ms)':>10}")
+    for nombre, r in resultados.items():
+        print(f"{nombre:<24}{r[f'acierto@{args.k}']:>12.0%}{r['mrr']:>8.2f}"
+              f"{r['latencia_media_ms']:>12.1f}{r['latencia_p95_ms']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
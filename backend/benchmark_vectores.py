@@ -0,0 +1,128 @@
+# backend/benchmark_vectores.py
+"""
+Benchmark de los vector stores del RAG: Chroma frente al backend NumPy
+memory-mapped (float16 e int8).
+
+Genera un corpus sintético (vectores aleatorios del tamaño de un corpus de
+clínica), lo escribe con cada backend y después, en un proceso nuevo para
+que la memoria sea comparable, mide el tiempo de carga, el RSS añadido y la
+latencia de consulta.
+
+Uso:
+    python -m backend.benchmark_vectores --chunks 5000 --dim 2048
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BACKENDS = ["chroma", "npy-float16", "npy-int8"]
+COLECCION = "benchmark"
+
+
+def _rss_mb() -> float:
+    """RSS actual en MB (Linux); si no hay /proc, el pico del proceso (0 en Windows)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, AttributeError):
+        try:
+            import resource  # solo Unix
+        except ImportError:
+            return 0.0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _abrir(backend: str, directorio: str):
+    if backend == "chroma":
+        from langchain_chroma import Chroma
+        return Chroma(collection_name=COLECCION, persist_directory=directorio)
+    from backend.vector_npy import NpyVectorStore
+    return NpyVectorStore(os.path.join(directorio, COLECCION), dtype=backend.split("-")[1])
+
+
+def _corpus(chunks: int, dim: int, semilla: int = 0) -> np.ndarray:
+    return np.random.default_rng(semilla).normal(size=(chunks, dim)).astype(np.float32)
+
+
+# Lotes de RAG_BATCH_SIZE (32), como en la ingesta real
+def construir(backend: str, directorio: str, chunks: int, dim: int, lote: int = 32):
+    vectores = _corpus(chunks, dim)
+    vs = _abrir(backend, directorio)
+    destino = getattr(vs, "_collection", vs)
+    for inicio in range(0, chunks, lote):
+        ids = [f"c{i}" for i in range(inicio, min(inicio + lote, chunks))]
+        destino.upsert(
+            ids=ids,
+            embeddings=vectores[inicio:inicio + lote].tolist(),
+            documents=[f"Fragmento de prueba {i}" for i in ids],
+            metadatas=[{"id_doc": int(i[1:]) % 10, "chunk_id": i} for i in ids],
+        )
+    if hasattr(vs, "flush"):
+        vs.flush()
+
+
+def medir(backend: str, directorio: str, chunks: int, dim: int, consultas: int, k: int) -> dict:
+    """Se ejecuta en un proceso nuevo: carga el store y lanza las consultas."""
+    consultas_v = _corpus(consultas, dim, semilla=1)
+    rss_inicial = _rss_mb()
+    inicio = time.perf_counter()
+    vs = _abrir(backend, directorio)
+    carga = time.perf_counter() - inicio
+
+    latencias = []
+    for v in consultas_v:
+        inicio = time.perf_counter()
+        vs.similarity_search_by_vector(v.tolist(), k=k)
+        latencias.append(time.perf_counter() - inicio)
+    return {
+        "carga_ms": 1000 * carga,
+        "rss_mb": _rss_mb() - rss_inicial,
+        "consulta_media_ms": 1000 * statistics.mean(latencias),
+        "consulta_p95_ms": 1000 * sorted(latencias)[int(0.95 * (len(latencias) - 1))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara Chroma con el vector store NumPy.")
+    parser.add_argument("--backends", nargs="+", default=BACKENDS, choices=BACKENDS)
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=2048, help="2048 = llama3.2:1b")
+    parser.add_argument("--consultas", type=int, default=200)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--medir", help=argparse.SUPPRESS)
+    parser.add_argument("--directorio", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.medir:
+        print(json.dumps(medir(args.medir, args.directorio, args.chunks, args.dim, args.consultas, args.k)))
+        return
+
+    resultados = {}
+    for backend in args.backends:
+        directorio = tempfile.mkdtemp()
+        inicio = time.perf_counter()
+        construir(backend, directorio, args.chunks, args.dim)
+        escritura = time.perf_counter() - inicio
+        salida = subprocess.run(
+            [sys.executable, "-m", "backend.benchmark_vectores", "--medir", backend, "--directorio", directorio,
+             "--chunks", str(args.chunks), "--dim", str(args.dim),
+             "--consultas", str(args.consultas), "--k", str(args.k)],
+            capture_output=True, text=True, check=True
+        )
+        resultados[backend] = {"escritura_s": escritura, **json.loads(salida.stdout.strip().splitlines()[-1])}
+
+    print(f"\n{'backend':<14}{'escritura (s)':>14}{'carga (ms)':>12}{'RSS (MB)':>10}{'media (ms)':>12}{'p95 (ms)':>10}")
+    for backend, r in resultados.items():
+        print(f"{backend:<14}{r['escritura_s']:>14.1f}{r['carga_ms']:>12.1f}{r['rss_mb']:>10.1f}"
+              f"{r['consulta_media_ms']:>12.2f}{r['consulta_p95_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# backend/calendar_sync.py
+"""
+Espejo local de Google Calendar en la tabla eventos_google.
+
+La primera sincronización descarga todos los eventos; las siguientes usan el
+syncToken de Google para traer solo los cambios. Si Google invalida el token
+(HTTP 410) se vuelve a hacer una sincronización completa.
+"""
+import os
+import threading
+import time
+import pytz
+from datetime import datetime
+from typing import Optional, Dict, List
+from googleapiclient.errors import HttpError
+
+from .db import cursor, query_all, query_one, get_all_users
+from .google_calendar import get_service
+from .credenciales import tiene_credenciales
+
+# Antigüedad máxima del espejo antes de que una consulta fuerce una sincronización
+SYNC_MAX_AGE = int(os.getenv("GOOGLE_SYNC_MAX_AGE", "60"))
+# Periodo del refresco en segundo plano
+SYNC_INTERVAL = int(os.getenv("GOOGLE_SYNC_INTERVAL", "300"))
+
+_user_locks: Dict[str, threading.Lock] = {}
+_user_locks_guard = threading.Lock()
+_timer_started = False
+
+
+def _lock_for(usuario_id: str) -> threading.Lock:
+    with _user_locks_guard:
+        return _user_locks.setdefault(usuario_id, threading.Lock())
+
+
+def _to_utc(info: Dict) -> Optional[str]:
+    """Normaliza el start/end de Google a 'YYYY-MM-DDTHH:MM:SS' en UTC."""
+    if not info:
+        return None
+    if "dateTime" in info:
+        dt = datetime.fromisoformat(info["dateTime"].replace("Z", "+00:00"))
+    else:
+        tz = pytz.timezone(info.get("timeZone") or os.getenv("TIMEZONE", "Europe/Madrid"))
+        dt = tz.localize(datetime.fromisoformat(info["date"]))
+    return dt.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def _row(usuario_id: str, e: Dict) -> tuple:
+    start, end = e.get("start", {}), e.get("end", {})
+    return (
+        usuario_id,
+        e["id"],
+        e.get("summary", "Sin título"),
+        e.get("description"),
+        start.get("dateTime", start.get("date")),
+        end.get("dateTime", end.get("date")),
+        _to_utc(start),
+        _to_utc(end),
+        0 if "dateTime" in start else 1,
+        e.get("htmlLink"),
+        e.get("updated"),
+    )
+
+
+def _apply(cur, usuario_id: str, eventos: List[Dict]):
+    borrados = [(usuario_id, e["id"]) for e in eventos if e.get("status") == "cancelled"]
+    vivos = [_row(usuario_id, e) for e in eventos if e.get("status") != "cancelled"]
+    if borrados:
+        cur.executemany("DELETE FROM eventos_google WHERE usuario_id = ? AND event_id = ?", borrados)
+    if vivos:
+        cur.executemany("""
+            INSERT OR REPLACE INTO eventos_google
+                (usuario_id, event_id, resumen, descripcion, inicio, fin,
+                 inicio_utc, fin_utc, todo_el_dia, html_link, actualizado)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, vivos)
+
+
+def mirror_event(usuario_id: str, event: Dict):
+    """Guarda en el espejo un evento recién creado o modificado."""
+    mirror_events(usuario_id, [event])
+
+
+def mirror_events(usuario_id: str, eventos: List[Dict]):
+    with cursor() as cur:
+        _apply(cur, usuario_id, eventos)
+
+
+def forget_event(usuario_id: str, event_id: str):
+    """Quita del espejo un evento borrado."""
+    forget_events(usuario_id, [event_id])
+
+
+def forget_events(usuario_id: str, event_ids: List[str]):
+    with cursor() as cur:
+        cur.executemany(
+            "DELETE FROM eventos_google WHERE usuario_id = ? AND event_id = ?",
+            [(usuario_id, event_id) for event_id in event_ids]
+        )
+
+
+def _list_pages(service, cal_id: str, sync_token: Optional[str]):
+    """Recorre todas las páginas de events().list. Devuelve (eventos, nextSyncToken)."""
+    eventos, page_token = [], None
+    while True:
+        params = {"calendarId": cal_id, "singleEvents": True, "maxResults": 250}
+        if sync_token:
+            params["syncToken"] = sync_token
+        else:
+            params["showDeleted"] = False
+        if page_token:
+            params["pageToken"] = page_token
+        resp = service.events().list(**params).execute()
+        eventos.extend(resp.get("items", []))
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            return eventos, resp.get("nextSyncToken")
+
+
+def sync_events(usuario_id: str, token_path: Optional[str] = None) -> int:
+    """
+    Sincroniza el espejo del usuario con Google Calendar.
+    Devuelve el número de eventos recibidos.
+    """
+    cal_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
+    with _lock_for(usuario_id):
+        estado = query_one("SELECT * FROM sync_google WHERE usuario_id = ?", (usuario_id,))
+        sync_token = estado["sync_token"] if estado and estado["calendar_id"] == cal_id else None
+        service = get_service(token_path)
+
+        completa = sync_token is None
+        try:
+            eventos, next_token = _list_pages(service, cal_id, sync_token)
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            # syncToken caducado: resincronización completa
+            completa = True
+            eventos, next_token = _list_pages(service, cal_id, None)
+
+        with cursor() as cur:
+            if completa:
+                cur.execute("DELETE FROM eventos_google WHERE usuario_id = ?", (usuario_id,))
+            _apply(cur, usuario_id, eventos)
+            cur.execute("""
+                INSERT OR REPLACE INTO sync_google (usuario_id, calendar_id, sync_token, ultima_sync)
+                VALUES (?, ?, ?, ?)
+            """, (usuario_id, cal_id, next_token, time.time()))
+        return len(eventos)
+
+
+def ensure_synced(usuario_id: str, token_path: Optional[str] = None, max_age: int = SYNC_MAX_AGE):
+    """
+    Sincroniza solo si el espejo tiene más de `max_age` segundos.
+    Si Google no responde pero ya hay datos locales, se sirven los locales.
+    """
+    estado = query_one("SELECT ultima_sync FROM sync_google WHERE usuario_id = ?", (usuario_id,))
+    if estado and time.time() - estado["ultima_sync"] < max_age:
+        return
+    try:
+        sync_events(usuario_id, token_path)
+    except Exception as e:
+        if not estado:
+            raise
+        print(f"⚠️ No se pudo sincronizar el calendario de {usuario_id}: {e}")
+
+
+def get_mirrored_events(usuario_id: str, desde: Optional[datetime] = None, limit: int = 50) -> List[Dict]:
+    """
+    Los `limit` primeros eventos del espejo, por inicio, que no han terminado
+    en `desde` (por defecto, ahora): incluye los que están en curso.
+    """
+    desde = desde or datetime.now(pytz.utc)
+    desde_utc = desde.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    return query_all("""
+        SELECT * FROM eventos_google
+        WHERE usuario_id = ? AND COALESCE(fin_utc, inicio_utc) > ?
+        ORDER BY inicio_utc
+        LIMIT ?
+    """, (usuario_id, desde_utc, limit))
+
+
+def _sync_loop(interval: int):
+    # Ningún error (red, token revocado, base de datos) debe matar el hilo
+    while True:
+        try:
+            usuarios = get_all_users()
+        except Exception as e:
+            print(f"⚠️ Sync en segundo plano: no se pudieron leer los usuarios: {e}")
+            usuarios = []
+        for user in usuarios:
+            try:
+                if tiene_credenciales(user["usuario_id"]):
+                    sync_events(user["usuario_id"], user["usuario_id"])
+            except Exception as e:
+                print(f"⚠️ Sync en segundo plano falló para {user['usuario_id']}: {e}")
+        time.sleep(interval)
+
+
+def start_background_sync(interval: int = SYNC_INTERVAL):
+    """Arranca (una vez por proceso) el hilo que refresca los espejos."""
+    global _timer_started
+    with _user_locks_guard:
+        if _timer_started or interval <= 0:
+            return
+        _timer_started = True
+    threading.Thread(target=_sync_loop, args=(interval,), daemon=True, name="calendar-sync").start()
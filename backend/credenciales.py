@@ -0,0 +1,211 @@
+# backend/credenciales.py
+"""
+Almacén de credenciales OAuth de Google en botcitas.db (tabla credenciales)
+con caché en memoria.
+
+Es la única vía para obtener credenciales: la usan app.py, google_calendar
+y las herramientas de los agentes. Cada credencial se identifica por una
+clave: el email del usuario o, por compatibilidad, la ruta de un token JSON
+antiguo (p. ej. GOOGLE_TOKEN_PATH). Los tokens que aún estén en ficheros se
+importan a la tabla la primera vez que se piden.
+
+Un hilo en segundo plano renueva los tokens antes de que caduquen, así que
+ningún turno del chat espera a un refresco. Nunca se abre el flujo OAuth
+interactivo desde aquí: si no hay credenciales, el usuario tiene que volver
+a conectar su cuenta desde la interfaz. Un token que Google rechaza al
+renovarlo (revocado) se marca como tal y no se vuelve a intentar.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from google.oauth2.credentials import Credentials
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+
+from .db import cursor, query_all, query_one
+
+# Se renuevan los tokens a los que les quede menos de este margen de vida
+REFRESH_MARGIN = timedelta(seconds=int(os.getenv("GOOGLE_REFRESH_MARGIN", "600")))
+# Periodo del refresco en segundo plano
+REFRESH_INTERVAL = int(os.getenv("GOOGLE_REFRESH_INTERVAL", "60"))
+
+_cache: Dict[str, Credentials] = {}
+_locks: Dict[str, threading.Lock] = {}
+_guard = threading.Lock()
+_refresher_started = False
+
+
+class CredencialesNoDisponibles(RuntimeError):
+    """No hay credenciales guardadas (o válidas) para la clave pedida."""
+
+
+def _lock_for(clave: str) -> threading.Lock:
+    with _guard:
+        return _locks.setdefault(clave, threading.Lock())
+
+
+def _utc_iso(dt: Optional[datetime]) -> Optional[str]:
+    # google-auth guarda expiry como datetime UTC sin zona horaria
+    return dt.strftime("%Y-%m-%dT%H:%M:%S") if dt else None
+
+
+def _ruta_legado(clave: str) -> str:
+    """Fichero JSON donde estaba el token de esta clave antes del almacén."""
+    if clave.endswith(".json"):
+        return clave
+    user = query_one("SELECT token_path FROM usuarios WHERE usuario_id = ? OR email = ? LIMIT 1", (clave, clave))
+    if user and user["token_path"]:
+        return user["token_path"]
+    return f"tokens/{clave.replace('@', '_at_')}.json"
+
+
+def _escribir(clave: str, creds: Credentials):
+    with cursor() as cur:
+        cur.execute("""
+            INSERT INTO credenciales (clave, token_json, expira_en, actualizado_en, revocada_en)
+            VALUES (?, ?, ?, datetime('now'), NULL)
+            ON CONFLICT(clave) DO UPDATE SET
+                token_json = excluded.token_json,
+                expira_en = excluded.expira_en,
+                actualizado_en = excluded.actualizado_en,
+                revocada_en = NULL
+        """, (clave, creds.to_json(), _utc_iso(creds.expiry)))
+
+
+def _cargar(clave: str) -> Optional[Credentials]:
+    row = query_one("SELECT token_json, revocada_en FROM credenciales WHERE clave = ?", (clave,))
+    if row and row["revocada_en"]:
+        # No se reimporta el fichero antiguo: tiene el mismo token revocado
+        return None
+    if row:
+        return Credentials.from_authorized_user_info(json.loads(row["token_json"]))
+
+    ruta = _ruta_legado(clave)
+    if not os.path.exists(ruta) or os.path.getsize(ruta) == 0:
+        return None
+    try:
+        with open(ruta, encoding="utf-8") as f:
+            creds = Credentials.from_authorized_user_info(json.load(f))
+    except Exception as e:
+        print(f"⚠️ Error al leer token en {ruta}: {e}")
+        return None
+    _escribir(clave, creds)
+    print(f"✅ Token de {ruta} importado al almacén de credenciales")
+    return creds
+
+
+def guardar_credenciales(clave: str, creds: Credentials):
+    """Guarda (o sustituye tras un nuevo login) las credenciales de una clave."""
+    with _lock_for(clave):
+        _escribir(clave, creds)
+        _cache[clave] = creds
+
+
+def obtener_credenciales(clave: str) -> Credentials:
+    """
+    Credenciales de la clave, desde memoria si ya se cargaron. El mismo
+    objeto se comparte entre llamadas, así que los refrescos del hilo en
+    segundo plano llegan a los clientes ya construidos.
+    Lanza CredencialesNoDisponibles si no hay token para la clave.
+    """
+    creds = _cache.get(clave)
+    if creds is None:
+        with _lock_for(clave):
+            creds = _cache.get(clave)
+            if creds is None:
+                creds = _cargar(clave)
+                if creds is None:
+                    raise CredencialesNoDisponibles(
+                        f"No hay credenciales de Google para {clave}: conecta de nuevo tu cuenta."
+                    )
+                _cache[clave] = creds
+    if creds.expired:
+        # Solo ocurre si el refresco en segundo plano no ha llegado a tiempo
+        # (p. ej. justo al arrancar el proceso)
+        _refrescar(clave, creds)
+    return creds
+
+
+def tiene_credenciales(clave: str) -> bool:
+    try:
+        obtener_credenciales(clave)
+        return True
+    except CredencialesNoDisponibles:
+        return False
+
+
+def olvidar_credenciales(clave: str):
+    """Borra las credenciales de la clave (memoria y base de datos)."""
+    with _lock_for(clave):
+        _cache.pop(clave, None)
+        with cursor() as cur:
+            cur.execute("DELETE FROM credenciales WHERE clave = ?", (clave,))
+
+
+def _refrescar(clave: str, creds: Credentials):
+    with _lock_for(clave):
+        # Otro hilo pudo refrescarlo mientras se esperaba el lock
+        if creds.expiry and creds.expiry - datetime.utcnow() > REFRESH_MARGIN:
+            return
+        if not creds.refresh_token:
+            raise CredencialesNoDisponibles(f"El token de {clave} caducó y no se puede renovar.")
+        try:
+            creds.refresh(Request())
+        except RefreshError as e:
+            # Revocado o caducado en Google: se marca una sola vez
+            _cache.pop(clave, None)
+            with cursor() as cur:
+                cur.execute(
+                    "UPDATE credenciales SET revocada_en = datetime('now') WHERE clave = ?", (clave,)
+                )
+            print(f"⚠️ Google rechazó el token de {clave}; hay que volver a conectar la cuenta: {e}")
+            raise CredencialesNoDisponibles(f"El token de {clave} fue revocado: conecta de nuevo tu cuenta.")
+        _escribir(clave, creds)
+
+
+def refrescar_proximas(margen: timedelta = REFRESH_MARGIN) -> int:
+    """Renueva los tokens que caducan dentro de `margen`. Devuelve cuántos."""
+    limite = _utc_iso(datetime.utcnow() + margen)
+    renovados = 0
+    for row in query_all("""
+        SELECT clave FROM credenciales
+        WHERE expira_en IS NOT NULL AND expira_en < ? AND revocada_en IS NULL
+    """, (limite,)):
+        clave = row["clave"]
+        try:
+            creds = _cache.get(clave) or _cargar(clave)
+            if creds is None:
+                continue
+            _cache.setdefault(clave, creds)
+            _refrescar(clave, _cache[clave])
+            renovados += 1
+        except CredencialesNoDisponibles:
+            # Ya avisado al marcarlo como revocado
+            continue
+        except Exception as e:
+            print(f"⚠️ No se pudo renovar el token de {clave}: {e}")
+    return renovados
+
+
+def _refresh_loop(interval: int):
+    while True:
+        # Un fallo puntual (red, base de datos bloqueada) no debe matar el hilo
+        try:
+            refrescar_proximas()
+        except Exception as e:
+            print(f"⚠️ Refresco de tokens en segundo plano falló: {e}")
+        time.sleep(interval)
+
+
+def start_background_refresh(interval: int = REFRESH_INTERVAL):
+    """Arranca (una vez por proceso) el hilo que renueva los tokens."""
+    global _refresher_started
+    with _guard:
+        if _refresher_started or interval <= 0:
+            return
+        _refresher_started = True
+    threading.Thread(target=_refresh_loop, args=(interval,), daemon=True, name="oauth-refresh").start()
@@ -1,83 +1,381 @@
 # backend/crew_manager.py
 from crewai import Agent, Task, Crew, Process, LLM
+from crewai.types.streaming import StreamChunkType
 from datetime import datetime
 import os
+import json
+import threading
+from typing import Callable, Dict, Optional, Tuple
 from dotenv import load_dotenv
-from backend.tools_openai import agendar_cita_tool, consultar_calendario_tool, consultar_pdf_tool, modificar_cita_tool, eliminar_cita_tool
+from openai import OpenAI
+from backend.db import registrar_turno
+from backend.proveedores import OLLAMA_HOST, endpoint, mantener_caliente
+from backend.intent_router import enrutar, ejecutar as ejecutar_intencion, registrar_ruta, ultimo_mensaje_usuario
+from backend.tools_openai import observar_herramientas, sesion_usuario, agendar_cita_tool, consultar_disponibilidad_tool, consultar_calendario_tool, consultar_pdf_tool, modificar_cita_tool, eliminar_cita_tool, gestionar_citas_lote_tool
+
+HERRAMIENTAS = [agendar_cita_tool, consultar_disponibilidad_tool, consultar_calendario_tool, consultar_pdf_tool, modificar_cita_tool, eliminar_cita_tool, gestionar_citas_lote_tool]
 
 load_dotenv()
 
-def ejecutar_agentes_cita(mensaje_usuario: str, email_usuario: str) -> str:
-    """
-    Inicia un flujo secuencial con CrewAI usando el LLM de Groq.
-    Corregido para precisión de fechas y persistencia de datos.
-    """
-    # 🚀 MEJORA: Pasamos el día de la semana para que el LLM no se pierda
-    ahora = datetime.now()
-    hoy_fecha = ahora.strftime("%Y-%m-%d")
-    dia_semana = ahora.strftime("%A") # Ejemplo: "Monday"
-    
-    api_key_groq = os.getenv("GROQ_API_KEY")
-    if not api_key_groq:
-        return "❌ Error: No se ha encontrado GROQ_API_KEY en el archivo .env"
-
-    mi_llm = LLM(
-        model="llama-3.3-70b-versatile",
-        temperature=0.0, 
-        base_url="https://api.groq.com/openai/v1",
-        api_key=api_key_groq
+# CREW_VERBOSE=0 desactiva la salida detallada de los agentes (producción)
+CREW_VERBOSE = os.getenv("CREW_VERBOSE", "1").lower() not in ("0", "false", "no")
+
+# Modo de ejecución por defecto: "crew" (analista + gestor), "single"
+# (un solo agente) o "function_calling" (bucle directo de tool calls).
+CREW_MODO = os.getenv("CREW_MODO", "crew")
+MODOS = ("crew", "single", "function_calling")
+
+DEFAULT_PROVIDER = "groq"
+DEFAULT_MODEL = "llama-3.3-70b-versatile"
+
+# Plantillas de las tareas: los {campos} se rellenan en cada turno con kickoff(inputs=...)
+DESCRIPCION_ANALISIS = '''Hoy es {dia_semana}, fecha: {hoy_fecha}. 
+        Analiza este historial: "{mensaje_usuario}"
+        
+        REGLAS CRÍTICAS DE INTENCIÓN:
+        1. PRIORIDAD RAG: Si el usuario hace una PREGUNTA (usa signos de interrogación o palabras como "cuánto", "qué dice", "cuándo") sobre normativas o el PDF, la intención es SIEMPRE "CONSULTAR_PDF". 
+        2. NO AGENDAR DUDAS: Si el usuario pregunta "cuánto tiempo de ayuno", NO agendes una cita llamada "Ayuno". Simplemente marca la intención como "CONSULTAR_PDF".
+        3. AGENDAR: Solo si el usuario pide explícitamente "agendar", "reservar" o "cita para...".
+        '''
+
+DESCRIPCION_EJECUCION = '''Ejecuta la acción siguiendo estas órdenes de seguridad:
+        
+        - 🚫 PROHIBICIÓN: Si la intención detectada es MODIFICAR, tienes TERMINANTEMENTE PROHIBIDO usar "agendar_cita_tool". Debes usar ÚNICAMENTE "modificar_cita_tool".
+        - Si es agendar desde cero: usa agendar_cita_tool (email: {email_usuario}). Si avisa de que la hora está ocupada, ofrece al usuario los huecos que propone.
+        - Si el usuario pregunta qué huecos o disponibilidad hay un día: usa consultar_disponibilidad_tool (email: {email_usuario}).
+        - Si es modificar: usa modificar_cita_tool (pasa el email: {email_usuario}, el servicio a buscar, y la NUEVA fecha y hora).
+        - Si el usuario pide agendar, modificar o cancelar VARIAS citas a la vez (o todas las de un día): usa gestionar_citas_lote_tool (email: {email_usuario}).
+        - Si es consultar el PDF: usa consultar_pdf_tool (email: {email_usuario}).
+        - Si es consultar el calendario: usa la herramienta correspondiente.'''
+
+# Modo "single": un único agente que analiza y ejecuta en la misma llamada
+DESCRIPCION_UNICA = DESCRIPCION_ANALISIS + '''
+        Una vez clara la intención, ejecútala tú mismo.
+        ''' + DESCRIPCION_EJECUCION
+
+_crews = {}
+_crews_lock = threading.Lock()
+_clientes: Dict[Tuple[str, str], OpenAI] = {}
+
+
+def _build_llm(provider: str, model: str, temperature: float, api_key_ref: Optional[str] = None) -> LLM:
+    if provider == "ollama":
+        return LLM(model=f"ollama/{model}", temperature=temperature, base_url=OLLAMA_HOST)
+    base_url, api_key = endpoint(provider, api_key_ref)
+    return LLM(
+        model=model,
+        temperature=temperature,
+        base_url=base_url,
+        api_key=api_key
     )
-    
-    # 2. DEFINICIÓN DE AGENTES
+
+
+def _build_crew(llm: LLM, verbose: bool) -> Crew:
     analista = Agent(
         role='Analista de Intenciones y Fechas',
         goal='Extraer datos estructurados y realizar cálculos de fechas exactos.',
         backstory='Eres un asistente administrativo experto en España. Eres extremadamente preciso calculando fechas.',
-        verbose=True,
+        verbose=verbose,
         allow_delegation=False,
-        llm=mi_llm
+        llm=llm
     )
 
     gestor = Agent(
         role='Coordinador de Agenda',
         goal='Confirmar o ejecutar acciones de agenda basándose en el análisis.',
         backstory='Eres un gestor eficiente. Si los datos están completos, ejecutas la herramienta. Si falta la HORA o el SERVICIO, lo pides.',
-        verbose=True,
+        verbose=verbose,
         allow_delegation=False,
-        tools=[agendar_cita_tool, consultar_calendario_tool, consultar_pdf_tool, modificar_cita_tool, eliminar_cita_tool], 
-        llm=mi_llm
+        tools=HERRAMIENTAS, 
+        llm=llm
     )
 
-    # 3. DEFINICIÓN DE TAREAS (Lógica de Fechas Blindada)
     tarea_analisis = Task(
-        description=f'''Hoy es {dia_semana}, fecha: {hoy_fecha}. 
-        Analiza este historial: "{mensaje_usuario}"
-        
-        REGLAS CRÍTICAS DE INTENCIÓN:
-        1. PRIORIDAD RAG: Si el usuario hace una PREGUNTA (usa signos de interrogación o palabras como "cuánto", "qué dice", "cuándo") sobre normativas o el PDF, la intención es SIEMPRE "CONSULTAR_PDF". 
-        2. NO AGENDAR DUDAS: Si el usuario pregunta "cuánto tiempo de ayuno", NO agendes una cita llamada "Ayuno". Simplemente marca la intención como "CONSULTAR_PDF".
-        3. AGENDAR: Solo si el usuario pide explícitamente "agendar", "reservar" o "cita para...".
-        ''',
+        description=DESCRIPCION_ANALISIS,
         expected_output='Informe con la Intención clara (CONSULTAR_PDF, AGENDAR, MODIFICAR, ELIMINAR) y los datos asociados.',
         agent=analista
     )
 
     tarea_ejecucion = Task(
-        description=f'''Ejecuta la acción siguiendo estas órdenes de seguridad:
-        
-        - 🚫 PROHIBICIÓN: Si la intención detectada es MODIFICAR, tienes TERMINANTEMENTE PROHIBIDO usar "agendar_cita_tool". Debes usar ÚNICAMENTE "modificar_cita_tool".
-        - Si es agendar desde cero: usa agendar_cita_tool (email: {email_usuario}).
-        - Si es modificar: usa modificar_cita_tool (pasa el email: {email_usuario}, el servicio a buscar, y la NUEVA fecha y hora).
-        - Si es consultar o PDF: usa la herramienta correspondiente.''',
+        description=DESCRIPCION_EJECUCION,
         expected_output='Respuesta final clara. Si modificaste, confirma que has ACTUALIZADO la cita existente sin crear una nueva.',
         agent=gestor
     )
 
-    equipo_citas = Crew(
+    return Crew(
         agents=[analista, gestor],
         tasks=[tarea_analisis, tarea_ejecucion],
-        process=Process.sequential 
+        process=Process.sequential,
+        verbose=verbose
+    )
+
+
+def _build_single_crew(llm: LLM, verbose: bool) -> Crew:
+    asistente = Agent(
+        role='Asistente de Agenda',
+        goal='Entender la petición, calcular fechas exactas y ejecutar la acción de agenda adecuada.',
+        backstory='Eres un asistente administrativo experto en España, preciso con las fechas. Si los datos están completos, ejecutas la herramienta. Si falta la HORA o el SERVICIO, lo pides.',
+        verbose=verbose,
+        allow_delegation=False,
+        tools=HERRAMIENTAS,
+        llm=llm
+    )
+
+    tarea = Task(
+        description=DESCRIPCION_UNICA,
+        expected_output='Respuesta final clara. Si modificaste, confirma que has ACTUALIZADO la cita existente sin crear una nueva.',
+        agent=asistente
     )
 
-    resultado = equipo_citas.kickoff()
-    return str(resultado.raw) if hasattr(resultado, 'raw') else str(resultado)
\ No newline at end of file
+    return Crew(agents=[asistente], tasks=[tarea], process=Process.sequential, verbose=verbose)
+
+
+def get_crew(provider: str = DEFAULT_PROVIDER, model: str = DEFAULT_MODEL,
+             temperature: float = 0.0, verbose: bool = CREW_VERBOSE, modo: str = "crew",
+             api_key_ref: Optional[str] = None) -> Crew:
+    """
+    Devuelve la plantilla de Crew para (provider, model, temperature).
+    El LLM y los agentes se crean una sola vez por proceso y se reutilizan.
+    api_key_ref: referencia de proveedores.guardar_api_key (None: la del .env).
+    """
+    key = (provider, model, temperature, verbose, modo, api_key_ref)
+    with _crews_lock:
+        crew = _crews.get(key)
+        if crew is None:
+            build = _build_single_crew if modo == "single" else _build_crew
+            crew = build(_build_llm(provider, model, temperature, api_key_ref), verbose)
+            _crews[key] = crew
+    return crew
+
+
+def _inputs_turno(mensaje_usuario: str, email_usuario: str) -> Dict[str, str]:
+    # 🚀 MEJORA: Pasamos el día de la semana para que el LLM no se pierda
+    ahora = datetime.now()
+    return {
+        "dia_semana": ahora.strftime("%A"), # Ejemplo: "Monday"
+        "hoy_fecha": ahora.strftime("%Y-%m-%d"),
+        "mensaje_usuario": mensaje_usuario,
+        "email_usuario": email_usuario,
+    }
+
+
+# Marca del formato ReAct tras la que empieza la respuesta final del agente
+MARCA_RESPUESTA = "Final Answer:"
+
+
+def _ejecutar_crew(mensaje_usuario: str, email_usuario: str, provider: str, model: str,
+                   temperature: float, modo: str, emitir: Optional[Callable] = None,
+                   api_key_ref: Optional[str] = None) -> Tuple[str, int]:
+    """
+    Ejecuta el Crew (modos "crew" y "single"). Con `emitir`, el Crew corre en
+    streaming y la respuesta final de la última tarea se emite como eventos
+    "token" a medida que la escribe el LLM; los pensamientos y las llamadas
+    a herramientas intermedias no se emiten.
+    """
+    plantilla = get_crew(provider, model, temperature, modo=modo, api_key_ref=api_key_ref)
+    # Copia por turno: los agentes comparten el LLM cacheado pero no el estado
+    # de ejecución, así dos sesiones pueden usar la misma plantilla a la vez.
+    equipo_citas = plantilla.copy()
+    if emitir and modo == "crew":
+        # Al terminar la tarea del analista ya se conoce la intención
+        def _tarea_terminada(salida):
+            if getattr(salida, "agent", "") == 'Analista de Intenciones y Fechas':
+                emitir({"tipo": "intencion", "texto": str(getattr(salida, "raw", salida))})
+        equipo_citas.task_callback = _tarea_terminada
+    if not emitir:
+        resultado = equipo_citas.kickoff(inputs=_inputs_turno(mensaje_usuario, email_usuario))
+    else:
+        equipo_citas.stream = True
+        salida = equipo_citas.kickoff(inputs=_inputs_turno(mensaje_usuario, email_usuario))
+        ultima = len(equipo_citas.tasks) - 1
+        texto, emitido, respondido = "", None, False
+        for chunk in salida:
+            if chunk.task_index != ultima or chunk.chunk_type != StreamChunkType.TEXT:
+                continue
+            # La marca puede llegar partida entre fragmentos: se busca en lo acumulado
+            texto += chunk.content
+            if emitido is None:
+                inicio = texto.find(MARCA_RESPUESTA)
+                if inicio < 0:
+                    continue
+                emitido = inicio + len(MARCA_RESPUESTA)
+            nuevo = texto[emitido:] if respondido else texto[emitido:].lstrip()
+            emitido = len(texto)
+            if nuevo:
+                emitir({"tipo": "token", "texto": nuevo})
+                respondido = True
+        resultado = salida.result
+        if emitido is None:
+            # Sin la marca (p. ej. tool calling nativo) no se distingue la
+            # respuesta de los pasos intermedios: se emite entera al final
+            emitir({"tipo": "token", "texto": str(getattr(resultado, "raw", resultado))})
+    respuesta = str(resultado.raw) if hasattr(resultado, 'raw') else str(resultado)
+    uso = getattr(resultado, "token_usage", None)
+    return respuesta, getattr(uso, "total_tokens", 0) or 0
+
+
+# ============================
+# MODO FUNCTION CALLING
+# ============================
+
+def _cliente(provider: str, api_key_ref: Optional[str] = None) -> OpenAI:
+    base_url, api_key = endpoint(provider, api_key_ref)
+    with _crews_lock:
+        cliente = _clientes.get((base_url, api_key))
+        if cliente is None:
+            cliente = OpenAI(base_url=base_url, api_key=api_key)
+            _clientes[(base_url, api_key)] = cliente
+    return cliente
+
+
+def _tool_schema(herramienta) -> Dict:
+    """Esquema OpenAI de una herramienta de CrewAI (nombre, docstring y argumentos)."""
+    parametros = herramienta.args_schema.model_json_schema()
+    parametros.pop("title", None)
+    return {
+        "type": "function",
+        "function": {
+            "name": herramienta.func.__name__,
+            "description": (herramienta.func.__doc__ or "").strip(),
+            "parameters": parametros,
+        },
+    }
+
+
+def _ejecutar_function_calling(mensaje_usuario: str, email_usuario: str, provider: str,
+                               model: str, temperature: float, max_pasos: int = 5,
+                               emitir: Optional[Callable] = None,
+                               api_key_ref: Optional[str] = None) -> Tuple[str, int]:
+    """
+    Un solo modelo decide y llama a las herramientas con tool calling nativo.
+    La respuesta se pide en streaming: el texto se va emitiendo como eventos
+    "token" y las tool calls se reconstruyen a partir de los fragmentos.
+    """
+    cliente = _cliente(provider, api_key_ref)
+    por_nombre = {h.func.__name__: h for h in HERRAMIENTAS}
+    mensajes = [
+        {"role": "system", "content": DESCRIPCION_UNICA.format(**_inputs_turno(mensaje_usuario, email_usuario))},
+        {"role": "user", "content": mensaje_usuario},
+    ]
+    tokens = 0
+    for _ in range(max_pasos):
+        stream = cliente.chat.completions.create(
+            model=model,
+            messages=mensajes,
+            tools=[_tool_schema(h) for h in HERRAMIENTAS],
+            tool_choice="auto",
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        contenido, calls = [], {}
+        for chunk in stream:
+            if chunk.usage:
+                tokens += chunk.usage.total_tokens
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                contenido.append(delta.content)
+                if emitir:
+                    emitir({"tipo": "token", "texto": delta.content})
+            for tc in delta.tool_calls or []:
+                call = calls.setdefault(tc.index, {"id": None, "name": "", "arguments": ""})
+                call["id"] = tc.id or call["id"]
+                if tc.function and tc.function.name:
+                    call["name"] += tc.function.name
+                if tc.function and tc.function.arguments:
+                    call["arguments"] += tc.function.arguments
+
+        if not calls:
+            return "".join(contenido), tokens
+
+        mensajes.append({
+            "role": "assistant",
+            "content": "".join(contenido) or None,
+            "tool_calls": [
+                {"id": c["id"], "type": "function", "function": {"name": c["name"], "arguments": c["arguments"]}}
+                for c in calls.values()
+            ],
+        })
+        for c in calls.values():
+            herramienta = por_nombre.get(c["name"])
+            try:
+                args = json.loads(c["arguments"] or "{}")
+                salida = herramienta.run(**args) if herramienta else f"Herramienta desconocida: {c['name']}"
+            except Exception as e:
+                salida = f"Error: {e}"
+            mensajes.append({"role": "tool", "tool_call_id": c["id"], "content": str(salida)})
+
+    return "No he podido completar la solicitud en los pasos permitidos.", tokens
+
+
+def _registrar_turno(email_usuario: str, mensaje_usuario: str, respuesta: str,
+                     ruta: str, intencion: str = None):
+    """Cuenta la ruta seguida y guarda el turno en memoria_chat."""
+    registrar_ruta(ruta, intencion)
+    try:
+        registrar_turno(
+            email_usuario, ultimo_mensaje_usuario(mensaje_usuario), respuesta,
+            json.dumps({"ruta": ruta, "intencion": intencion})
+        )
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar el turno: {e}")
+
+
+def ejecutar_turno(mensaje_usuario: str, email_usuario: str,
+                   provider: str = DEFAULT_PROVIDER, model: str = DEFAULT_MODEL,
+                   temperature: float = 0.0, modo: str = CREW_MODO,
+                   usar_router: bool = True, emitir: Optional[Callable] = None,
+                   api_key_ref: Optional[str] = None) -> Dict:
+    """
+    Ejecuta un turno y devuelve {"respuesta", "ruta", "tokens"}.
+    ruta: "rapida" (enrutador por reglas) o el modo usado.
+    emitir: callback opcional que recibe los eventos intermedios del turno:
+    - {"tipo": "intencion", "texto"}
+    - {"tipo": "herramienta_inicio", "nombre", "args"} / {"tipo": "herramienta_fin", "nombre", "resultado"}
+    - {"tipo": "token", "texto"}: fragmentos de la respuesta final
+    api_key_ref: key de Groq introducida en la interfaz (proveedores.guardar_api_key).
+    """
+    if modo not in MODOS:
+        raise ValueError(f"Modo desconocido: {modo}. Usa uno de {MODOS}")
+    emitir_evento = emitir or (lambda evento: None)
+    if provider == "ollama":
+        # Renueva el keep_alive del modelo local para los próximos turnos
+        mantener_caliente(model)
+
+    with observar_herramientas(emitir), sesion_usuario(email_usuario):
+        # Ruta rápida: si la intención es inequívoca no hace falta el Crew
+        intencion = enrutar(mensaje_usuario, email_usuario) if usar_router else None
+        if intencion:
+            emitir_evento({"tipo": "intencion", "texto": intencion.tipo})
+            respuesta = ejecutar_intencion(intencion, email_usuario)
+            emitir_evento({"tipo": "token", "texto": respuesta})
+            _registrar_turno(email_usuario, mensaje_usuario, respuesta, "rapida", intencion.tipo)
+            return {"respuesta": respuesta, "ruta": "rapida", "tokens": 0}
+
+        if modo == "function_calling":
+            respuesta, tokens = _ejecutar_function_calling(
+                mensaje_usuario, email_usuario, provider, model, temperature, emitir=emitir,
+                api_key_ref=api_key_ref
+            )
+        else:
+            respuesta, tokens = _ejecutar_crew(
+                mensaje_usuario, email_usuario, provider, model, temperature, modo, emitir=emitir,
+                api_key_ref=api_key_ref
+            )
+    _registrar_turno(email_usuario, mensaje_usuario, respuesta, modo)
+    return {"respuesta": respuesta, "ruta": modo, "tokens": tokens}
+
+
+def ejecutar_agentes_cita(mensaje_usuario: str, email_usuario: str,
+                          provider: str = DEFAULT_PROVIDER, model: str = DEFAULT_MODEL,
+                          temperature: float = 0.0, modo: str = CREW_MODO) -> str:
+    """
+    Ejecuta un turno sin eventos intermedios y devuelve solo la respuesta,
+    con el proveedor, modelo y modo indicados.
+    """
+    try:
+        return ejecutar_turno(mensaje_usuario, email_usuario, provider, model, temperature, modo)["respuesta"]
+    except ValueError as e:
+        return f"❌ Error: {e}"
@@ -1,15 +1,503 @@
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 from typing import Optional, Dict
 
+from .cache import TTLCache
+
 DB_PATH = "botcitas.db"
 
-def get_connection():
-    return sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+# Pragmas aplicados al abrir cada conexión:
+# - WAL permite lectores concurrentes mientras otro hilo escribe.
+# - busy_timeout espera al lock en lugar de fallar con "database is locked".
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+)
 
-def init_db():
+_local = threading.local()
+
+
+def _open_connection():
+    con = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES, timeout=5.0)
+    con.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        con.execute(pragma)
+    return con
+
+
+def get_connection():
+    """
+    Devuelve la conexión persistente del hilo actual (se abre la primera vez).
+    No hay que cerrarla: se reutiliza en todas las consultas del mismo hilo.
+    """
+    con = getattr(_local, "con", None)
+    if con is None or getattr(_local, "path", None) != DB_PATH:
+        if con is not None:
+            con.close()
+        con = _open_connection()
+        _local.con = con
+        _local.path = DB_PATH
+        _local.depth = 0
+    return con
+
+
+def close_connection():
+    """Cierra la conexión del hilo actual (p. ej. al terminar un worker)."""
+    con = getattr(_local, "con", None)
+    if con is not None:
+        con.close()
+        _local.con = None
+
+
+@contextmanager
+def cursor():
+    """
+    Entrega un cursor sobre la conexión del hilo.
+    Hace commit al salir (o rollback si hay excepción). Los bloques anidados
+    forman parte de la transacción del bloque más externo.
+    """
     con = get_connection()
+    _local.depth += 1
     cur = con.cursor()
+    try:
+        yield cur
+        if _local.depth == 1:
+            con.commit()
+    except BaseException:
+        if _local.depth == 1:
+            con.rollback()
+        raise
+    finally:
+        _local.depth -= 1
+        cur.close()
 
+
+def init_db():
+    with cursor() as cur:
+        _create_tables(cur)
+    migrate()
+    if os.getenv("DB_CHECK_PLANS"):
+        check_query_plans()
+
+
+# ============================
+# MIGRACIONES DE ESQUEMA
+# ============================
+# Recalcula las tablas de estadísticas desde citas y usuarios (migración 9 y
+# verificar_estadisticas(reparar=True))
+_SQL_RECONSTRUIR_STATS = [
+    "DELETE FROM stats_globales",
+    "INSERT INTO stats_globales (clave, total) SELECT 'usuarios', COUNT(*) FROM usuarios",
+    "INSERT INTO stats_globales (clave, total) SELECT 'citas', COUNT(*) FROM citas",
+    "DELETE FROM stats_citas_tipo",
+    "INSERT INTO stats_citas_tipo (tipo, total) SELECT COALESCE(tipo, ''), COUNT(*) FROM citas GROUP BY 1",
+    "DELETE FROM stats_citas_usuario",
+    "INSERT INTO stats_citas_usuario (usuario_id, total) SELECT COALESCE(usuario_id, ''), COUNT(*) FROM citas GROUP BY 1",
+    "DELETE FROM stats_citas_dia",
+    "INSERT INTO stats_citas_dia (fecha, total) SELECT COALESCE(fecha, ''), COUNT(*) FROM citas GROUP BY 1",
+]
+
+# Cada migración es (versión, descripción, sentencias). Se aplican en orden
+# y una sola vez; la versión actual se guarda en la tabla schema_version.
+# Nunca se edita una migración ya publicada: se añade una nueva al final.
+MIGRATIONS = [
+    (1, "Índices para las consultas frecuentes", [
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_email ON usuarios (email)",
+        "CREATE INDEX IF NOT EXISTS idx_citas_usuario_fecha_hora ON citas (usuario_id, fecha, hora)",
+        "CREATE INDEX IF NOT EXISTS idx_citas_usuario_tipo ON citas (usuario_id, tipo)",
+        "CREATE INDEX IF NOT EXISTS idx_citas_fecha_hora ON citas (fecha, hora)",
+        "CREATE INDEX IF NOT EXISTS idx_memoria_usuario_fecha ON memoria_chat (usuario_id, fecha)",
+    ]),
+    (2, "Índice FTS5 de búsqueda sobre citas", [
+        # Contentless: solo guarda el índice invertido, el texto sigue en citas.
+        # remove_diacritics hace que "revision" encuentre "revisión".
+        """CREATE VIRTUAL TABLE IF NOT EXISTS citas_fts USING fts5(
+            tipo, descripcion, usuario_id,
+            content='',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS citas_fts_ai AFTER INSERT ON citas BEGIN
+            INSERT INTO citas_fts (rowid, tipo, descripcion, usuario_id)
+            VALUES (new.id_cita, new.tipo, new.descripcion, new.usuario_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS citas_fts_ad AFTER DELETE ON citas BEGIN
+            INSERT INTO citas_fts (citas_fts, rowid, tipo, descripcion, usuario_id)
+            VALUES ('delete', old.id_cita, old.tipo, old.descripcion, old.usuario_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS citas_fts_au AFTER UPDATE OF tipo, descripcion, usuario_id ON citas BEGIN
+            INSERT INTO citas_fts (citas_fts, rowid, tipo, descripcion, usuario_id)
+            VALUES ('delete', old.id_cita, old.tipo, old.descripcion, old.usuario_id);
+            INSERT INTO citas_fts (rowid, tipo, descripcion, usuario_id)
+            VALUES (new.id_cita, new.tipo, new.descripcion, new.usuario_id);
+        END""",
+        """INSERT INTO citas_fts (rowid, tipo, descripcion, usuario_id)
+           SELECT id_cita, tipo, descripcion, usuario_id FROM citas""",
+    ]),
+    (3, "Espejo local de eventos de Google Calendar", [
+        """CREATE TABLE IF NOT EXISTS eventos_google (
+            usuario_id TEXT NOT NULL,
+            event_id TEXT NOT NULL,
+            resumen TEXT,
+            descripcion TEXT,
+            inicio TEXT,
+            fin TEXT,
+            inicio_utc TEXT,
+            fin_utc TEXT,
+            todo_el_dia INTEGER DEFAULT 0,
+            html_link TEXT,
+            actualizado TEXT,
+            PRIMARY KEY (usuario_id, event_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_eventos_usuario_inicio ON eventos_google (usuario_id, inicio_utc)",
+        """CREATE TABLE IF NOT EXISTS sync_google (
+            usuario_id TEXT PRIMARY KEY,
+            calendar_id TEXT,
+            sync_token TEXT,
+            ultima_sync REAL
+        )""",
+    ]),
+    (4, "Cola de trabajos para los turnos de los agentes", [
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id_job INTEGER PRIMARY KEY AUTOINCREMENT,
+            clave TEXT NOT NULL,
+            usuario_id TEXT,
+            mensaje TEXT,
+            opciones TEXT,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            etapa TEXT,
+            parcial TEXT,
+            resultado TEXT,
+            ruta TEXT,
+            creado_en TEXT,
+            actualizado_en TEXT
+        )""",
+        # Un mismo mensaje solo puede tener un trabajo vivo o terminado;
+        # si falló se permite reenviarlo.
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_clave_activa ON jobs (clave)
+           WHERE estado IN ('pendiente', 'ejecutando', 'terminado')""",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_estado ON jobs (estado)",
+    ]),
+    (5, "Caché persistente de embeddings de preguntas", [
+        """CREATE TABLE IF NOT EXISTS cache_embeddings (
+            modelo TEXT NOT NULL,
+            texto TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            creado_en REAL NOT NULL,
+            PRIMARY KEY (modelo, texto)
+        )""",
+    ]),
+    (6, "Huellas de documentos y chunks para la ingesta incremental de PDFs", [
+        "ALTER TABLE documentos_pdf ADD COLUMN hash_contenido TEXT",
+        "ALTER TABLE documentos_pdf ADD COLUMN num_paginas INTEGER",
+        "ALTER TABLE documentos_pdf ADD COLUMN num_chunks INTEGER",
+        "ALTER TABLE documentos_pdf ADD COLUMN actualizado_en TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_documentos_usuario_titulo ON documentos_pdf (usuario_id, titulo)",
+        "CREATE INDEX IF NOT EXISTS idx_documentos_usuario_hash ON documentos_pdf (usuario_id, hash_contenido)",
+        # Un chunk (id = hash de su texto) puede aparecer en varias páginas o
+        # documentos; solo se borra del vector store cuando nadie lo usa.
+        """CREATE TABLE IF NOT EXISTS chunks_pdf (
+            id_doc INTEGER NOT NULL,
+            pagina INTEGER NOT NULL,
+            chunk_id TEXT NOT NULL,
+            hash_pagina TEXT NOT NULL,
+            PRIMARY KEY (id_doc, pagina, chunk_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_chunks_chunk_id ON chunks_pdf (chunk_id)",
+    ]),
+    (7, "Índice léxico BM25 de los chunks de PDF", [
+        # Guarda el texto (a diferencia de citas_fts): es la única copia en
+        # SQLite del contenido que también está en el vector store.
+        """CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+            texto,
+            chunk_id UNINDEXED, id_doc UNINDEXED, pagina UNINDEXED, usuario_id UNINDEXED,
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='3'
+        )""",
+    ]),
+    (8, "Índice por tipo para agregar la demanda del dashboard", [
+        "CREATE INDEX IF NOT EXISTS idx_citas_tipo ON citas (tipo)",
+    ]),
+    (9, "Tablas de estadísticas del dashboard mantenidas por triggers", [
+        # Contadores que los triggers actualizan en cada escritura: el
+        # dashboard los lee en O(1) en lugar de recorrer citas y usuarios.
+        # verificar_estadisticas() los compara con los datos base.
+        "CREATE TABLE IF NOT EXISTS stats_globales (clave TEXT PRIMARY KEY, total INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS stats_citas_tipo (tipo TEXT PRIMARY KEY, total INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS stats_citas_usuario (usuario_id TEXT PRIMARY KEY, total INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS stats_citas_dia (fecha TEXT PRIMARY KEY, total INTEGER NOT NULL)",
+        """CREATE TRIGGER IF NOT EXISTS stats_citas_ai AFTER INSERT ON citas BEGIN
+            UPDATE stats_globales SET total = total + 1 WHERE clave = 'citas';
+            INSERT INTO stats_citas_tipo (tipo, total) VALUES (COALESCE(new.tipo, ''), 1)
+            ON CONFLICT(tipo) DO UPDATE SET total = total + 1;
+            INSERT INTO stats_citas_usuario (usuario_id, total) VALUES (COALESCE(new.usuario_id, ''), 1)
+            ON CONFLICT(usuario_id) DO UPDATE SET total = total + 1;
+            INSERT INTO stats_citas_dia (fecha, total) VALUES (COALESCE(new.fecha, ''), 1)
+            ON CONFLICT(fecha) DO UPDATE SET total = total + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS stats_citas_ad AFTER DELETE ON citas BEGIN
+            UPDATE stats_globales SET total = total - 1 WHERE clave = 'citas';
+            INSERT INTO stats_citas_tipo (tipo, total) VALUES (COALESCE(old.tipo, ''), -1)
+            ON CONFLICT(tipo) DO UPDATE SET total = total - 1;
+            DELETE FROM stats_citas_tipo WHERE tipo = COALESCE(old.tipo, '') AND total <= 0;
+            INSERT INTO stats_citas_usuario (usuario_id, total) VALUES (COALESCE(old.usuario_id, ''), -1)
+            ON CONFLICT(usuario_id) DO UPDATE SET total = total - 1;
+            DELETE FROM stats_citas_usuario WHERE usuario_id = COALESCE(old.usuario_id, '') AND total <= 0;
+            INSERT INTO stats_citas_dia (fecha, total) VALUES (COALESCE(old.fecha, ''), -1)
+            ON CONFLICT(fecha) DO UPDATE SET total = total - 1;
+            DELETE FROM stats_citas_dia WHERE fecha = COALESCE(old.fecha, '') AND total <= 0;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS stats_citas_au AFTER UPDATE OF tipo, usuario_id, fecha ON citas BEGIN
+            INSERT INTO stats_citas_tipo (tipo, total) VALUES (COALESCE(old.tipo, ''), -1)
+            ON CONFLICT(tipo) DO UPDATE SET total = total - 1;
+            DELETE FROM stats_citas_tipo WHERE tipo = COALESCE(old.tipo, '') AND total <= 0;
+            INSERT INTO stats_citas_usuario (usuario_id, total) VALUES (COALESCE(old.usuario_id, ''), -1)
+            ON CONFLICT(usuario_id) DO UPDATE SET total = total - 1;
+            DELETE FROM stats_citas_usuario WHERE usuario_id = COALESCE(old.usuario_id, '') AND total <= 0;
+            INSERT INTO stats_citas_dia (fecha, total) VALUES (COALESCE(old.fecha, ''), -1)
+            ON CONFLICT(fecha) DO UPDATE SET total = total - 1;
+            DELETE FROM stats_citas_dia WHERE fecha = COALESCE(old.fecha, '') AND total <= 0;
+            INSERT INTO stats_citas_tipo (tipo, total) VALUES (COALESCE(new.tipo, ''), 1)
+            ON CONFLICT(tipo) DO UPDATE SET total = total + 1;
+            INSERT INTO stats_citas_usuario (usuario_id, total) VALUES (COALESCE(new.usuario_id, ''), 1)
+            ON CONFLICT(usuario_id) DO UPDATE SET total = total + 1;
+            INSERT INTO stats_citas_dia (fecha, total) VALUES (COALESCE(new.fecha, ''), 1)
+            ON CONFLICT(fecha) DO UPDATE SET total = total + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS stats_usuarios_ai AFTER INSERT ON usuarios BEGIN
+            UPDATE stats_globales SET total = total + 1 WHERE clave = 'usuarios';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS stats_usuarios_ad AFTER DELETE ON usuarios BEGIN
+            UPDATE stats_globales SET total = total - 1 WHERE clave = 'usuarios';
+        END""",
+    ] + _SQL_RECONSTRUIR_STATS),
+    (10, "Almacén de credenciales OAuth de Google", [
+        # Sustituye a los ficheros de tokens/; ver backend/credenciales.py
+        """CREATE TABLE IF NOT EXISTS credenciales (
+            clave TEXT PRIMARY KEY,
+            token_json TEXT NOT NULL,
+            expira_en TEXT,
+            actualizado_en TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_credenciales_expira ON credenciales (expira_en)",
+    ]),
+    (11, "Deduplicar solo los trabajos vivos", [
+        # Un mensaje ya terminado se puede volver a enviar (p. ej. la misma
+        # cita otra semana tras limpiar el chat)
+        "DROP INDEX IF EXISTS idx_jobs_clave_activa",
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_clave_activa ON jobs (clave)
+           WHERE estado IN ('pendiente', 'ejecutando')""",
+    ]),
+    (12, "Índice BM25 de chunks filtrable por usuario", [
+        # El texto pasa a una tabla normal (borrados por chunk_id con índice)
+        # y chunks_fts queda como índice de contenido externo, mantenido por
+        # triggers como citas_fts. La columna usuario es un token indexado
+        # ('u' + hex del usuario_id): la consulta filtra dentro del MATCH.
+        """CREATE TABLE IF NOT EXISTS chunks_texto (
+            id INTEGER PRIMARY KEY,
+            chunk_id TEXT NOT NULL UNIQUE,
+            texto TEXT NOT NULL,
+            usuario TEXT NOT NULL,
+            id_doc INTEGER,
+            pagina INTEGER,
+            usuario_id TEXT
+        )""",
+        """INSERT OR IGNORE INTO chunks_texto (chunk_id, texto, usuario, id_doc, pagina, usuario_id)
+           SELECT chunk_id, texto, 'u' || COALESCE(hex(usuario_id), ''), id_doc, pagina, usuario_id
+           FROM chunks_fts""",
+        "DROP TABLE chunks_fts",
+        """CREATE VIRTUAL TABLE chunks_fts USING fts5(
+            texto, usuario,
+            content='chunks_texto', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='3'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS chunks_texto_ai AFTER INSERT ON chunks_texto BEGIN
+            INSERT INTO chunks_fts (rowid, texto, usuario) VALUES (new.id, new.texto, new.usuario);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS chunks_texto_ad AFTER DELETE ON chunks_texto BEGIN
+            INSERT INTO chunks_fts (chunks_fts, rowid, texto, usuario) VALUES ('delete', old.id, old.texto, old.usuario);
+        END""",
+        "INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')",
+    ]),
+    (13, "Marca de credenciales revocadas", [
+        # Un token revocado se marca una vez y deja de refrescarse hasta que
+        # el usuario vuelve a conectar su cuenta
+        "ALTER TABLE credenciales ADD COLUMN revocada_en TEXT",
+    ]),
+    (14, "Versión de la agenda de cada usuario", [
+        # Sube con cualquier cambio en citas o eventos_google del usuario,
+        # también desde otros procesos: la caché de disponibilidad.py la
+        # usa en la clave en lugar de la generación global de escritura.
+        "CREATE TABLE IF NOT EXISTS agenda_version (usuario_id TEXT PRIMARY KEY, version INTEGER NOT NULL)",
+        """CREATE TRIGGER IF NOT EXISTS agenda_version_citas_ai AFTER INSERT ON citas BEGIN
+            INSERT INTO agenda_version (usuario_id, version) VALUES (COALESCE(new.usuario_id, ''), 1)
+            ON CONFLICT(usuario_id) DO UPDATE SET version = version + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS agenda_version_citas_ad AFTER DELETE ON citas BEGIN
+            INSERT INTO agenda_version (usuario_id, version) VALUES (COALESCE(old.usuario_id, ''), 1)
+            ON CONFLICT(usuario_id) DO UPDATE SET version = version + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS agenda_version_citas_au AFTER UPDATE ON citas BEGIN
+            INSERT INTO agenda_version (usuario_id, version) VALUES (COALESCE(old.usuario_id, ''), 1)
+            ON CONFLICT(usuario_id) DO UPDATE SET version = version + 1;
+            INSERT INTO agenda_version (usuario_id, version) VALUES (COALESCE(new.usuario_id, ''), 1)
+            ON CONFLICT(usuario_id) DO UPDATE SET version = version + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS agenda_version_eventos_google_ai AFTER INSERT ON eventos_google BEGIN
+            INSERT INTO agenda_version (usuario_id, version) VALUES (COALESCE(new.usuario_id, ''), 1)
+            ON CONFLICT(usuario_id) DO UPDATE SET version = version + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS agenda_version_eventos_google_ad AFTER DELETE ON eventos_google BEGIN
+            INSERT INTO agenda_version (usuario_id, version) VALUES (COALESCE(old.usuario_id, ''), 1)
+            ON CONFLICT(usuario_id) DO UPDATE SET version = version + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS agenda_version_eventos_google_au AFTER UPDATE ON eventos_google BEGIN
+            INSERT INTO agenda_version (usuario_id, version) VALUES (COALESCE(old.usuario_id, ''), 1)
+            ON CONFLICT(usuario_id) DO UPDATE SET version = version + 1;
+            INSERT INTO agenda_version (usuario_id, version) VALUES (COALESCE(new.usuario_id, ''), 1)
+            ON CONFLICT(usuario_id) DO UPDATE SET version = version + 1;
+        END""",
+    ]),
+    (15, "Índice de eventos del espejo por fin", [
+        # get_mirrored_events filtra y ordena por el fin (los eventos en curso
+        # siguen apareciendo); la expresión debe coincidir con la de la consulta
+        """CREATE INDEX IF NOT EXISTS idx_eventos_usuario_fin
+           ON eventos_google (usuario_id, COALESCE(fin_utc, inicio_utc))""",
+    ]),
+    (16, "Versión de los datos del dashboard", [
+        # Sube solo con los cambios que ve el dashboard (citas y usuarios),
+        # también desde otros procesos: la caché del dashboard la usa en la
+        # clave, así que el progreso de los jobs, memoria_chat o la caché de
+        # embeddings no la invalidan.
+        """CREATE TABLE IF NOT EXISTS dashboard_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )""",
+        "INSERT OR IGNORE INTO dashboard_version (id, version) VALUES (1, 0)",
+        """CREATE TRIGGER IF NOT EXISTS dashboard_version_citas_ai AFTER INSERT ON citas BEGIN
+            UPDATE dashboard_version SET version = version + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS dashboard_version_citas_ad AFTER DELETE ON citas BEGIN
+            UPDATE dashboard_version SET version = version + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS dashboard_version_citas_au
+           AFTER UPDATE OF fecha, hora, tipo, usuario_id ON citas BEGIN
+            UPDATE dashboard_version SET version = version + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS dashboard_version_usuarios_ai AFTER INSERT ON usuarios BEGIN
+            UPDATE dashboard_version SET version = version + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS dashboard_version_usuarios_ad AFTER DELETE ON usuarios BEGIN
+            UPDATE dashboard_version SET version = version + 1;
+        END""",
+    ]),
+    (17, "Índice de eventos del espejo por inicio y fin", [
+        # get_mirrored_events ordena y limita por inicio: con el fin en el
+        # propio índice, los eventos ya terminados se descartan sin leer la
+        # tabla ni ordenar. Sustituye al de la migración 15 y al de
+        # (usuario_id, inicio_utc), que es su prefijo.
+        """CREATE INDEX IF NOT EXISTS idx_eventos_usuario_inicio_fin
+           ON eventos_google (usuario_id, inicio_utc, COALESCE(fin_utc, inicio_utc))""",
+        "DROP INDEX IF EXISTS idx_eventos_usuario_fin",
+        "DROP INDEX IF EXISTS idx_eventos_usuario_inicio",
+    ]),
+]
+
+
+def get_schema_version() -> int:
+    row = query_one("SELECT MAX(version) AS version FROM schema_version")
+    return (row["version"] or 0) if row else 0
+
+
+def migrate():
+    """
+    Aplica las migraciones pendientes, cada una en su propia transacción.
+    sqlite3 no abre transacción antes de un DDL, así que se abre a mano con
+    BEGIN IMMEDIATE: si una sentencia falla no queda nada a medias, y si dos
+    procesos arrancan a la vez el segundo espera y ve la migración aplicada.
+    """
+    execute_query("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            descripcion TEXT,
+            aplicada_en TEXT
+        )
+    """)
+    for version, descripcion, sentencias in MIGRATIONS:
+        if version <= get_schema_version():
+            continue
+        with cursor() as cur:
+            cur.execute("BEGIN IMMEDIATE")
+            # Otro proceso pudo aplicarla mientras se esperaba el lock
+            actual = cur.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+            if version <= actual:
+                continue
+            for sql in sentencias:
+                cur.execute(sql)
+            cur.execute(
+                "INSERT INTO schema_version (version, descripcion, aplicada_en) VALUES (?, ?, datetime('now'))",
+                (version, descripcion)
+            )
+
+
+# Consultas calientes con parámetros de ejemplo. check_query_plans() verifica
+# que ninguna recorre la tabla entera.
+HOT_QUERIES = {
+    "get_user_by_email": ("SELECT * FROM usuarios WHERE email = ?", ("a@b.com",)),
+    "get_user_appointments": ("""
+        SELECT * FROM citas WHERE usuario_id = ? ORDER BY fecha ASC, hora ASC
+    """, ("a@b.com",)),
+    "find_appointment_tipo": ("SELECT * FROM citas WHERE usuario_id = ? AND tipo = ? LIMIT 1", ("a@b.com", "Dentista")),
+    "find_appointment_fecha": ("SELECT * FROM citas WHERE usuario_id = ? AND fecha = ? LIMIT 1", ("a@b.com", "2025-01-01")),
+    "find_appointment_fecha_tipo": ("""
+        SELECT * FROM citas WHERE usuario_id = ? AND fecha = ? AND tipo = ? LIMIT 1
+    """, ("a@b.com", "2025-01-01", "Dentista")),
+    "get_all_appointments": ("SELECT * FROM citas ORDER BY fecha DESC, hora DESC", ()),
+    "get_mirrored_events": ("""
+        SELECT * FROM eventos_google WHERE usuario_id = ? AND COALESCE(fin_utc, inicio_utc) > ?
+        ORDER BY inicio_utc LIMIT ?
+    """, ("a@b.com", "2025-01-01T00:00:00", 50)),
+    "list_appointments_fecha": ("""
+        SELECT * FROM citas WHERE fecha = ? ORDER BY hora DESC LIMIT ?
+    """, ("2025-01-01", 50)),
+    "dashboard_ultimas_citas": ("""
+        SELECT fecha, hora, tipo, usuario_id FROM citas ORDER BY fecha DESC, hora DESC LIMIT ?
+    """, (10,)),
+}
+
+
+def explain(query: str, params: tuple = ()):
+    """Devuelve las líneas de EXPLAIN QUERY PLAN de una consulta."""
+    return [r["detail"] for r in query_all("EXPLAIN QUERY PLAN " + query, params)]
+
+
+def check_query_plans():
+    """
+    Comprueba con EXPLAIN QUERY PLAN que las consultas de HOT_QUERIES usan
+    índices. Lanza RuntimeError si alguna cae en un SCAN completo o
+    necesita un B-tree temporal para ordenar.
+    """
+    fallos = {}
+    for nombre, (query, params) in HOT_QUERIES.items():
+        malos = [
+            d for d in explain(query, params)
+            if (d.startswith("SCAN") and "USING" not in d) or "TEMP B-TREE" in d
+        ]
+        if malos:
+            fallos[nombre] = malos
+    if fallos:
+        raise RuntimeError(f"Consultas sin índice: {fallos}")
+    return True
+
+
+def _create_tables(cur):
     # Tabla de usuarios
     cur.execute('''
     CREATE TABLE IF NOT EXISTS usuarios (
@@ -62,37 +550,22 @@ def init_db():
     )
     ''')
 
-    con.commit()
-    con.close()
-
 
 def execute_query(query: str, params: tuple = ()):
-    con = get_connection()
-    cur = con.cursor()
-    cur.execute(query, params)
-    con.commit()
-    lastrowid = cur.lastrowid
-    con.close()
-    return lastrowid
+    with cursor() as cur:
+        cur.execute(query, params)
+        return cur.lastrowid
 
 
 def query_one(query: str, params: tuple = ()):
-    con = get_connection()
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-    cur.execute(query, params)
-    row = cur.fetchone()
-    con.close()
+    with cursor() as cur:
+        row = cur.execute(query, params).fetchone()
     return dict(row) if row else None
 
 
 def query_all(query: str, params: tuple = ()):
-    con = get_connection()
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-    cur.execute(query, params)
-    rows = cur.fetchall()
-    con.close()
+    with cursor() as cur:
+        rows = cur.execute(query, params).fetchall()
     return [dict(r) for r in rows]
 
 
@@ -100,9 +573,10 @@ def get_user_by_email(email: str) -> Optional[Dict]:
     return query_one("SELECT * FROM usuarios WHERE email = ?", (email,))
 
 
-def upsert_user_token(usuario_id: str, nombre: str, email: str, token_path: str):
+def upsert_user_token(usuario_id: str, nombre: str, email: str, token_path: Optional[str] = None):
     """
-    Inserta o actualiza el usuario y guarda el token de Google OAuth.
+    Inserta o actualiza el usuario. El token de Google OAuth se guarda en el
+    almacén de credenciales; token_path solo queda para tokens antiguos en fichero.
     """
     execute_query("""
         INSERT INTO usuarios (usuario_id, nombre, email, fecha_registro, token_path)
@@ -163,6 +637,14 @@ def delete_appointment_by_id(id_cita: int):
     execute_query("DELETE FROM citas WHERE id_cita = ?", (id_cita,))
 
 
+def registrar_turno(usuario_id: str, mensaje_usuario: str, respuesta_bot: str, contexto: str = None):
+    """Guarda un turno del chat en memoria_chat (contexto: JSON con la ruta seguida)."""
+    execute_query("""
+        INSERT INTO memoria_chat (usuario_id, fecha, mensaje_usuario, respuesta_bot, contexto)
+        VALUES (?, datetime('now'), ?, ?, ?)
+    """, (usuario_id, mensaje_usuario, respuesta_bot, contexto))
+
+
 def get_all_appointments():
     """Devuelve absolutamente todas las citas del sistema para el Admin."""
     return query_all("SELECT * FROM citas ORDER BY fecha DESC, hora DESC")
@@ -170,4 +652,102 @@ def get_all_appointments():
 
 def get_all_users():
     """Devuelve todos los usuarios registrados."""
-    return query_all("SELECT * FROM usuarios")
\ No newline at end of file
+    return query_all("SELECT * FROM usuarios")
+
+
+# ============================
+# DASHBOARD DE ADMINISTRACIÓN
+# ============================
+# Las agregaciones se hacen en SQLite y se cachean DASHBOARD_CACHE_TTL
+# segundos. La clave incluye dashboard_version (migración 16), que solo
+# sube cuando cambian citas o usuarios, en este o en otro proceso.
+DASHBOARD_CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", "30"))
+_cache_dashboard = TTLCache(maxsize=64, ttl=DASHBOARD_CACHE_TTL)
+
+
+def _cacheado(nombre: str, calcular, *args):
+    fila = query_one("SELECT version FROM dashboard_version WHERE id = 1")
+    clave = (DB_PATH, nombre, args, fila["version"] if fila else 0)
+    valor = _cache_dashboard.get(clave)
+    if valor is None:
+        valor = calcular(*args)
+        _cache_dashboard.set(clave, valor)
+    return valor
+
+
+def _kpis() -> Dict:
+    # O(1): los contadores los mantienen los triggers de la migración 9
+    totales = {r["clave"]: r["total"] for r in query_all("SELECT clave, total FROM stats_globales")}
+    usuarios, citas = totales.get("usuarios", 0), totales.get("citas", 0)
+    return {
+        "usuarios": usuarios,
+        "citas": citas,
+        "promedio_citas_usuario": round(citas / usuarios, 1) if usuarios else 0,
+    }
+
+
+def dashboard_kpis() -> Dict:
+    """Usuarios totales, citas totales y promedio de citas por usuario."""
+    return _cacheado("kpis", _kpis)
+
+
+def dashboard_demanda_por_tipo(limit: int = 20):
+    """[{tipo, total}] de los servicios más pedidos (tabla stats_citas_tipo)."""
+    return _cacheado("demanda", lambda n: query_all("""
+        SELECT tipo, total FROM stats_citas_tipo ORDER BY total DESC LIMIT ?
+    """, (n,)), limit)
+
+
+def dashboard_citas_por_dia(desde: str, hasta: str):
+    """[{fecha, total}] de citas por día en [desde, hasta] (tabla stats_citas_dia)."""
+    return _cacheado("por_dia", lambda d, h: query_all("""
+        SELECT fecha, total FROM stats_citas_dia WHERE fecha BETWEEN ? AND ? ORDER BY fecha
+    """, (d, h)), desde, hasta)
+
+
+def dashboard_ultimas_citas(limit: int = 10):
+    """Las últimas citas por fecha y hora, leídas en orden del índice."""
+    return _cacheado("ultimas", lambda n: query_all("""
+        SELECT fecha, hora, tipo, usuario_id FROM citas ORDER BY fecha DESC, hora DESC LIMIT ?
+    """, (n,)), limit)
+
+
+# Consultas que recalculan cada tabla de estadísticas desde los datos base
+_STATS_ESPERADAS = {
+    "stats_globales": """
+        SELECT 'usuarios' AS clave, COUNT(*) AS total FROM usuarios
+        UNION ALL SELECT 'citas', COUNT(*) FROM citas
+    """,
+    "stats_citas_tipo": "SELECT COALESCE(tipo, '') AS clave, COUNT(*) AS total FROM citas GROUP BY 1",
+    "stats_citas_usuario": "SELECT COALESCE(usuario_id, '') AS clave, COUNT(*) AS total FROM citas GROUP BY 1",
+    "stats_citas_dia": "SELECT COALESCE(fecha, '') AS clave, COUNT(*) AS total FROM citas GROUP BY 1",
+}
+_STATS_CLAVE = {"stats_globales": "clave", "stats_citas_tipo": "tipo",
+                "stats_citas_usuario": "usuario_id", "stats_citas_dia": "fecha"}
+
+
+def verificar_estadisticas(reparar: bool = False) -> Dict[str, Dict]:
+    """
+    Compara las tablas de estadísticas con los datos base. Devuelve, por
+    tabla, las claves con deriva como {clave: (guardado, real)}; vacío si
+    todo cuadra. Con reparar=True reconstruye las tablas si hay deriva.
+    """
+    deriva = {}
+    with cursor() as cur:
+        for tabla, sql in _STATS_ESPERADAS.items():
+            real = {r["clave"]: r["total"] for r in cur.execute(sql).fetchall()}
+            guardado = {
+                r[0]: r[1] for r in cur.execute(f"SELECT {_STATS_CLAVE[tabla]}, total FROM {tabla}").fetchall()
+            }
+            diferencias = {
+                c: (guardado.get(c, 0), real.get(c, 0))
+                for c in real.keys() | guardado.keys()
+                if guardado.get(c, 0) != real.get(c, 0)
+            }
+            if diferencias:
+                deriva[tabla] = diferencias
+        if deriva and reparar:
+            for sql in _SQL_RECONSTRUIR_STATS:
+                cur.execute(sql)
+            cur.execute("UPDATE dashboard_version SET version = version + 1")
+    return deriva
@@ -0,0 +1,207 @@
+# backend/disponibilidad.py
+"""
+Motor de disponibilidad: huecos libres y detección de solapes sobre las
+citas del usuario y su espejo de Google Calendar (eventos_google).
+
+Por usuario se construye un índice de intervalos ordenados por inicio, con
+el máximo acumulado de los finales. Así, saber qué ocupa [a, b) es una
+búsqueda binaria más un recorrido hacia atrás que se detiene en cuanto
+ningún intervalo anterior puede llegar a `a`: microsegundos aunque haya un
+año de agenda. El índice se reconstruye solo cuando cambia la agenda de ese
+usuario (tabla agenda_version, que mantienen triggers también para las
+escrituras de otros procesos), y como mucho cada DISPONIBILIDAD_TTL segundos.
+
+Los tiempos se manejan como minutos en la zona horaria local (TIMEZONE).
+"""
+import os
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from itertools import accumulate
+from typing import Dict, List, Optional, Tuple
+
+import pytz
+
+from . import db
+from .cache import TTLCache
+from .db import query_all, query_one
+
+# Duración de una cita cuando no se indica (la misma que create_event)
+DURACION_CITA = int(os.getenv("DURACION_CITA", "60"))
+# Horario de atención y días laborables (0 = lunes)
+HORARIO = os.getenv("DISPONIBILIDAD_HORARIO", "09:00-18:00")
+DIAS_LABORABLES = {int(d) for d in os.getenv("DISPONIBILIDAD_DIAS", "0,1,2,3,4").split(",")}
+# Granularidad de las horas de inicio propuestas
+PASO_MINUTOS = int(os.getenv("DISPONIBILIDAD_PASO", "30"))
+# Vida máxima de un índice en memoria
+DISPONIBILIDAD_TTL = float(os.getenv("DISPONIBILIDAD_TTL", "300"))
+
+_EPOCA = datetime(2000, 1, 1)
+_indices = TTLCache(maxsize=256, ttl=DISPONIBILIDAD_TTL)
+
+
+def _minuto(dt: datetime) -> int:
+    return int((dt - _EPOCA).total_seconds() // 60)
+
+
+def _fecha_hora(minuto: int) -> datetime:
+    return _EPOCA + timedelta(minutes=minuto)
+
+
+def _minuto_local(fecha_iso: str, hora: str) -> int:
+    return _minuto(datetime.strptime(f"{fecha_iso} {hora[:5]}", "%Y-%m-%d %H:%M"))
+
+
+def ahora_local() -> datetime:
+    """Fecha y hora actuales en TIMEZONE, sin zona (como los minutos del índice)."""
+    return datetime.now(pytz.timezone(os.getenv("TIMEZONE", "Europe/Madrid"))).replace(tzinfo=None)
+
+
+def _horario(horario: str) -> Tuple[int, int]:
+    """'09:00-18:00' -> minutos desde medianoche de inicio y fin."""
+    inicio, fin = horario.split("-")
+    return tuple(int(h) * 60 + int(m) for h, m in (inicio.split(":"), fin.split(":")))
+
+
+def en_horario(hora: str, duracion: int = DURACION_CITA, horario: Optional[str] = None) -> bool:
+    """True si una cita a 'HH:MM' de `duracion` minutos cabe en el horario (por defecto, HORARIO)."""
+    apertura, cierre = _horario(horario or HORARIO)
+    inicio = int(hora[:2]) * 60 + int(hora[3:5])
+    return apertura <= inicio and inicio + duracion <= cierre
+
+
+class IndiceAgenda:
+    """Intervalos [inicio, fin) ocupados de un usuario, ordenados por inicio."""
+
+    def __init__(self, intervalos: List[Tuple[int, int, str, Optional[int], Optional[str]]]):
+        intervalos.sort()
+        self.inicios = [i[0] for i in intervalos]
+        self.fines = [i[1] for i in intervalos]
+        self.titulos = [i[2] for i in intervalos]
+        self.citas = [i[3] for i in intervalos]
+        self.eventos = [i[4] for i in intervalos]
+        # max_fin[j]: el mayor fin entre los intervalos 0..j
+        self.max_fin = list(accumulate(self.fines, max))
+
+    def __len__(self) -> int:
+        return len(self.inicios)
+
+    def solapes(self, a: int, b: int, excluir: Tuple = ()) -> List[int]:
+        """Posiciones de los intervalos que se solapan con [a, b), por inicio."""
+        j = bisect_left(self.inicios, b) - 1
+        encontrados = []
+        while j >= 0 and self.max_fin[j] > a:
+            if self.fines[j] > a and not (
+                (self.citas[j] is not None and self.citas[j] in excluir)
+                or (self.eventos[j] is not None and self.eventos[j] in excluir)
+            ):
+                encontrados.append(j)
+            j -= 1
+        encontrados.reverse()
+        return encontrados
+
+    def huecos(self, a: int, b: int, duracion: int) -> List[Tuple[int, int]]:
+        """Tramos libres de al menos `duracion` minutos dentro de [a, b)."""
+        libres, desde = [], a
+        for j in self.solapes(a, b):
+            if self.inicios[j] - desde >= duracion:
+                libres.append((desde, self.inicios[j]))
+            desde = max(desde, self.fines[j])
+        if b - desde >= duracion:
+            libres.append((desde, b))
+        return libres
+
+
+def _construir(usuario_id: str) -> IndiceAgenda:
+    intervalos, con_evento = [], set()
+    for c in query_all(
+        "SELECT id_cita, fecha, hora, tipo, id_evento_google FROM citas WHERE usuario_id = ?", (usuario_id,)
+    ):
+        try:
+            inicio = _minuto_local(c["fecha"], c["hora"])
+        except (TypeError, ValueError):
+            continue
+        intervalos.append((inicio, inicio + DURACION_CITA, c["tipo"] or "Cita", c["id_cita"], c["id_evento_google"]))
+        if c["id_evento_google"]:
+            con_evento.add(c["id_evento_google"])
+
+    tz = pytz.timezone(os.getenv("TIMEZONE", "Europe/Madrid"))
+    for e in query_all(
+        "SELECT event_id, resumen, inicio_utc, fin_utc FROM eventos_google WHERE usuario_id = ?", (usuario_id,)
+    ):
+        # Los eventos creados por el bot ya están como cita
+        if e["event_id"] in con_evento or not e["inicio_utc"]:
+            continue
+        inicio, fin = (
+            _minuto(pytz.utc.localize(datetime.fromisoformat(t)).astimezone(tz).replace(tzinfo=None))
+            for t in (e["inicio_utc"], e["fin_utc"] or e["inicio_utc"])
+        )
+        intervalos.append((inicio, max(fin, inicio + 1), e["resumen"] or "Evento", None, e["event_id"]))
+    return IndiceAgenda(intervalos)
+
+
+def indice_usuario(usuario_id: str) -> IndiceAgenda:
+    """Índice del usuario; se reconstruye solo si su agenda ha cambiado."""
+    fila = query_one("SELECT version FROM agenda_version WHERE usuario_id = ?", (usuario_id,))
+    clave = (db.DB_PATH, usuario_id, fila["version"] if fila else 0)
+    indice = _indices.get(clave)
+    if indice is None:
+        indice = _construir(usuario_id)
+        _indices.set(clave, indice)
+    return indice
+
+
+def conflictos(usuario_id: str, fecha_iso: str, hora: str, duracion: int = DURACION_CITA,
+               excluir: Tuple = ()) -> List[Dict]:
+    """
+    Citas o eventos que se solapan con una cita nueva en fecha y hora.
+    excluir: id_cita o id de evento de Google que no cuentan (la cita que se mueve).
+    """
+    indice = indice_usuario(usuario_id)
+    a = _minuto_local(fecha_iso, hora)
+    return [
+        {
+            "titulo": indice.titulos[j],
+            "inicio": _fecha_hora(indice.inicios[j]).strftime("%Y-%m-%d %H:%M"),
+            "fin": _fecha_hora(indice.fines[j]).strftime("%Y-%m-%d %H:%M"),
+        }
+        for j in indice.solapes(a, a + duracion, excluir)
+    ]
+
+
+def huecos_libres(usuario_id: str, fecha_iso: str, duracion: int = DURACION_CITA,
+                  horario: str = HORARIO, desde: Optional[datetime] = None) -> List[Tuple[str, str]]:
+    """
+    Tramos libres ('HH:MM', 'HH:MM') del día dentro del horario de atención.
+    Nada si no es laborable; no empiezan antes de `desde` (por defecto, ahora).
+    """
+    if datetime.strptime(fecha_iso, "%Y-%m-%d").weekday() not in DIAS_LABORABLES:
+        return []
+    apertura, cierre = _horario(horario)
+    dia = _minuto_local(fecha_iso, "00:00")
+    inicio = max(dia + apertura, _minuto((desde or ahora_local()).replace(second=0, microsecond=0, tzinfo=None)))
+    return [
+        (_fecha_hora(a).strftime("%H:%M"), _fecha_hora(b).strftime("%H:%M"))
+        for a, b in indice_usuario(usuario_id).huecos(inicio, dia + cierre, duracion)
+    ]
+
+
+def proximos_huecos(usuario_id: str, desde: datetime, duracion: int = DURACION_CITA,
+                    n: int = 3, dias_max: int = 60, horario: str = HORARIO) -> List[Tuple[str, str]]:
+    """Las n primeras (fecha, hora) libres desde `desde` en días laborables."""
+    apertura, cierre = _horario(horario)
+    indice = indice_usuario(usuario_id)
+    ahora = _minuto(desde.replace(second=0, microsecond=0, tzinfo=None))
+    propuestas = []
+    for d in range(dias_max):
+        fecha = (desde + timedelta(days=d)).date()
+        if fecha.weekday() not in DIAS_LABORABLES:
+            continue
+        dia = _minuto(datetime.combine(fecha, datetime.min.time()))
+        for a, b in indice.huecos(max(dia + apertura, ahora), dia + cierre, duracion):
+            # Redondeo al siguiente múltiplo del paso (p. ej. 10:07 -> 10:30)
+            inicio = -(-a // PASO_MINUTOS) * PASO_MINUTOS
+            if b - inicio >= duracion:
+                propuestas.append((fecha.isoformat(), _fecha_hora(inicio).strftime("%H:%M")))
+                if len(propuestas) >= n:
+                    return propuestas
+    return propuestas
@@ -1,76 +1,94 @@
 # google_calendar.py
 import os, pytz
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional, Dict, List
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import httplib2
+import google_auth_httplib2
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 
-SCOPES = ["https://www.googleapis.com/auth/calendar"]
+from .credenciales import obtener_credenciales
 
-def _load_creds(token_path: Optional[str], creds_path: Optional[str] = None):
-    creds_path = creds_path or os.getenv("GOOGLE_CREDENTIALS_PATH", "credentials.json")
-    token_path = token_path or os.getenv("GOOGLE_TOKEN_PATH", "token.json")
+# Respuestas de Calendar a un borrado de un evento que ya no existe
+YA_BORRADO = (404, 410)
 
-    creds = None
-    
-    # Intentar cargar credenciales existentes
-    if token_path and os.path.exists(token_path):
-        try:
-            # Verificar que el archivo no esté vacío
-            if os.path.getsize(token_path) > 0:
-                creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-            else:
-                print(f"⚠️ Token vacío en {token_path}, se regenerará")
-                os.remove(token_path)
-        except Exception as e:
-            print(f"⚠️ Error al leer token en {token_path}: {e}")
-            print(f" Eliminando token corrupto y regenerando...")
-            try:
-                os.remove(token_path)
-            except:
-                pass
-            creds = None
-    
-    # Si no hay credenciales válidas, obtenerlas
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-            except Exception as e:
-                print(f"⚠️ Error al refrescar token: {e}")
-                print(f"Iniciando flujo de autenticación completo...")
-                flow = InstalledAppFlow.from_client_secrets_file(creds_path, SCOPES)
-                creds = flow.run_local_server(port=0)
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(creds_path, SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        # Guardar token
-        if token_path:
-            try:
-                with open(token_path, "w", encoding="utf-8") as f:
-                    f.write(creds.to_json())
-                print(f"✅ Token guardado en {token_path}")
-            except Exception as e:
-                print(f"⚠️ Error al guardar token: {e}")
-    
-    return creds
+# Caché de clientes de Calendar ya autorizados, por clave de credenciales (LRU)
+SERVICE_CACHE_SIZE = int(os.getenv("GOOGLE_SERVICE_CACHE_SIZE", "32"))
 
-def get_service(token_path: Optional[str] = None):
-    creds = _load_creds(token_path)
-    return build("calendar", "v3", credentials=creds)
 
-def create_event(summary: str, date_iso: str, time_hhmm: str,
-                 duration_minutes: int = 60, description: str = "",
-                 attendees_emails: Optional[List[str]] = None,
-                 token_path: Optional[str] = None) -> Dict:
+class _CachedService:
     """
-    Crea un evento y devuelve el dict de evento (incluye 'id' y 'htmlLink').
-    token_path: ruta al token del usuario (para operar en SU calendario).
+    Cliente de Calendar construido una sola vez por credenciales.
+    httplib2.Http no es thread-safe, así que cada hilo usa su propio
+    AuthorizedHttp (requestBuilder) sobre las mismas credenciales.
     """
-    service = get_service(token_path)
+
+    def __init__(self, creds):
+        self.creds = creds
+        self._local = threading.local()
+        self.service = build(
+            "calendar", "v3",
+            http=self._http(),
+            requestBuilder=self._build_request,
+            cache_discovery=False
+        )
+
+    def _http(self):
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._local.http = http
+        return http
+
+    def _build_request(self, http, *args, **kwargs):
+        return HttpRequest(self._http(), *args, **kwargs)
+
+
+_services: "OrderedDict[str, _CachedService]" = OrderedDict()
+_services_lock = threading.Lock()
+
+
+def get_service(token_path: Optional[str] = None):
+    """
+    Devuelve un cliente de Calendar autorizado, reutilizado entre llamadas.
+    token_path es la clave del almacén de credenciales (el email del usuario
+    o la ruta de un token antiguo). Las credenciales las renueva en segundo
+    plano credenciales.py; el cliente se reconstruye si el usuario vuelve a
+    iniciar sesión.
+    """
+    token_path = token_path or os.getenv("GOOGLE_TOKEN_PATH", "token.json")
+    creds = obtener_credenciales(token_path)
+
+    with _services_lock:
+        entry = _services.get(token_path)
+        if entry is not None and entry.creds is creds:
+            _services.move_to_end(token_path)
+            return entry.service
+
+    entry = _CachedService(creds)
+    with _services_lock:
+        _services[token_path] = entry
+        _services.move_to_end(token_path)
+        while len(_services) > SERVICE_CACHE_SIZE:
+            _services.popitem(last=False)
+    return entry.service
+
+
+def invalidate_service(token_path: Optional[str] = None):
+    """Descarta el cliente cacheado de un token (o todos si no se indica)."""
+    with _services_lock:
+        if token_path is None:
+            _services.clear()
+        else:
+            _services.pop(token_path, None)
+
+def _event_body(summary: str, date_iso: str, time_hhmm: str,
+                duration_minutes: int = 60, description: str = "",
+                attendees_emails: Optional[List[str]] = None) -> Dict:
+    """Construye el cuerpo de un evento nuevo en la zona horaria configurada."""
     tz = os.getenv("TIMEZONE", "Europe/Madrid")
 
     start_dt = datetime.strptime(f"{date_iso} {time_hhmm}", "%Y-%m-%d %H:%M")
@@ -90,6 +108,19 @@ def create_event(summary: str, date_iso: str, time_hhmm: str,
     }
     if attendees_emails:
         event["attendees"] = [{"email": e} for e in attendees_emails]
+    return event
+
+
+def create_event(summary: str, date_iso: str, time_hhmm: str,
+                 duration_minutes: int = 60, description: str = "",
+                 attendees_emails: Optional[List[str]] = None,
+                 token_path: Optional[str] = None) -> Dict:
+    """
+    Crea un evento y devuelve el dict de evento (incluye 'id' y 'htmlLink').
+    token_path: ruta al token del usuario (para operar en SU calendario).
+    """
+    service = get_service(token_path)
+    event = _event_body(summary, date_iso, time_hhmm, duration_minutes, description, attendees_emails)
 
     cal_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
     created = service.events().insert(calendarId=cal_id, body=event, sendUpdates="all").execute()
@@ -109,25 +140,16 @@ def get_future_events(token_path: Optional[str] = None, max_results: int = 50):
     ).execute()
     return events_result.get("items", [])
 
-def update_event(event_id: str,
-                 new_date_iso: str,
-                 new_time_hhmm: str,
-                 token_path: Optional[str] = None) -> Dict:
+def _move_event(event: Dict, new_date_iso: str, new_time_hhmm: str) -> Dict:
     """
-    Actualiza la fecha y hora de un evento existente en Google Calendar,
+    Cambia start/end de un evento ya descargado a la nueva fecha y hora,
     manteniendo su duración original.
     """
-    service = get_service(token_path)
-    cal_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
-
-    # 1) Obtener evento actual
-    event = service.events().get(calendarId=cal_id, eventId=event_id).execute()
-
-    # 2) Determinar zona horaria
+    # 1) Determinar zona horaria
     tz = event.get("start", {}).get("timeZone") or os.getenv("TIMEZONE", "Europe/Madrid")
     tz_obj = pytz.timezone(tz)
 
-    # 3) Calcular la duración del evento
+    # 2) Calcular la duración del evento
     start_info = event["start"]
     end_info = event["end"]
 
@@ -143,12 +165,12 @@ def update_event(event_id: str,
     else:
         duration = timedelta(minutes=60)
 
-    # 4) Construir nueva fecha/hora de inicio con la zona horaria correcta
+    # 3) Construir nueva fecha/hora de inicio con la zona horaria correcta
     new_start_naive = datetime.strptime(f"{new_date_iso} {new_time_hhmm}", "%Y-%m-%d %H:%M")
     new_start = tz_obj.localize(new_start_naive)
     new_end = new_start + duration
 
-    # 5) Actualizar campos start/end igual que en create_event
+    # 4) Actualizar campos start/end igual que en create_event
     event["start"] = {
         "dateTime": new_start.isoformat(),
         "timeZone": tz,
@@ -157,8 +179,26 @@ def update_event(event_id: str,
         "dateTime": new_end.isoformat(),
         "timeZone": tz,
     }
+    return event
 
-    # 6) Enviar actualización
+def update_event(event_id: str,
+                 new_date_iso: str,
+                 new_time_hhmm: str,
+                 token_path: Optional[str] = None) -> Dict:
+    """
+    Actualiza la fecha y hora de un evento existente en Google Calendar,
+    manteniendo su duración original.
+    """
+    service = get_service(token_path)
+    cal_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
+
+    # 1) Obtener evento actual
+    event = service.events().get(calendarId=cal_id, eventId=event_id).execute()
+
+    # 2) Mover start/end conservando la duración
+    event = _move_event(event, new_date_iso, new_time_hhmm)
+
+    # 3) Enviar actualización
     updated = service.events().update(
         calendarId=cal_id,
         eventId=event_id,
@@ -169,7 +209,104 @@ def update_event(event_id: str,
     return updated
 
 def delete_event(event_id: str, token_path: Optional[str] = None) -> bool:
+    """Borra el evento. Si ya no existía en Google (404/410) cuenta como borrado."""
     service = get_service(token_path)
     cal_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
-    service.events().delete(calendarId=cal_id, eventId=event_id, sendUpdates="all").execute()
+    try:
+        service.events().delete(calendarId=cal_id, eventId=event_id, sendUpdates="all").execute()
+    except HttpError as e:
+        if e.resp.status not in YA_BORRADO:
+            raise
     return True
+
+
+# ============================
+# OPERACIONES EN LOTE
+# ============================
+# Calendar acepta como máximo 50 peticiones por BatchHttpRequest.
+BATCH_LIMIT = 50
+
+
+def _run_batch(service, requests: List) -> List[Dict]:
+    """
+    Ejecuta las peticiones en lotes de BATCH_LIMIT y devuelve un resultado
+    por petición, en el mismo orden: {"ok", "event", "error", "status"}.
+    status es el código HTTP del error (None si no hubo error o no era HTTP).
+    """
+    resultados: List[Optional[Dict]] = [None] * len(requests)
+
+    def _callback(request_id, response, exception):
+        resultados[int(request_id)] = {
+            "ok": exception is None,
+            "event": response if exception is None else None,
+            "error": str(exception) if exception is not None else None,
+            "status": exception.resp.status if isinstance(exception, HttpError) else None,
+        }
+
+    for inicio in range(0, len(requests), BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=_callback)
+        for i in range(inicio, min(inicio + BATCH_LIMIT, len(requests))):
+            batch.add(requests[i], request_id=str(i))
+        batch.execute()
+    return resultados
+
+
+def create_events_batch(items: List[Dict], token_path: Optional[str] = None) -> List[Dict]:
+    """
+    Crea varios eventos en peticiones batch.
+    items: dicts con summary, date_iso, time_hhmm y opcionalmente
+    duration_minutes, description y attendees_emails.
+    """
+    service = get_service(token_path)
+    cal_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
+    requests = [
+        service.events().insert(calendarId=cal_id, body=_event_body(**item), sendUpdates="all")
+        for item in items
+    ]
+    return _run_batch(service, requests)
+
+
+def update_events_batch(items: List[Dict], token_path: Optional[str] = None) -> List[Dict]:
+    """
+    Mueve varios eventos conservando su duración: un batch de get y otro de
+    update, en lugar de dos peticiones por evento.
+    items: dicts con event_id, new_date_iso y new_time_hhmm.
+    """
+    service = get_service(token_path)
+    cal_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
+
+    actuales = _run_batch(service, [
+        service.events().get(calendarId=cal_id, eventId=item["event_id"]) for item in items
+    ])
+
+    resultados = list(actuales)
+    pendientes, requests = [], []
+    for i, (item, actual) in enumerate(zip(items, actuales)):
+        if not actual["ok"]:
+            continue
+        body = _move_event(actual["event"], item["new_date_iso"], item["new_time_hhmm"])
+        pendientes.append(i)
+        requests.append(service.events().update(
+            calendarId=cal_id, eventId=item["event_id"], body=body, sendUpdates="all"
+        ))
+
+    for i, res in zip(pendientes, _run_batch(service, requests)):
+        resultados[i] = res
+    return resultados
+
+
+def delete_events_batch(event_ids: List[str], token_path: Optional[str] = None) -> List[Dict]:
+    """
+    Borra varios eventos en peticiones batch. Como en delete_event, un evento
+    que ya no existía en Google (404/410) cuenta como borrado.
+    """
+    service = get_service(token_path)
+    cal_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
+    resultados = _run_batch(service, [
+        service.events().delete(calendarId=cal_id, eventId=event_id, sendUpdates="all")
+        for event_id in event_ids
+    ])
+    for r in resultados:
+        if r["status"] in YA_BORRADO:
+            r["ok"] = True
+    return resultados
@@ -0,0 +1,352 @@
+# backend/importacion.py
+"""
+Importación y exportación masiva de citas en CSV e iCalendar (.ics).
+
+Todo funciona en streaming: los lectores son generadores que leen el
+fichero línea a línea, las filas se insertan en lotes de IMPORT_LOTE con
+un executemany por transacción, y la exportación recorre citas por páginas
+de id_cita. La memoria no depende del tamaño del fichero.
+
+Con --google, cada lote se crea también en Google Calendar mediante
+peticiones batch (requiere que el usuario haya conectado su cuenta).
+
+Uso:
+    python -m backend.importacion importar agenda.csv --usuario ana@clinica.es
+    python -m backend.importacion importar agenda.ics --usuario ana@clinica.es --google
+    python -m backend.importacion exportar copia.csv [--usuario ana@clinica.es]
+    python -m backend.importacion exportar copia.ics --usuario ana@clinica.es
+"""
+import argparse
+import csv
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+
+import pytz
+
+from . import db
+from .services import add_appointment_rows, set_event_ids_bulk
+
+# Filas por transacción al importar
+IMPORT_LOTE = int(os.getenv("IMPORT_LOTE", "10000"))
+# Citas por página al exportar
+EXPORT_LOTE = 5000
+# Duración de los eventos exportados a .ics (la misma que create_event)
+DURACION_CITA = int(os.getenv("DURACION_CITA", "60"))
+# Mensajes de error que se guardan al importar (del resto solo se cuentan)
+MAX_ERRORES = 20
+
+COLUMNAS = ("usuario_id", "fecha", "hora", "tipo", "descripcion", "recordatorio", "id_evento_google")
+
+RE_FECHA_ISO = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+RE_FECHA_ES = re.compile(r"^(\d{1,2})[/-](\d{1,2})[/-](\d{4})$")
+RE_HORA = re.compile(r"^(\d{1,2})[:.](\d{2})(?::\d{2})?$")
+RE_ICS_FECHA = re.compile(r"^(\d{4})(\d{2})(\d{2})(?:T(\d{2})(\d{2})\d{2}(Z)?)?$")
+
+
+def _zona():
+    return pytz.timezone(os.getenv("TIMEZONE", "Europe/Madrid"))
+
+
+def _fecha(valor: str) -> str:
+    valor = (valor or "").strip()
+    if RE_FECHA_ISO.match(valor):
+        return valor
+    m = RE_FECHA_ES.match(valor)
+    if m:
+        return f"{m.group(3)}-{int(m.group(2)):02d}-{int(m.group(1)):02d}"
+    raise ValueError(f"fecha no válida: {valor!r}")
+
+
+def _hora(valor: str) -> str:
+    m = RE_HORA.match((valor or "").strip())
+    if not m or int(m.group(1)) > 23 or int(m.group(2)) > 59:
+        raise ValueError(f"hora no válida: {valor!r}")
+    return f"{int(m.group(1)):02d}:{m.group(2)}"
+
+
+# ============================
+# LECTORES
+# ============================
+
+def leer_csv(fuente: TextIO) -> Iterator[Dict]:
+    """Genera un dict por fila; la cabecera usa los nombres de COLUMNAS."""
+    yield from csv.DictReader(fuente)
+
+
+def _lineas_ics(fuente: TextIO) -> Iterator[str]:
+    """Líneas lógicas del .ics: las que empiezan por espacio continúan la anterior."""
+    actual = None
+    for linea in fuente:
+        linea = linea.rstrip("\r\n")
+        if linea[:1] in (" ", "\t") and actual is not None:
+            actual += linea[1:]
+            continue
+        if actual is not None:
+            yield actual
+        actual = linea
+    if actual:
+        yield actual
+
+
+def _texto_ics(valor: str) -> str:
+    return (valor.replace("\\n", "\n").replace("\\N", "\n")
+            .replace("\\,", ",").replace("\\;", ";").replace("\\\\", "\\"))
+
+
+def _inicio_ics(parametros: str, valor: str):
+    """(fecha, hora) locales de un DTSTART; hora None si es de día completo."""
+    m = RE_ICS_FECHA.match(valor.strip())
+    if not m:
+        raise ValueError(f"DTSTART no válido: {valor!r}")
+    anio, mes, dia, h, mi, utc = m.groups()
+    if h is None:
+        return f"{anio}-{mes}-{dia}", None
+    dt = datetime(int(anio), int(mes), int(dia), int(h), int(mi))
+    tzid = re.search(r"TZID=([^;:]+)", parametros)
+    try:
+        origen = pytz.utc if utc else (pytz.timezone(tzid.group(1).strip('"')) if tzid else None)
+    except pytz.UnknownTimeZoneError:
+        # p. ej. nombres de Windows ("Romance Standard Time"): se salta el evento
+        raise ValueError(f"zona horaria desconocida: {tzid.group(1)!r}")
+    if origen is not None:
+        dt = origen.localize(dt).astimezone(_zona())
+    return dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M")
+
+
+def leer_ics(fuente: TextIO) -> Iterator[Dict]:
+    """Genera un dict (con las claves de COLUMNAS) por cada VEVENT."""
+    evento = None
+    for linea in _lineas_ics(fuente):
+        nombre, _, valor = linea.partition(":")
+        propiedad, _, parametros = nombre.partition(";")
+        propiedad = propiedad.upper()
+        if propiedad == "BEGIN" and valor.upper() == "VEVENT":
+            evento = {}
+        elif propiedad == "END" and valor.upper() == "VEVENT" and evento is not None:
+            yield evento
+            evento = None
+        elif evento is None:
+            continue
+        elif propiedad == "SUMMARY":
+            evento["tipo"] = _texto_ics(valor)
+        elif propiedad == "DESCRIPTION":
+            evento["descripcion"] = _texto_ics(valor)
+        elif propiedad == "DTSTART":
+            try:
+                evento["fecha"], evento["hora"] = _inicio_ics(parametros, valor)
+            except ValueError as e:
+                evento["error"] = str(e)
+
+
+# ============================
+# IMPORTACIÓN
+# ============================
+
+def _filas(registros: Iterable[Dict], usuario_id: Optional[str], errores: Dict) -> Iterator[tuple]:
+    """
+    Valida y normaliza los registros; los inválidos se saltan. En `errores`
+    se cuentan todos ("num") pero solo se guardan los MAX_ERRORES primeros
+    mensajes ("primeros"), así la memoria no crece con el fichero.
+    """
+    for n, r in enumerate(registros, 1):
+        try:
+            if r.get("error"):
+                raise ValueError(r["error"])
+            usuario = usuario_id or (r.get("usuario_id") or "").strip()
+            if not usuario:
+                raise ValueError("falta usuario_id")
+            # En .ics, hora None es un evento de día completo
+            hora = r.get("hora")
+            yield (
+                usuario,
+                _fecha(r.get("fecha")),
+                _hora(hora) if hora else None,
+                (r.get("tipo") or "").strip() or "Cita",
+                r.get("descripcion") or None,
+                r.get("recordatorio") or None,
+                r.get("id_evento_google") or None,
+            )
+        except ValueError as e:
+            errores["num"] += 1
+            if len(errores["primeros"]) < MAX_ERRORES:
+                errores["primeros"].append(f"registro {n}: {e}")
+
+
+def _subir_a_google(filas: List[tuple]) -> int:
+    """Inserta el lote guardando los ids y lo crea en Google Calendar por usuario."""
+    # Imports diferidos: la importación local no necesita las librerías de Google
+    from .google_calendar import create_events_batch
+    from .calendar_sync import mirror_events
+    from .credenciales import tiene_credenciales
+
+    # Mismas filas que la ruta local (incluido recordatorio), con sus ids
+    ids = add_appointment_rows(filas, return_ids=True)
+    subidas = 0
+    por_usuario: Dict[str, List] = {}
+    for id_cita, fila in zip(ids, filas):
+        # Solo las citas con hora y que no vienen ya de Google
+        if fila[2] and not fila[6]:
+            por_usuario.setdefault(fila[0], []).append((id_cita, fila))
+    for usuario, citas in por_usuario.items():
+        if not tiene_credenciales(usuario):
+            print(f"⚠️ {usuario} no ha conectado Google Calendar: sus citas solo se guardan en local")
+            continue
+        try:
+            resultados = create_events_batch([
+                {"summary": t, "date_iso": f, "time_hhmm": h, "description": d or ""}
+                for _, (_, f, h, t, d, _, _) in citas
+            ], token_path=usuario)
+        except Exception as e:
+            print(f"⚠️ No se pudieron crear en Google las citas de {usuario}: {e}")
+            continue
+        ok = [(id_cita, r["event"]) for (id_cita, _), r in zip(citas, resultados) if r["ok"]]
+        set_event_ids_bulk([(id_cita, ev["id"]) for id_cita, ev in ok])
+        mirror_events(usuario, [ev for _, ev in ok])
+        subidas += len(ok)
+    return subidas
+
+
+def importar(registros: Iterable[Dict], usuario_id: Optional[str] = None,
+             lote: int = IMPORT_LOTE, google: bool = False) -> Dict:
+    """
+    Importa registros (dicts de leer_csv o leer_ics) en lotes de `lote`
+    filas, cada uno en su transacción. Devuelve
+    {"importadas", "en_google", "errores": [primeros errores], "num_errores"}.
+    """
+    errores = {"num": 0, "primeros": []}
+    filas = _filas(registros, usuario_id, errores)
+    importadas = en_google = 0
+    while True:
+        bloque = list(islice(filas, lote))
+        if not bloque:
+            break
+        if google:
+            en_google += _subir_a_google(bloque)
+            importadas += len(bloque)
+        else:
+            importadas += add_appointment_rows(bloque)
+    return {"importadas": importadas, "en_google": en_google,
+            "errores": errores["primeros"], "num_errores": errores["num"]}
+
+
+def importar_fichero(ruta: str, usuario_id: Optional[str] = None, google: bool = False) -> Dict:
+    lector = leer_ics if ruta.lower().endswith(".ics") else leer_csv
+    with open(ruta, encoding="utf-8-sig", newline="") as f:
+        return importar(lector(f), usuario_id, google=google)
+
+
+# ============================
+# EXPORTACIÓN
+# ============================
+
+def iter_citas(usuario_id: Optional[str] = None, lote: int = EXPORT_LOTE) -> Iterator[Dict]:
+    """Recorre las citas por páginas de id_cita (sin cargarlas todas)."""
+    ultimo = 0
+    while True:
+        pagina = db.query_all(f"""
+            SELECT id_cita, {", ".join(COLUMNAS)} FROM citas
+            WHERE id_cita > ? {"AND usuario_id = ?" if usuario_id else ""}
+            ORDER BY id_cita LIMIT ?
+        """, (ultimo, usuario_id, lote) if usuario_id else (ultimo, lote))
+        if not pagina:
+            return
+        yield from pagina
+        ultimo = pagina[-1]["id_cita"]
+
+
+def escribir_csv(citas: Iterable[Dict], destino: TextIO) -> int:
+    escritor = csv.DictWriter(destino, fieldnames=COLUMNAS, extrasaction="ignore")
+    escritor.writeheader()
+    n = 0
+    for n, cita in enumerate(citas, 1):
+        escritor.writerow(cita)
+    return n
+
+
+def _escapar_ics(valor: str) -> str:
+    return (valor.replace("\\", "\\\\").replace(";", "\\;")
+            .replace(",", "\\,").replace("\n", "\\n"))
+
+
+def _plegar_ics(linea: str) -> str:
+    """Parte las líneas de más de 75 caracteres (RFC 5545)."""
+    if len(linea) <= 75:
+        return linea + "\r\n"
+    trozos = [linea[:75]] + [" " + linea[i:i + 74] for i in range(75, len(linea), 74)]
+    return "\r\n".join(trozos) + "\r\n"
+
+
+def escribir_ics(citas: Iterable[Dict], destino: TextIO) -> int:
+    """
+    Las citas con hora se exportan en UTC (sufijo Z): un DTSTART con TZID
+    exigiría incluir su VTIMEZONE. X-WR-TIMEZONE solo indica la zona en la
+    que mostrarlas.
+    """
+    zona = _zona()
+    sello = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    destino.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//BotCitas//Exportacion//ES\r\n"
+                  f"X-WR-TIMEZONE:{zona.zone}\r\n")
+    n = 0
+    for cita in citas:
+        try:
+            fecha = datetime.strptime(cita["fecha"], "%Y-%m-%d")
+        except (TypeError, ValueError):
+            continue
+        lineas = ["BEGIN:VEVENT", f"UID:cita-{cita['id_cita']}@botcitas", f"DTSTAMP:{sello}"]
+        try:
+            inicio = zona.localize(datetime.strptime(f"{cita['fecha']} {cita['hora'][:5]}", "%Y-%m-%d %H:%M"))
+            inicio = inicio.astimezone(pytz.utc)
+            fin = inicio + timedelta(minutes=DURACION_CITA)
+            lineas += [f"DTSTART:{inicio:%Y%m%dT%H%M%SZ}", f"DTEND:{fin:%Y%m%dT%H%M%SZ}"]
+        except (TypeError, ValueError):
+            # Sin hora: evento de día completo
+            lineas += [f"DTSTART;VALUE=DATE:{fecha:%Y%m%d}",
+                       f"DTEND;VALUE=DATE:{fecha + timedelta(days=1):%Y%m%d}"]
+        lineas.append("SUMMARY:" + _escapar_ics(cita["tipo"] or "Cita"))
+        if cita.get("descripcion"):
+            lineas.append("DESCRIPTION:" + _escapar_ics(cita["descripcion"]))
+        lineas.append("END:VEVENT")
+        destino.write("".join(_plegar_ics(l) for l in lineas))
+        n += 1
+    destino.write("END:VCALENDAR\r\n")
+    return n
+
+
+def exportar_fichero(ruta: str, usuario_id: Optional[str] = None) -> int:
+    escritor = escribir_ics if ruta.lower().endswith(".ics") else escribir_csv
+    with open(ruta, "w", encoding="utf-8", newline="") as f:
+        return escritor(iter_citas(usuario_id), f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importa o exporta citas en CSV o iCalendar.")
+    sub = parser.add_subparsers(dest="accion", required=True)
+    imp = sub.add_parser("importar", help="carga un .csv o .ics en la tabla citas")
+    imp.add_argument("ruta")
+    imp.add_argument("--usuario", help="usuario de todas las citas (obligatorio en .ics)")
+    imp.add_argument("--google", action="store_true", help="crear también los eventos en Google Calendar")
+    exp = sub.add_parser("exportar", help="vuelca las citas a un .csv o .ics")
+    exp.add_argument("ruta")
+    exp.add_argument("--usuario", help="solo las citas de este usuario")
+    args = parser.parse_args()
+
+    db.init_db()
+    inicio = time.perf_counter()
+    if args.accion == "importar":
+        resumen = importar_fichero(args.ruta, args.usuario, args.google)
+        for error in resumen["errores"]:
+            print(f"⚠️ {error}")
+        print(f"✅ {resumen['importadas']} citas importadas ({resumen['num_errores']} descartadas"
+              f"{', ' + str(resumen['en_google']) + ' en Google Calendar' if args.google else ''}) "
+              f"en {time.perf_counter() - inicio:.1f}s")
+    else:
+        n = exportar_fichero(args.ruta, args.usuario)
+        print(f"✅ {n} citas exportadas a {args.ruta} en {time.perf_counter() - inicio:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
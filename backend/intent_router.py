@@ -0,0 +1,223 @@
+# backend/intent_router.py
+"""
+Enrutador rápido de intenciones por reglas, previo al Crew.
+
+Si el último mensaje del usuario es inequívoco (consultar la agenda, borrar
+una cita que existe, o agendar con servicio, fecha y hora completos, en el
+futuro y dentro del horario de atención) se llama directamente a la
+herramienta. Los mensajes con varias peticiones ("... y otra para el lunes",
+"qué citas tengo y cancela la del fisio") y las horas ambiguas ("a las 5")
+nunca se resuelven aquí. En cualquier otro caso devuelve None y el turno sigue por
+el flujo multi-agente.
+"""
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List
+
+import dateparser
+
+from backend.disponibilidad import en_horario
+from backend.services import list_user_tipos
+from backend.tools_openai import consultar_calendario_tool, agendar_cita_tool, eliminar_cita_tool
+
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "1").lower() not in ("0", "false", "no")
+
+DIAS_SEMANA = ["lunes", "martes", "miercoles", "jueves", "viernes", "sabado", "domingo"]
+MESES = "enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|setiembre|octubre|noviembre|diciembre"
+
+RE_CONSULTAR = re.compile(
+    r"\b(que|cuales) (citas|eventos) tengo\b"
+    r"|\b(ver|ensename|muestrame|dime|lista(me)?) (mis|las) (citas|eventos)\b"
+    r"|\b(ver|consultar|revisar) (mi )?(agenda|calendario)\b"
+    r"|^mis citas$"
+)
+RE_ELIMINAR = re.compile(
+    r"^(por favor,? )?(borra|borrame|elimina|eliminame|cancela|cancelame|anula|anulame|quita|quitame)"
+    r" (la |mi )?cita (de|del|con|para) (?P<tipo>.+)$"
+)
+RE_AGENDAR = re.compile(
+    r"^(por favor,? )?(agenda|agendame|reserva|reservame|pide|pideme|quiero|necesito)"
+    r" (una )?cita (de|del|con|para) (?P<resto>.+)$"
+)
+RE_HORA = re.compile(
+    r"\ba las (?P<h>\d{1,2})(?:[:.](?P<m>\d{2}))?(?: ?h| horas)?"
+    r"(?P<tarde> de la (tarde|noche))?\b"
+)
+RE_FECHA = re.compile(
+    r"\b(pasado manana|manana|hoy"
+    r"|(el )?(proximo |este )?(" + "|".join(DIAS_SEMANA) + r")( que viene)?"
+    r"|(el )?\d{1,2} de (" + MESES + r")( de \d{4})?"
+    r"|(el )?\d{1,2}[/-]\d{1,2}([/-]\d{2,4})?"
+    r"|\d{4}-\d{2}-\d{2})\b"
+)
+# Conectores que quedan entre el servicio y la fecha ("dentista para el ...")
+RE_COLA_TIPO = re.compile(r"\s+(para|el|la|de|del|y)$", re.IGNORECASE)
+RE_ARTICULO = re.compile(r"^(el|la|los|las|un|una) ")
+# Expresiones que obligan a pasar por los agentes (dudas o varias citas)
+RE_AMBIGUO = re.compile(r"\b(todas|varias|citas|pdf|documento|normativa|ayuno)\b")
+# Conjunciones y palabras que indican una segunda petición en el mensaje
+RE_VARIAS = re.compile(r"\b(y|e|otra|otras|otro|otros|tambien|ademas|luego|despues)\b")
+
+
+@dataclass
+class Intencion:
+    tipo: str
+    datos: Dict[str, str] = field(default_factory=dict)
+
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def limpiar(texto: str) -> str:
+    """Colapsa espacios y quita signos de puntuación en los extremos."""
+    return re.sub(r"\s+", " ", texto).strip(" ¿?¡!.,;")
+
+
+def _plegar(texto: str) -> str:
+    """Minúsculas y sin acentos, carácter a carácter (conserva las posiciones)."""
+    return "".join(unicodedata.normalize("NFKD", c)[0] for c in texto.lower())
+
+
+def normalizar(texto: str) -> str:
+    return _plegar(limpiar(texto))
+
+
+def ultimo_mensaje_usuario(historial: str) -> str:
+    """Extrae el último '- user: ...' del historial que construye app.py."""
+    mensajes = re.findall(r"^- user: (.*)$", historial, re.MULTILINE)
+    return mensajes[-1] if mensajes else historial
+
+
+def _parse_fecha(expr: str, ahora: datetime) -> Optional[str]:
+    expr = expr.replace("el ", "", 1) if expr.startswith("el ") else expr
+    for i, dia in enumerate(DIAS_SEMANA):
+        if dia in expr:
+            delta = (i - ahora.weekday()) % 7 or 7
+            return (ahora + timedelta(days=delta)).strftime("%Y-%m-%d")
+    fecha = dateparser.parse(expr, languages=["es"], settings={
+        "PREFER_DATES_FROM": "future",
+        "DATE_ORDER": "DMY",
+        "RELATIVE_BASE": ahora,
+    })
+    return fecha.strftime("%Y-%m-%d") if fecha else None
+
+
+def _parse_hora(m: re.Match) -> Optional[str]:
+    h, mins = int(m.group("h")), int(m.group("m") or 0)
+    if m.group("tarde") and h < 12:
+        h += 12
+    if h > 23 or mins > 59:
+        return None
+    return f"{h:02d}:{mins:02d}"
+
+
+def _hora_inequivoca(m: re.Match, hora: str) -> bool:
+    """
+    La hora cae en el horario de atención y no admite otra lectura dentro de
+    él: "a las 5" (05:00) no se agenda de madrugada, y con un horario 08-22
+    "a las 9" puede ser 09:00 o 21:00.
+    """
+    if not en_horario(hora):
+        return False
+    h = int(hora[:2])
+    return bool(m.group("tarde")) or h >= 12 or not en_horario(f"{h + 12:02d}{hora[2:]}")
+
+
+def _tipo_existente(candidato: str, email_usuario: str) -> Optional[str]:
+    """Devuelve el tipo tal y como está guardado si hay exactamente uno que coincide."""
+    objetivo = normalizar(candidato)
+    coincidencias = [t for t in list_user_tipos(email_usuario) if t and normalizar(t) == objetivo]
+    return coincidencias[0] if len(coincidencias) == 1 else None
+
+
+def clasificar(historial: str, email_usuario: str, ahora: Optional[datetime] = None) -> Optional[Intencion]:
+    """Devuelve la intención si es inequívoca, o None si hay que usar el Crew."""
+    original = limpiar(ultimo_mensaje_usuario(historial))
+    texto = _plegar(original)
+    ahora = ahora or datetime.now()
+
+    # Antes que cualquier intención: "qué citas tengo y borra la del
+    # dentista" no puede resolverse solo como consulta
+    if RE_VARIAS.search(texto):
+        return None
+    if RE_CONSULTAR.search(texto):
+        return Intencion("CONSULTAR")
+
+    m = RE_ELIMINAR.match(texto)
+    if m and not RE_AMBIGUO.search(m.group("tipo")):
+        tipo = _tipo_existente(m.group("tipo"), email_usuario)
+        if tipo:
+            return Intencion("ELIMINAR", {"descripcion": tipo})
+        return None
+
+    m = RE_AGENDAR.match(texto)
+    if m and not RE_AMBIGUO.search(m.group("resto")):
+        resto = m.group("resto")
+        fechas = list(RE_FECHA.finditer(resto))
+        horas = list(RE_HORA.finditer(resto))
+        # Sin fecha u hora, o con más de una (varias citas): al Crew
+        if len(fechas) != 1 or len(horas) != 1:
+            return None
+        m_fecha, m_hora = fechas[0], horas[0]
+        fin_tipo = m.start("resto") + min(m_fecha.start(), m_hora.start())
+        tipo = RE_COLA_TIPO.sub("", original[m.start("resto"):fin_tipo].strip())
+        articulo = RE_ARTICULO.match(_plegar(tipo))
+        if articulo:
+            tipo = tipo[articulo.end():]
+        fecha = _parse_fecha(m_fecha.group(0), ahora)
+        hora = _parse_hora(m_hora)
+        # Una hora fuera del horario o ambigua la resuelve el Crew
+        if hora and not _hora_inequivoca(m_hora, hora):
+            return None
+        # Una hora ya pasada ("hoy a las 8" por la tarde) la resuelve el Crew
+        if fecha and hora and datetime.strptime(f"{fecha} {hora}", "%Y-%m-%d %H:%M") <= ahora:
+            return None
+        if tipo and fecha and hora:
+            return Intencion("AGENDAR", {"descripcion": tipo[0].upper() + tipo[1:], "fecha": fecha, "hora": hora})
+
+    return None
+
+
+def ejecutar(intencion: Intencion, email_usuario: str) -> str:
+    """Llama directamente a la herramienta correspondiente a la intención."""
+    if intencion.tipo == "CONSULTAR":
+        return consultar_calendario_tool.run(email_usuario=email_usuario)
+    if intencion.tipo == "ELIMINAR":
+        return eliminar_cita_tool.run(email_usuario=email_usuario, **intencion.datos)
+    if intencion.tipo == "AGENDAR":
+        return agendar_cita_tool.run(email_usuario=email_usuario, **intencion.datos)
+    raise ValueError(f"Intención sin ruta rápida: {intencion.tipo}")
+
+
+def registrar_ruta(ruta: str, intencion: Optional[str] = None):
+    with _stats_lock:
+        _stats["total"] += 1
+        _stats[ruta] += 1
+        if intencion:
+            _stats[f"{ruta}:{intencion}"] += 1
+
+
+def router_stats() -> Dict[str, float]:
+    """Contadores de turnos por ruta y tasa de acierto de la ruta rápida."""
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats.get("total", 0)
+    stats["hit_rate"] = round(stats.get("rapida", 0) / total, 3) if total else 0.0
+    return stats
+
+
+def enrutar(historial: str, email_usuario: str) -> Optional[Intencion]:
+    """Clasifica el turno si el enrutador está activo; None = usar el Crew."""
+    if not ROUTER_ENABLED:
+        return None
+    try:
+        return clasificar(historial, email_usuario)
+    except Exception as e:
+        print(f"⚠️ Error en el enrutador rápido: {e}")
+        return None
@@ -0,0 +1,155 @@
+# backend/jobs.py
+"""
+Cola de trabajos para ejecutar los turnos de los agentes fuera del script
+de Streamlit.
+
+Los trabajos se guardan en la tabla jobs de botcitas.db y los ejecuta un
+pool de hilos con un máximo de turnos simultáneos. Reenviar el mismo
+mensaje mientras su trabajo está pendiente o en curso devuelve ese trabajo,
+y el resultado queda persistido para que un rerun lo recoja sin volver a
+llamar al LLM. Un mensaje ya terminado se ejecuta de nuevo si se reenvía.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from backend.db import cursor, execute_query, query_one, query_all, close_connection
+
+# Número máximo de turnos de agentes ejecutándose a la vez
+JOBS_MAX_CONCURRENTES = int(os.getenv("JOBS_MAX_CONCURRENTES", "4"))
+# Cada cuánto se vuelca el progreso parcial de un turno a la base de datos
+INTERVALO_PROGRESO = 0.3
+
+ESTADOS_ACTIVOS = ("pendiente", "ejecutando")
+
+_executor = ThreadPoolExecutor(max_workers=JOBS_MAX_CONCURRENTES, thread_name_prefix="turno")
+_recuperados = False
+_recuperados_lock = threading.Lock()
+
+
+def _clave(mensaje: str, email_usuario: str, opciones: Dict) -> str:
+    datos = json.dumps([email_usuario, mensaje, opciones], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(datos.encode("utf-8")).hexdigest()
+
+
+def _actualizar(id_job: int, **campos):
+    asignaciones = ", ".join(f"{c} = ?" for c in campos)
+    execute_query(
+        f"UPDATE jobs SET {asignaciones}, actualizado_en = datetime('now') WHERE id_job = ?",
+        (*campos.values(), id_job)
+    )
+
+
+def _ejecutar(id_job: int):
+    # Import diferido: crew_manager carga CrewAI y las herramientas
+    from backend.crew_manager import ejecutar_turno
+
+    # Se reclama el trabajo de forma atómica: si otro hilo o proceso ya lo
+    # ha empezado, no se ejecuta dos veces
+    with cursor() as cur:
+        cur.execute("""
+            UPDATE jobs SET estado = 'ejecutando', etapa = ?, actualizado_en = datetime('now')
+            WHERE id_job = ? AND estado = 'pendiente'
+        """, ("🤖 Analizando tu solicitud...", id_job))
+        if cur.rowcount == 0:
+            return
+    job = get_job(id_job)
+    progreso = {"etapa": None, "parcial": [], "volcado": 0.0}
+
+    def _emitir(evento: Dict):
+        if evento["tipo"] == "token":
+            progreso["parcial"].append(evento["texto"])
+        elif evento["tipo"] == "intencion":
+            progreso["etapa"] = "🧭 Intención detectada"
+        elif evento["tipo"] == "herramienta_inicio":
+            progreso["etapa"] = f"🔧 Ejecutando {evento['nombre']}..."
+        elif evento["tipo"] == "herramienta_fin":
+            progreso["etapa"] = f"✓ {evento['nombre']}"
+        if time.monotonic() - progreso["volcado"] >= INTERVALO_PROGRESO:
+            _actualizar(id_job, etapa=progreso["etapa"], parcial="".join(progreso["parcial"]))
+            progreso["volcado"] = time.monotonic()
+
+    # El volcado de progreso va limitado por INTERVALO_PROGRESO: el estado
+    # final siempre lleva el texto parcial completo en la misma escritura
+    try:
+        turno = ejecutar_turno(job["mensaje"], job["usuario_id"], emitir=_emitir, **json.loads(job["opciones"]))
+        _actualizar(id_job, estado="terminado", etapa=None, parcial="".join(progreso["parcial"]),
+                    resultado=turno["respuesta"], ruta=turno["ruta"])
+    except Exception as e:
+        _actualizar(id_job, estado="error", etapa=None, parcial="".join(progreso["parcial"]),
+                    resultado=f"❌ Lo siento, mis agentes tuvieron un error: {str(e)}")
+    finally:
+        close_connection()
+
+
+def submit_turno(mensaje: str, email_usuario: str, **opciones) -> int:
+    """
+    Encola un turno y devuelve el id del trabajo. Si ya hay un trabajo
+    pendiente o en curso para el mismo mensaje, devuelve ese.
+    opciones: provider, model, temperature, modo (se pasan a ejecutar_turno).
+    """
+    clave = _clave(mensaje, email_usuario, opciones)
+    existente = query_one(
+        "SELECT id_job FROM jobs WHERE clave = ? AND estado IN ('pendiente', 'ejecutando')",
+        (clave,)
+    )
+    if existente:
+        return existente["id_job"]
+
+    try:
+        id_job = execute_query("""
+            INSERT INTO jobs (clave, usuario_id, mensaje, opciones, estado, creado_en, actualizado_en)
+            VALUES (?, ?, ?, ?, 'pendiente', datetime('now'), datetime('now'))
+        """, (clave, email_usuario, mensaje, json.dumps(opciones)))
+    except sqlite3.IntegrityError:
+        # Otra sesión encoló el mismo mensaje a la vez
+        return query_one(
+            "SELECT id_job FROM jobs WHERE clave = ? AND estado IN ('pendiente', 'ejecutando')",
+            (clave,)
+        )["id_job"]
+
+    _executor.submit(_ejecutar, id_job)
+    return id_job
+
+
+def get_job(id_job: int) -> Optional[Dict]:
+    return query_one("SELECT * FROM jobs WHERE id_job = ?", (id_job,))
+
+
+def esperar_job(id_job: int, timeout: Optional[float] = None, intervalo: float = 0.25) -> Optional[Dict]:
+    """Espera (sondeando) a que el trabajo termine y lo devuelve."""
+    limite = time.monotonic() + timeout if timeout else None
+    while True:
+        job = get_job(id_job)
+        if not job or job["estado"] not in ESTADOS_ACTIVOS:
+            return job
+        if limite and time.monotonic() > limite:
+            return job
+        time.sleep(intervalo)
+
+
+def recuperar_jobs():
+    """
+    Al arrancar (una vez por proceso): relanza los trabajos que no llegaron a
+    empezar y marca como interrumpidos los que estaban en curso. Estos no se
+    repiten porque sus herramientas pueden haber creado ya citas o eventos;
+    si el trabajo sigue vivo en otro proceso, su resultado final sustituye
+    a la marca.
+    """
+    global _recuperados
+    with _recuperados_lock:
+        if _recuperados:
+            return
+        _recuperados = True
+    execute_query("""
+        UPDATE jobs SET estado = 'error', etapa = NULL, actualizado_en = datetime('now'),
+            resultado = '⚠️ El turno se interrumpió al reiniciarse la aplicación. Revisa tu agenda antes de repetirlo.'
+        WHERE estado = 'ejecutando'
+    """)
+    for job in query_all("SELECT id_job FROM jobs WHERE estado = 'pendiente' ORDER BY id_job"):
+        _executor.submit(_ejecutar, job["id_job"])
@@ -0,0 +1,117 @@
+# backend/proveedores.py
+"""
+Registro de proveedores de LLM (Groq y Ollama) que usan la interfaz y los
+agentes.
+
+- Endpoints OpenAI-compatibles de cada proveedor.
+- Modelos locales descubiertos con la API HTTP de Ollama (/api/tags) y
+  cacheados OLLAMA_MODELOS_TTL segundos, sin lanzar `ollama list` en cada rerun.
+- Precarga del modelo local elegido con keep_alive, para que el primer turno
+  no pague la carga del modelo en memoria.
+- Las API keys que introduce el usuario se guardan solo en memoria; a los
+  trabajos (que se persisten en botcitas.db) se les pasa una referencia.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+from .cache import TTLCache
+
+GROQ_BASE_URL = "https://api.groq.com/openai/v1"
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+# Cuánto mantiene Ollama el modelo cargado tras la última petición
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_MODELOS_TTL = float(os.getenv("OLLAMA_MODELOS_TTL", "60"))
+# Cada cuánto se renueva la precarga de un modelo (por debajo del keep_alive)
+OLLAMA_REPRECARGA = float(os.getenv("OLLAMA_REPRECARGA", "600"))
+
+# id -> (etiqueta en la interfaz, modelo por defecto)
+PROVEEDORES = {
+    "groq": ("Groq (cloud)", "llama-3.3-70b-versatile"),
+    "ollama": ("Ollama (local)", "llama3.2:1b"),
+}
+
+_modelos = TTLCache(maxsize=4, ttl=OLLAMA_MODELOS_TTL)
+_api_keys: Dict[str, str] = {}
+_precargados: Dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def proveedor_por_etiqueta(etiqueta: str) -> str:
+    for pid, (nombre, _) in PROVEEDORES.items():
+        if nombre == etiqueta:
+            return pid
+    raise ValueError(f"Proveedor desconocido: {etiqueta}")
+
+
+def guardar_api_key(api_key: str) -> str:
+    """Guarda la key en memoria y devuelve la referencia que viaja con el turno."""
+    ref = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    with _lock:
+        _api_keys[ref] = api_key
+    return ref
+
+
+def endpoint(provider: str, api_key_ref: Optional[str] = None) -> Tuple[str, str]:
+    """(base_url, api_key) OpenAI-compatible del proveedor."""
+    if provider == "ollama":
+        return OLLAMA_HOST + "/v1", "ollama"
+    api_key_groq = _api_keys.get(api_key_ref) if api_key_ref else None
+    api_key_groq = api_key_groq or os.getenv("GROQ_API_KEY")
+    if not api_key_groq:
+        raise ValueError("No se ha encontrado GROQ_API_KEY en el archivo .env")
+    return GROQ_BASE_URL, api_key_groq
+
+
+def _ollama(ruta: str, datos: Optional[Dict] = None, timeout: float = 2.0) -> Dict:
+    cuerpo = json.dumps(datos).encode("utf-8") if datos is not None else None
+    peticion = urllib.request.Request(
+        OLLAMA_HOST + ruta, data=cuerpo, headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(peticion, timeout=timeout) as r:
+        return json.loads(r.read() or b"{}")
+
+
+def modelos_ollama(forzar: bool = False) -> List[str]:
+    """
+    Modelos instalados en Ollama. La lista (también si Ollama no responde:
+    lista vacía) se cachea OLLAMA_MODELOS_TTL segundos; forzar=True la renueva.
+    """
+    if not forzar:
+        modelos = _modelos.get(OLLAMA_HOST)
+        if modelos is not None:
+            return modelos
+    try:
+        modelos = sorted(m["name"] for m in _ollama("/api/tags").get("models", []))
+    except Exception as e:
+        print(f"⚠️ No se pudo consultar Ollama en {OLLAMA_HOST}: {e}")
+        modelos = []
+    _modelos.set(OLLAMA_HOST, modelos)
+    return modelos
+
+
+def _precargar(model: str):
+    try:
+        # Una petición sin prompt solo carga el modelo y fija su keep_alive
+        _ollama("/api/generate", {"model": model, "keep_alive": OLLAMA_KEEP_ALIVE}, timeout=300)
+    except Exception as e:
+        print(f"⚠️ No se pudo precargar {model} en Ollama: {e}")
+        with _lock:
+            _precargados.pop(model, None)
+
+
+def mantener_caliente(model: str):
+    """
+    Precarga el modelo en segundo plano si no se ha hecho en los últimos
+    OLLAMA_REPRECARGA segundos. No bloquea: se puede llamar en cada rerun.
+    """
+    ahora = time.monotonic()
+    with _lock:
+        if ahora - _precargados.get(model, float("-inf")) < OLLAMA_REPRECARGA:
+            return
+        _precargados[model] = ahora
+    threading.Thread(target=_precargar, args=(model,), daemon=True, name=f"ollama-{model}").start()
@@ -1,23 +1,59 @@
 # backend/services.py
-import sqlite3
-from typing import Optional, List, Dict, Any
-from .db import get_connection, execute_query, query_all, query_one
+import re
+import hashlib
+import threading
+import time
+import unicodedata
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Optional, List, Dict, Any, Callable
+from .db import cursor, execute_query, query_all, query_one
+from .cache import TTLCache
 from models.appointment import Appointment
 #Lector pdf
 from PyPDF2 import PdfReader
 import os
-from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
 from langchain_community.embeddings import OllamaEmbeddings
 
 DB_VECTOR_PATH = "./chroma_db_data"
+# Modelo de embeddings, independiente del modelo de chat de los agentes.
+# Cambiarlo obliga a re-ingerir los PDFs (las dimensiones no coinciden).
+EMBEDDING_MODEL = os.getenv("RAG_EMBEDDING_MODEL", "llama3.2:1b")
+# Chunks por petición de embeddings y peticiones simultáneas a Ollama
+RAG_BATCH_SIZE = int(os.getenv("RAG_BATCH_SIZE", "32"))
+RAG_EMBED_WORKERS = int(os.getenv("RAG_EMBED_WORKERS", "4"))
+# Marca por colección que la ingesta actualiza al añadir chunks; si cambia (en
+# este u otro proceso) la instancia compartida de Chroma se vuelve a abrir.
+VERSION_FILE = os.path.join(DB_VECTOR_PATH, ".version_{coleccion}")
+# Vector store: "chroma" o "npy" (matriz NumPy memory-mapped, ver vector_npy.py).
+# Cambiarlo obliga a re-ingerir los PDFs.
+RAG_BACKEND = os.getenv("RAG_BACKEND", "chroma")
+# Tipo de los vectores en el backend npy: "float16" o "int8"
+RAG_NPY_DTYPE = os.getenv("RAG_NPY_DTYPE", "float16")
+
+# Caché de preguntas al RAG: texto normalizado -> embedding, y
+# (embedding, versión de la colección) -> chunks más parecidos.
+RAG_CACHE_SIZE = int(os.getenv("RAG_CACHE_SIZE", "512"))
+RAG_CACHE_TTL = float(os.getenv("RAG_CACHE_TTL", "86400"))
+# RAG_CACHE_SQLITE=1 guarda también los embeddings en botcitas.db
+RAG_CACHE_SQLITE = os.getenv("RAG_CACHE_SQLITE", "0").lower() in ("1", "true", "si")
+
+# Recuperación: "vector", "bm25" o "hibrido" (ambas listas fusionadas con RRF)
+RAG_MODO = os.getenv("RAG_MODO", "hibrido")
+# Reordenado final: "heuristico", "0" para desactivarlo, o el nombre de un
+# cross-encoder de sentence-transformers (p. ej. "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+RAG_RERANK = os.getenv("RAG_RERANK", "heuristico")
+# Candidatos que aporta cada lista antes de fusionar y reordenar
+RAG_CANDIDATOS = int(os.getenv("RAG_CANDIDATOS", "20"))
+RRF_K = 60
 
 
 def add_appointment(a: Appointment) -> int:
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
+    return execute_query("""
         INSERT INTO citas (usuario_id, fecha, hora, tipo, descripcion, recordatorio, id_evento_google, creado_en)
         VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))
     """, (
@@ -29,50 +65,128 @@ def add_appointment(a: Appointment) -> int:
         None,
         None
     ))
-    conn.commit()
-    new_id = cur.lastrowid
-    conn.close()
-    return new_id
 
 def set_event_id_for_appointment(id_cita: int, event_id: str):
     execute_query("UPDATE citas SET id_evento_google = ? WHERE id_cita = ?", (event_id, id_cita))
 
+
+# ============================
+# OPERACIONES EN LOTE (una sola transacción)
+# ============================
+
+def add_appointments_bulk(citas: List[Appointment]) -> List[int]:
+    """Inserta varias citas en una transacción y devuelve sus ids en orden."""
+    ids = []
+    with cursor() as cur:
+        for a in citas:
+            cur.execute("""
+                INSERT INTO citas (usuario_id, fecha, hora, tipo, descripcion, recordatorio, id_evento_google, creado_en)
+                VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))
+            """, (a.email, a.fecha_iso, a.hora_iso, a.servicio, a.observaciones, None, a.gcal_event_id))
+            ids.append(cur.lastrowid)
+    return ids
+
+
+def add_appointment_rows(filas: List[tuple], return_ids: bool = False):
+    """
+    Inserta filas (usuario_id, fecha, hora, tipo, descripcion, recordatorio,
+    id_evento_google) en una transacción. Es la vía rápida de las
+    importaciones masivas: un único executemany que devuelve cuántas filas
+    insertó. Con return_ids=True inserta fila a fila y devuelve sus ids.
+    """
+    sql = """
+        INSERT INTO citas (usuario_id, fecha, hora, tipo, descripcion, recordatorio, id_evento_google, creado_en)
+        VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))
+    """
+    with cursor() as cur:
+        if not return_ids:
+            cur.executemany(sql, filas)
+            return len(filas)
+        ids = []
+        for fila in filas:
+            cur.execute(sql, fila)
+            ids.append(cur.lastrowid)
+    return ids
+
+
+def set_event_ids_bulk(pares: List[tuple]):
+    """pares: [(id_cita, event_id), ...]"""
+    with cursor() as cur:
+        cur.executemany(
+            "UPDATE citas SET id_evento_google = ? WHERE id_cita = ?",
+            [(event_id, id_cita) for id_cita, event_id in pares]
+        )
+
+
+def update_appointments_bulk(cambios: List[tuple]):
+    """cambios: [(usuario_id, id_cita, nueva_fecha, nueva_hora), ...]"""
+    with cursor() as cur:
+        cur.executemany("""
+            UPDATE citas
+            SET fecha = ?, hora = ?
+            WHERE usuario_id = ? AND id_cita = ?
+        """, [(fecha, hora, usuario_id, id_cita) for usuario_id, id_cita, fecha, hora in cambios])
+
+
+def delete_appointments_bulk(ids: List[int]):
+    with cursor() as cur:
+        cur.executemany("DELETE FROM citas WHERE id_cita = ?", [(i,) for i in ids])
+
+def _parse_fecha_busqueda(q: str) -> Optional[str]:
+    """Convierte 'dd/mm/yyyy', 'dd-mm-yyyy' o 'yyyy-mm-dd' a ISO."""
+    m1 = re.match(r"(\d{1,2})[/-](\d{1,2})[/-](\d{4})", q.strip())
+    m2 = re.match(r"(\d{4})-(\d{2})-(\d{2})", q.strip())
+
+    if m1:
+        d, m, y = m1.groups()
+        return f"{y}-{m.zfill(2)}-{d.zfill(2)}"
+    if m2:
+        y, m, d = m2.groups()
+        return f"{y}-{m}-{d}"
+    return None
+
+
+def _fts_query(q: str) -> Optional[str]:
+    """
+    Traduce el texto libre a una consulta FTS5: cada palabra entre comillas
+    (para neutralizar la sintaxis FTS) y con '*' para buscar por prefijo.
+    """
+    palabras = re.findall(r"\w+", q)
+    if not palabras:
+        return None
+    return " ".join(f'"{p}"*' for p in palabras)
+
+
 def list_appointments(q: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    """
+    Lista citas. Con `q` busca en tipo, descripción y usuario mediante el
+    índice FTS5 (por prefijo, sin acentos, ordenado por BM25). Si `q` es una
+    fecha, primero devuelve las citas de ese día por igualdad indexada.
+    """
+    if not q:
+        return query_all("SELECT * FROM citas ORDER BY fecha DESC, hora DESC LIMIT ?", (limit,))
 
-    sql = "SELECT * FROM citas"
-    params = []
+    resultados = []
+    fecha_iso = _parse_fecha_busqueda(q)
+    if fecha_iso:
+        resultados = query_all(
+            "SELECT * FROM citas WHERE fecha = ? ORDER BY hora DESC LIMIT ?",
+            (fecha_iso, limit)
+        )
+
+    consulta = _fts_query(q)
+    if consulta and len(resultados) < limit:
+        vistos = {r["id_cita"] for r in resultados}
+        coincidencias = query_all("""
+            SELECT c.* FROM citas_fts
+            JOIN citas c ON c.id_cita = citas_fts.rowid
+            WHERE citas_fts MATCH ?
+            ORDER BY bm25(citas_fts)
+            LIMIT ?
+        """, (consulta, limit))
+        resultados += [r for r in coincidencias if r["id_cita"] not in vistos]
 
-    if q:
-        import re
-        fecha_iso = None
-        m1 = re.match(r"(\d{1,2})[/-](\d{1,2})[/-](\d{4})", q.strip())
-        m2 = re.match(r"(\d{4})-(\d{2})-(\d{2})", q.strip())
-
-        if m1:
-            d, m, y = m1.groups()
-            fecha_iso = f"{y}-{m.zfill(2)}-{d.zfill(2)}"
-        elif m2:
-            y, m, d = m2.groups()
-            fecha_iso = f"{y}-{m}-{d}"
-
-        if fecha_iso:
-            sql += " WHERE (tipo LIKE ? OR descripcion LIKE ? OR usuario_id LIKE ? OR fecha = ?)"
-            wildcard = f"%{q}%"
-            params = [wildcard, wildcard, wildcard, fecha_iso]
-        else:
-            sql += " WHERE tipo LIKE ? OR descripcion LIKE ? OR usuario_id LIKE ?"
-            wildcard = f"%{q}%"
-            params = [wildcard, wildcard, wildcard]
-
-    sql += " ORDER BY fecha DESC, hora DESC LIMIT ?"
-    params.append(limit)
-
-    rows = cur.execute(sql, params).fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return resultados[:limit]
 
 def find_appointment_by_id(id_cita: int):
     return query_one("SELECT * FROM citas WHERE id_cita = ?", (id_cita,))
@@ -81,10 +195,6 @@ def find_appointment(usuario_email: str = None, fecha: str = None, tipo: str = N
     """
     Devuelve la primera coincidencia
     """
-    conn = get_connection()
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
     sql = "SELECT * FROM citas WHERE 1=1"
     params = []
     if usuario_email:
@@ -98,16 +208,27 @@ def find_appointment(usuario_email: str = None, fecha: str = None, tipo: str = N
         params.append(tipo)
 
     sql += " LIMIT 1"
-    row = cur.execute(sql, params).fetchone()
-    conn.close()
-    return dict(row) if row else None
+    return query_one(sql, tuple(params))
+
+def find_appointments(usuario_email: str, fecha: str = None, tipo: str = None) -> List[Dict[str, Any]]:
+    """Como find_appointment, pero devuelve todas las coincidencias."""
+    sql = "SELECT * FROM citas WHERE usuario_id = ?"
+    params = [usuario_email]
+    if fecha:
+        sql += " AND fecha = ?"
+        params.append(fecha)
+    if tipo:
+        sql += " AND tipo = ?"
+        params.append(tipo)
+    return query_all(sql + " ORDER BY fecha, hora", tuple(params))
+
+def list_user_tipos(usuario_email: str) -> List[str]:
+    """Tipos de cita distintos de un usuario (recorre solo el índice usuario+tipo)."""
+    rows = query_all("SELECT DISTINCT tipo FROM citas WHERE usuario_id = ?", (usuario_email,))
+    return [r["tipo"] for r in rows]
 
 def delete_appointment(id_: int):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM citas WHERE id_cita=?", (id_,))
-    conn.commit()
-    conn.close()
+    execute_query("DELETE FROM citas WHERE id_cita=?", (id_,))
 
 
 def update_appointment(usuario_id: str, id_cita: int, nueva_fecha: str, nueva_hora: str):
@@ -118,32 +239,597 @@ def update_appointment(usuario_id: str, id_cita: int, nueva_fecha: str, nueva_ho
     """, (nueva_fecha, nueva_hora, usuario_id, id_cita))
 
 
-def procesar_pdf_rag(pdf_bytes: bytes, filename: str) -> bool:
+# ============================
+# RAG: EMBEDDINGS Y VECTOR STORE COMPARTIDOS
+# ============================
+_embeddings = None
+_vectorstores: Dict[str, Any] = {}
+_versiones: Dict[str, float] = {}
+_vector_lock = threading.Lock()
+
+
+def coleccion_usuario(usuario_id: Optional[str]) -> str:
+    """
+    Nombre de la colección de Chroma de un usuario. Cada usuario busca solo
+    en sus propios documentos; los PDFs sin sesión van a "docs_anonimo".
+    """
+    if not usuario_id:
+        return "docs_anonimo"
+    return "docs_" + hashlib.sha1(usuario_id.lower().encode("utf-8")).hexdigest()[:16]
+
+
+def _leer_version(coleccion: str) -> float:
+    try:
+        return os.path.getmtime(VERSION_FILE.format(coleccion=coleccion))
+    except OSError:
+        return 0.0
+
+
+def _marcar_nueva_version(coleccion: str) -> float:
+    os.makedirs(DB_VECTOR_PATH, exist_ok=True)
+    with open(VERSION_FILE.format(coleccion=coleccion), "w", encoding="utf-8") as f:
+        f.write(str(time.time()))
+    return _leer_version(coleccion)
+
+
+def get_embeddings() -> OllamaEmbeddings:
+    global _embeddings
+    with _vector_lock:
+        if _embeddings is None:
+            _embeddings = OllamaEmbeddings(model=EMBEDDING_MODEL)
+        return _embeddings
+
+
+def _abrir_vectorstore(coleccion: str, embeddings: Optional[OllamaEmbeddings]):
+    if RAG_BACKEND == "npy":
+        from .vector_npy import NpyVectorStore
+        return NpyVectorStore(os.path.join(DB_VECTOR_PATH, "npy", coleccion), dtype=RAG_NPY_DTYPE)
+    return Chroma(
+        collection_name=coleccion,
+        persist_directory=DB_VECTOR_PATH,
+        embedding_function=embeddings
+    )
+
+
+def get_vectorstore(usuario_id: Optional[str] = None):
+    """
+    Devuelve el vector store (Chroma o npy, según RAG_BACKEND) de la colección
+    del usuario, compartido por todo el proceso. Se reabre solo si otra
+    ingesta ha cambiado la colección.
+    """
+    coleccion = coleccion_usuario(usuario_id)
+    version = _leer_version(coleccion)
+    # El backend npy recibe siempre vectores ya calculados
+    embeddings = get_embeddings() if RAG_BACKEND != "npy" else None
+    with _vector_lock:
+        if coleccion not in _vectorstores or version != _versiones.get(coleccion):
+            _vectorstores[coleccion] = _abrir_vectorstore(coleccion, embeddings)
+            _versiones[coleccion] = version
+        return _vectorstores[coleccion]
+
+
+def _coleccion_actualizada(coleccion: str):
+    """Tras escribir chunks: nueva versión y resultados cacheados invalidados."""
+    with _vector_lock:
+        # Esta instancia ya ve los chunks nuevos: solo los demás procesos reabren
+        _versiones[coleccion] = _marcar_nueva_version(coleccion)
+    _cache_resultados.clear()
+
+
+def usuario_tiene_documentos(usuario_id: Optional[str]) -> bool:
+    return query_one("SELECT 1 AS x FROM documentos_pdf WHERE usuario_id IS ? LIMIT 1", (usuario_id,)) is not None
+
+
+_cache_embeddings = TTLCache(RAG_CACHE_SIZE, RAG_CACHE_TTL)
+_cache_resultados = TTLCache(RAG_CACHE_SIZE, RAG_CACHE_TTL)
+_sqlite_hits = 0
+
+
+def _normalizar_pregunta(pregunta: str) -> str:
+    texto = unicodedata.normalize("NFKC", pregunta).lower()
+    texto = re.sub(r"[¿?¡!.,;:]+", " ", texto)
+    return re.sub(r"\s+", " ", texto).strip()
+
+
+def _embedding_sqlite(texto: str) -> Optional[List[float]]:
+    global _sqlite_hits
+    row = query_one(
+        "SELECT vector, creado_en FROM cache_embeddings WHERE modelo = ? AND texto = ?",
+        (EMBEDDING_MODEL, texto)
+    )
+    if not row or time.time() - row["creado_en"] > RAG_CACHE_TTL:
+        return None
+    _sqlite_hits += 1
+    return array("f", row["vector"]).tolist()
+
+
+def embed_pregunta(pregunta: str) -> List[float]:
+    """Embedding de la pregunta normalizada, con caché en memoria (y opcionalmente SQLite)."""
+    texto = _normalizar_pregunta(pregunta)
+    clave = (EMBEDDING_MODEL, texto)
+    vector = _cache_embeddings.get(clave)
+    if vector is not None:
+        return vector
+
+    vector = _embedding_sqlite(texto) if RAG_CACHE_SQLITE else None
+    if vector is None:
+        vector = get_embeddings().embed_query(texto)
+        if RAG_CACHE_SQLITE:
+            execute_query(
+                "INSERT OR REPLACE INTO cache_embeddings (modelo, texto, vector, creado_en) VALUES (?, ?, ?, ?)",
+                (EMBEDDING_MODEL, texto, array("f", vector).tobytes(), time.time())
+            )
+    _cache_embeddings.set(clave, vector)
+    return vector
+
+
+# Palabras vacías que no aportan a la búsqueda léxica
+STOPWORDS = {
+    "que", "qué", "cual", "cuál", "como", "cómo", "cuanto", "cuánto", "cuanta", "cuánta",
+    "para", "por", "con", "sin", "del", "las", "los", "una", "uno", "unos", "unas",
+    "hay", "dice", "sobre", "este", "esta", "ese", "esa", "son", "hace", "falta",
+    "antes", "después", "mis", "tengo", "puedo", "debo", "documento", "pdf",
+}
+
+
+def _plegar(texto: str) -> str:
+    texto = unicodedata.normalize("NFD", texto.lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+
+def _terminos(pregunta: str) -> List[str]:
+    return [p for p in re.findall(r"\w+", pregunta.lower()) if p not in STOPWORDS and (len(p) > 2 or p.isdigit())]
+
+
+def _clave_chunk(doc: Document, usuario_id: Optional[str]) -> str:
+    # Los chunks ingeridos antes de guardar chunk_id en los metadatos se
+    # identifican igual: por el hash de su texto dentro del usuario
+    return doc.metadata.get("chunk_id") or _sha256(f"{usuario_id or ''}\0{doc.page_content}")
+
+
+def _buscar_vector(pregunta: str, n: int, usuario_id: Optional[str], id_doc: Optional[int]) -> list:
+    vector = embed_pregunta(pregunta)
+    filtro = {"id_doc": id_doc} if id_doc is not None else None
+    return get_vectorstore(usuario_id).similarity_search_by_vector(vector, k=n, filter=filtro)
+
+
+def _token_usuario(usuario_id: Optional[str]) -> str:
+    """Token de la columna usuario de chunks_fts (el mismo que calcula la migración 12)."""
+    return "u" + (usuario_id or "").encode("utf-8").hex().upper()
+
+
+def _buscar_bm25(pregunta: str, n: int, usuario_id: Optional[str], id_doc: Optional[int]) -> list:
+    """Chunks ordenados por BM25 (índice chunks_fts); basta con que aparezca un término."""
+    terminos = _terminos(pregunta)
+    if not terminos:
+        return []
+    # Prefijo en las palabras largas para cubrir plurales y flexiones
+    consulta = " OR ".join(f'"{t}"*' if len(t) > 4 else f'"{t}"' for t in terminos)
+    # El filtro por usuario va dentro del MATCH: solo se puntúan sus chunks
+    filas = query_all("""
+        SELECT t.texto, t.chunk_id, t.id_doc, t.pagina
+        FROM chunks_fts JOIN chunks_texto t ON t.id = chunks_fts.rowid
+        WHERE chunks_fts MATCH ? AND (? IS NULL OR t.id_doc = ?)
+        ORDER BY bm25(chunks_fts, 1.0, 0.0)
+        LIMIT ?
+    """, (f"usuario:{_token_usuario(usuario_id)} AND ({consulta})", id_doc, id_doc, n))
+    return [
+        Document(page_content=f["texto"],
+                 metadata={"chunk_id": f["chunk_id"], "id_doc": f["id_doc"], "page": f["pagina"]})
+        for f in filas
+    ]
+
+
+def _fusion_rrf(listas: List[list], usuario_id: Optional[str]) -> List[tuple]:
+    """Reciprocal rank fusion: [(puntuación, doc)] de mayor a menor."""
+    puntos, docs = {}, {}
+    for lista in listas:
+        for pos, doc in enumerate(lista):
+            clave = _clave_chunk(doc, usuario_id)
+            puntos[clave] = puntos.get(clave, 0.0) + 1.0 / (RRF_K + pos + 1)
+            docs.setdefault(clave, doc)
+    return sorted(((p, docs[c]) for c, p in puntos.items()), key=lambda x: -x[0])
+
+
+_cross_encoder = None
+
+
+def _get_cross_encoder(nombre: str):
+    global _cross_encoder
+    with _vector_lock:
+        if _cross_encoder is None:
+            from sentence_transformers import CrossEncoder
+            _cross_encoder = CrossEncoder(nombre, device="cpu")
+        return _cross_encoder
+
+
+def _rerank(pregunta: str, candidatos: List[tuple], k: int, rerank: str) -> list:
+    """
+    Elige los k finales. El heurístico premia los chunks que contienen más
+    términos de la pregunta, con peso extra para números y términos exactos
+    (artículos, fármacos) que la búsqueda densa suele perder.
+    """
+    if rerank in ("0", "", "no") or len(candidatos) <= 1:
+        return [d for _, d in candidatos[:k]]
+    if rerank != "heuristico":
+        try:
+            modelo = _get_cross_encoder(rerank)
+            notas = modelo.predict([(pregunta, d.page_content) for _, d in candidatos])
+            orden = sorted(zip(notas, range(len(candidatos))), key=lambda x: -x[0])
+            return [candidatos[i][1] for _, i in orden[:k]]
+        except Exception as e:
+            print(f"⚠️ Reranker {rerank} no disponible, uso el heurístico: {e}")
+
+    terminos = {_plegar(t) for t in _terminos(pregunta)}
+    if not terminos:
+        return [d for _, d in candidatos[:k]]
+    max_rrf = candidatos[0][0]
+
+    def _nota(item):
+        rrf, doc = item
+        palabras = set(re.findall(r"\w+", _plegar(doc.page_content)))
+        cubiertos = terminos & palabras
+        peso = sum(2.0 if any(c.isdigit() for c in t) else 1.0 for t in cubiertos)
+        total = sum(2.0 if any(c.isdigit() for c in t) else 1.0 for t in terminos)
+        return 0.5 * rrf / max_rrf + 0.5 * peso / total
+
+    return [d for _, d in sorted(candidatos, key=_nota, reverse=True)[:k]]
+
+
+def buscar_fragmentos(pregunta: str, k: int = 3, usuario_id: Optional[str] = None,
+                      id_doc: Optional[int] = None, modo: Optional[str] = None,
+                      rerank: Optional[str] = None) -> list:
+    """
+    Recupera los k chunks más relevantes de los PDFs del usuario (con caché
+    de resultados). Con id_doc se limita a un único documento.
+
+    modo (por defecto RAG_MODO): "vector", "bm25" o "hibrido", que fusiona
+    ambas listas con RRF. rerank (por defecto RAG_RERANK) elige los k finales
+    entre los candidatos fusionados.
+    """
+    modo = modo or RAG_MODO
+    rerank = RAG_RERANK if rerank is None else rerank
+    coleccion = coleccion_usuario(usuario_id)
+    if modo == "bm25":
+        huella = _normalizar_pregunta(pregunta)
+    else:
+        huella = hashlib.sha1(array("f", embed_pregunta(pregunta)).tobytes()).hexdigest()
+    # La versión se lee del fichero: cambia también con ingestas de otros procesos
+    clave = (coleccion, huella, k, id_doc, modo, rerank, _leer_version(coleccion))
+
+    docs = _cache_resultados.get(clave)
+    if docs is not None:
+        return docs
+
+    n = max(k, RAG_CANDIDATOS)
+    listas = []
+    if modo in ("vector", "hibrido"):
+        listas.append(_buscar_vector(pregunta, n, usuario_id, id_doc))
+    if modo in ("bm25", "hibrido"):
+        listas.append(_buscar_bm25(pregunta, n, usuario_id, id_doc))
+    docs = _rerank(pregunta, _fusion_rrf(listas, usuario_id), k, rerank)
+    _cache_resultados.set(clave, docs)
+    return docs
+
+
+def rag_cache_stats() -> Dict[str, Dict]:
+    """Aciertos y fallos de las dos cachés del RAG."""
+    return {
+        "embeddings": {**_cache_embeddings.stats(), "sqlite_hits": _sqlite_hits},
+        "resultados": _cache_resultados.stats(),
+    }
+
+
+def _sha256(datos) -> str:
+    if isinstance(datos, str):
+        datos = datos.encode("utf-8")
+    return hashlib.sha256(datos).hexdigest()
+
+
+def _iter_paginas(reader: PdfReader, filename: str):
+    """
+    Genera las páginas del PDF de una en una, extrayendo el texto bajo
+    demanda directamente de los bytes subidos (sin ficheros temporales).
+    """
+    for i, page in enumerate(reader.pages):
+        yield Document(page_content=page.extract_text() or "", metadata={"source": filename, "page": i})
+
+
+def _escribir_lote(vectorstore, chunks: list, vectores: List[List[float]]):
+    """Escribe chunks ya vectorizados (upsert: reintentar una ingesta es idempotente)."""
+    # Chroma hace el upsert sobre su colección; NpyVectorStore lo expone directamente
+    destino = getattr(vectorstore, "_collection", vectorstore)
+    destino.upsert(
+        ids=[c.metadata["chunk_id"] for c in chunks],
+        embeddings=vectores,
+        documents=[c.page_content for c in chunks],
+        metadatas=[{k: v for k, v in c.metadata.items() if v is not None} for c in chunks],
+    )
+
+
+def ingerir_pdf(pdf_bytes: bytes, filename: str, usuario_id: Optional[str] = None,
+                progreso: Optional[Callable[[int, int, int], None]] = None) -> Dict[str, Any]:
+    """
+    Ingesta incremental de un PDF en la memoria vectorial.
+
+    - Si el usuario ya subió exactamente el mismo fichero, no hace nada.
+    - Si es una nueva versión del mismo título, solo re-vectoriza las páginas
+      cuyo contenido cambió y borra los chunks que dejan de usarse.
+    - Los chunks se identifican por el hash de su texto, así que un chunk que
+      ya está en el vector store no se vuelve a añadir.
+
+    Las páginas se leen de una en una; los chunks se vectorizan en lotes de
+    RAG_BATCH_SIZE repartidos en RAG_EMBED_WORKERS hilos y se escriben según
+    van llegando. progreso(paginas_leidas, paginas_totales, chunks_escritos)
+    se llama tras cada página y cada lote.
+
+    Los chunks van a la colección del usuario (coleccion_usuario) con su
+    email e id_doc en los metadatos.
+
+    Devuelve un resumen: id_doc, estado ("sin_cambios", "nuevo", "actualizado"),
+    paginas_cambiadas, chunks_nuevos y chunks_borrados.
+    """
+    hash_doc = _sha256(pdf_bytes)
+    mismo = query_one(
+        "SELECT id_doc FROM documentos_pdf WHERE usuario_id IS ? AND hash_contenido = ?",
+        (usuario_id, hash_doc)
+    )
+    if mismo:
+        return {"id_doc": mismo["id_doc"], "estado": "sin_cambios",
+                "paginas_cambiadas": 0, "chunks_nuevos": 0, "chunks_borrados": 0}
+
+    doc = query_one(
+        "SELECT id_doc FROM documentos_pdf WHERE usuario_id IS ? AND titulo = ? ORDER BY id_doc DESC LIMIT 1",
+        (usuario_id, filename)
+    )
+    if doc:
+        id_doc, estado = doc["id_doc"], "actualizado"
+    else:
+        id_doc = execute_query("""
+            INSERT INTO documentos_pdf (usuario_id, titulo, fecha_subida, embedding_path)
+            VALUES (?, ?, datetime('now'), ?)
+        """, (usuario_id, filename, DB_VECTOR_PATH))
+        estado = "nuevo"
+
+    # BytesIO sobre los bytes subidos: se leen en memoria, sin copiarlos a disco
+    reader = PdfReader(BytesIO(pdf_bytes))
+    total_paginas = len(reader.pages)
+    hashes_previos = {
+        r["pagina"]: r["hash_pagina"]
+        for r in query_all("SELECT DISTINCT pagina, hash_pagina FROM chunks_pdf WHERE id_doc = ?", (id_doc,))
+    }
+    avisar = progreso or (lambda *args: None)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    embeddings = get_embeddings()
+    vectorstore = get_vectorstore(usuario_id)
+
+    # 1) Streaming: leer, trocear, vectorizar en paralelo y escribir por lotes
+    filas, cambiadas, vistos, textos = [], [], set(), []
+    lote, en_vuelo = [], []
+    escritos = leidas = 0
+
+    def _vaciar(hasta: int):
+        nonlocal escritos
+        while len(en_vuelo) > hasta:
+            chunks, futuro = en_vuelo.pop(0)
+            _escribir_lote(vectorstore, chunks, futuro.result())
+            escritos += len(chunks)
+            avisar(leidas, total_paginas, escritos)
+
+    with ThreadPoolExecutor(max_workers=RAG_EMBED_WORKERS) as pool:
+        for i, pagina in enumerate(_iter_paginas(reader, filename)):
+            leidas = i + 1
+            hash_pagina = _sha256(pagina.page_content)
+            if hashes_previos.get(i) != hash_pagina:
+                cambiadas.append(i)
+                pagina.metadata.update({"page": i, "id_doc": id_doc, "usuario_id": usuario_id})
+                for chunk in text_splitter.split_documents([pagina]):
+                    # El id incluye al usuario: cada colección deduplica sus propios chunks
+                    chunk_id = _sha256(f"{usuario_id or ''}\0{chunk.page_content}")
+                    filas.append((id_doc, i, chunk_id, hash_pagina))
+                    if chunk_id in vistos or query_one(
+                        "SELECT 1 AS x FROM chunks_pdf WHERE chunk_id = ? LIMIT 1", (chunk_id,)
+                    ):
+                        continue
+                    vistos.add(chunk_id)
+                    chunk.metadata["chunk_id"] = chunk_id
+                    textos.append((chunk.page_content, chunk_id, id_doc, i, usuario_id))
+                    lote.append(chunk)
+                    if len(lote) >= RAG_BATCH_SIZE:
+                        en_vuelo.append((lote, pool.submit(embeddings.embed_documents, [c.page_content for c in lote])))
+                        lote = []
+                        # Memoria acotada: como mucho 2 lotes por hilo pendientes
+                        _vaciar(2 * RAG_EMBED_WORKERS)
+            avisar(leidas, total_paginas, escritos)
+        if lote:
+            en_vuelo.append((lote, pool.submit(embeddings.embed_documents, [c.page_content for c in lote])))
+        _vaciar(0)
+
+    # 2) Registro de páginas y chunks en una sola transacción
+    sobrantes = [i for i in hashes_previos if i >= leidas]
+    with cursor() as cur:
+        reemplazadas = [(id_doc, i) for i in cambiadas + sobrantes]
+        anteriores = {
+            r["chunk_id"] for i in cambiadas + sobrantes
+            for r in cur.execute(
+                "SELECT chunk_id FROM chunks_pdf WHERE id_doc = ? AND pagina = ?", (id_doc, i)
+            ).fetchall()
+        }
+        cur.executemany("DELETE FROM chunks_pdf WHERE id_doc = ? AND pagina = ?", reemplazadas)
+        cur.executemany("INSERT OR IGNORE INTO chunks_pdf (id_doc, pagina, chunk_id, hash_pagina) VALUES (?, ?, ?, ?)", filas)
+        huerfanos = [
+            c for c in anteriores
+            if not cur.execute("SELECT 1 FROM chunks_pdf WHERE chunk_id = ? LIMIT 1", (c,)).fetchone()
+        ]
+        # Índice léxico: mismos chunks que el vector store, uno por chunk_id
+        cur.executemany("""
+            INSERT OR IGNORE INTO chunks_texto (texto, chunk_id, id_doc, pagina, usuario_id, usuario)
+            VALUES (?1, ?2, ?3, ?4, ?5, 'u' || COALESCE(hex(?5), ''))
+        """, textos)
+        cur.executemany("DELETE FROM chunks_texto WHERE chunk_id = ?", [(c,) for c in huerfanos])
+        total_chunks = cur.execute("SELECT COUNT(*) FROM chunks_pdf WHERE id_doc = ?", (id_doc,)).fetchone()[0]
+        cur.execute("""
+            UPDATE documentos_pdf
+            SET hash_contenido = ?, num_paginas = ?, num_chunks = ?, actualizado_en = datetime('now')
+            WHERE id_doc = ?
+        """, (hash_doc, leidas, total_chunks, id_doc))
+        if huerfanos:
+            vectorstore.delete(ids=huerfanos)
+        # NpyVectorStore acumula en memoria: una sola escritura por documento
+        if hasattr(vectorstore, "flush"):
+            vectorstore.flush()
+
+    if escritos or huerfanos:
+        _coleccion_actualizada(coleccion_usuario(usuario_id))
+
+    return {"id_doc": id_doc, "estado": estado, "paginas_cambiadas": len(cambiadas),
+            "chunks_nuevos": escritos, "chunks_borrados": len(huerfanos)}
+
+
+def procesar_pdf_rag(pdf_bytes: bytes, filename: str, usuario_id: Optional[str] = None) -> bool:
     """
     Guarda el PDF en la memoria vectorial usando Ollama.
     """
-    temp_path = f"temp_{filename}"
-    with open(temp_path, "wb") as f:
-        f.write(pdf_bytes)
-        
     try:
-        loader = PyPDFLoader(temp_path)
-        documentos = loader.load()
-        
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = text_splitter.split_documents(documentos)
-        
-        embeddings = OllamaEmbeddings(model="llama3.2:1b")
-        
-        Chroma.from_documents(
-            documents=chunks, 
-            embedding=embeddings, 
-            persist_directory=DB_VECTOR_PATH
-        )
+        ingerir_pdf(pdf_bytes, filename, usuario_id)
         return True
     except Exception as e:
         print(f"Error en RAG: {e}")
         return False
+
+
+# Colección única (la de por defecto de langchain_chroma) anterior a las
+# colecciones por usuario
+COLECCION_LEGADO = "langchain"
+_legado_revisado = False
+
+
+def _doc_legado(usuario_id: Optional[str], titulo: str) -> int:
+    """
+    Documento al que se asignan los chunks antiguos sin registro en
+    chunks_pdf: el de una migración anterior interrumpida o uno nuevo sin
+    hash_contenido, de modo que volver a subir el fichero lo re-ingiere.
+    """
+    doc = query_one(
+        "SELECT id_doc FROM documentos_pdf WHERE usuario_id IS ? AND titulo = ? AND hash_contenido IS NULL",
+        (usuario_id, titulo)
+    )
+    if doc:
+        return doc["id_doc"]
+    return execute_query("""
+        INSERT INTO documentos_pdf (usuario_id, titulo, fecha_subida, embedding_path, resumen)
+        VALUES (?, ?, datetime('now'), ?, 'Migrado de la colección única')
+    """, (usuario_id, titulo, DB_VECTOR_PATH))
+
+
+def migrar_coleccion_legado(lote: int = 500) -> int:
+    """
+    Reparte los chunks de la colección única anterior entre las colecciones
+    de sus usuarios (con los ids por usuario y en el índice BM25) y la borra.
+    Sin ella, esos documentos constan como subidos pero ninguna búsqueda los
+    encuentra, y volver a subirlos no hace nada (mismo hash).
+
+    Los chunks sin registro en chunks_pdf (los ingeridos antes de registrar
+    documentos) no dicen quién los subió: como antes los veía cualquier
+    usuario, se copian a todos los registrados (o a la colección anónima si
+    no hay ninguno) en un documento con el nombre del fichero original.
+
+    Cada lote se borra de la colección antigua al terminarlo, así que una
+    migración interrumpida sigue donde se quedó. Un fallo no impide arrancar
+    la app: se avisa y se reintenta en el siguiente arranque.
+    Devuelve cuántos chunks se han movido.
+    """
+    global _legado_revisado
+    if _legado_revisado or RAG_BACKEND != "chroma" or not os.path.isdir(DB_VECTOR_PATH):
+        return 0
+    _legado_revisado = True
+
+    movidos, colecciones, docs_legado = 0, set(), {}
+    try:
+        import chromadb  # dependencia de langchain_chroma
+        cliente = chromadb.PersistentClient(path=DB_VECTOR_PATH)
+        # Según la versión, list_collections devuelve nombres u objetos
+        if COLECCION_LEGADO not in [getattr(c, "name", c) for c in cliente.list_collections()]:
+            return 0
+        legado = cliente.get_collection(COLECCION_LEGADO)
+        usuarios = [r["usuario_id"] for r in query_all("SELECT usuario_id FROM usuarios ORDER BY usuario_id")]
+
+        while True:
+            datos = legado.get(include=["embeddings", "documents", "metadatas"], limit=lote)
+            if not datos["ids"]:
+                break
+            por_usuario: Dict[Optional[str], list] = {}
+            for cid, vector, texto, meta in zip(datos["ids"], datos["embeddings"], datos["documents"], datos["metadatas"]):
+                meta = meta or {}
+                # Un chunk deduplicado pudo servir a documentos de varios usuarios
+                usos = query_all("""
+                    SELECT DISTINCT d.usuario_id, c.id_doc, c.pagina
+                    FROM chunks_pdf c JOIN documentos_pdf d ON d.id_doc = c.id_doc
+                    WHERE c.chunk_id = ?
+                """, (cid,))
+                for uso in usos:
+                    por_usuario.setdefault(uso["usuario_id"], []).append((cid, vector, texto, meta, uso, False))
+                if usos:
+                    continue
+                destinos = usuarios or [None]
+                # Ya está con el id de algún usuario (lote reintentado o PDF vuelto a subir)
+                ids = [_sha256(f"{u or ''}\0{texto}") for u in destinos]
+                if query_one(
+                    f"SELECT 1 AS x FROM chunks_pdf WHERE chunk_id IN ({', '.join('?' * len(ids))}) LIMIT 1", tuple(ids)
+                ):
+                    continue
+                titulo = os.path.basename(str(meta.get("source", ""))).removeprefix("temp_") or "documento"
+                for usuario_id in destinos:
+                    if (usuario_id, titulo) not in docs_legado:
+                        docs_legado[(usuario_id, titulo)] = _doc_legado(usuario_id, titulo)
+                    uso = {"id_doc": docs_legado[(usuario_id, titulo)], "pagina": int(meta.get("page", 0))}
+                    por_usuario.setdefault(usuario_id, []).append((cid, vector, texto, meta, uso, True))
+
+            for usuario_id, usos in por_usuario.items():
+                chunks, vectores, textos, renombres, filas, vistos = [], [], [], [], [], set()
+                for cid, vector, texto, meta, uso, sin_registro in usos:
+                    nuevo = _sha256(f"{usuario_id or ''}\0{texto}")
+                    if sin_registro:
+                        filas.append((uso["id_doc"], uso["pagina"], nuevo, "legado"))
+                    else:
+                        renombres.append((nuevo, cid, uso["id_doc"]))
+                    if nuevo in vistos:
+                        continue
+                    vistos.add(nuevo)
+                    metadata = {**meta, "chunk_id": nuevo, "id_doc": uso["id_doc"],
+                                "page": uso["pagina"], "usuario_id": usuario_id}
+                    chunks.append(Document(page_content=texto, metadata=metadata))
+                    vectores.append([float(x) for x in vector])
+                    textos.append((texto, nuevo, uso["id_doc"], uso["pagina"], usuario_id))
+                with cursor() as cur:
+                    cur.executemany(
+                        "UPDATE OR IGNORE chunks_pdf SET chunk_id = ? WHERE chunk_id = ? AND id_doc = ?", renombres
+                    )
+                    cur.executemany(
+                        "INSERT OR IGNORE INTO chunks_pdf (id_doc, pagina, chunk_id, hash_pagina) VALUES (?, ?, ?, ?)", filas
+                    )
+                    cur.executemany("""
+                        INSERT OR IGNORE INTO chunks_texto (texto, chunk_id, id_doc, pagina, usuario_id, usuario)
+                        VALUES (?1, ?2, ?3, ?4, ?5, 'u' || COALESCE(hex(?5), ''))
+                    """, textos)
+                    _escribir_lote(get_vectorstore(usuario_id), chunks, vectores)
+                colecciones.add(coleccion_usuario(usuario_id))
+                movidos += len(chunks)
+            legado.delete(ids=datos["ids"])
+
+        for id_doc in docs_legado.values():
+            execute_query("""
+                UPDATE documentos_pdf
+                SET num_paginas = (SELECT COUNT(DISTINCT pagina) FROM chunks_pdf WHERE id_doc = ?1),
+                    num_chunks = (SELECT COUNT(*) FROM chunks_pdf WHERE id_doc = ?1),
+                    actualizado_en = datetime('now')
+                WHERE id_doc = ?1
+            """, (id_doc,))
+        cliente.delete_collection(COLECCION_LEGADO)
+        print(f"✅ {movidos} fragmentos de la colección antigua repartidos en {len(colecciones)} colecciones de usuario")
+    except Exception as e:
+        print(f"⚠️ No se pudo migrar la colección antigua de PDFs (se reintentará al arrancar): {e}")
     finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
\ No newline at end of file
+        for coleccion in colecciones:
+            _coleccion_actualizada(coleccion)
+    return movidos
@@ -1,45 +1,134 @@
 import os
+import json
+import functools
+from datetime import datetime
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
 from crewai.tools import tool
 from models.appointment import Appointment
-from langchain_chroma import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
 
 from backend.services import (
     add_appointment, set_event_id_for_appointment, find_appointment, 
-    update_appointment, delete_appointment
+    update_appointment, delete_appointment, find_appointments,
+    add_appointments_bulk, set_event_ids_bulk, update_appointments_bulk,
+    delete_appointments_bulk, buscar_fragmentos, usuario_tiene_documentos
 )
 from backend.google_calendar import (
-    get_future_events, create_event, update_event, delete_event
+    create_event, update_event, delete_event,
+    create_events_batch, update_events_batch, delete_events_batch
 )
+from backend.calendar_sync import (
+    ensure_synced, get_mirrored_events, mirror_event, forget_event,
+    mirror_events, forget_events
+)
+from backend.disponibilidad import DURACION_CITA, ahora_local, conflictos, huecos_libres, proximos_huecos
+
+# Observador de herramientas y usuario de la sesión del turno en curso.
+# Son ContextVar y no threading.local: el Crew en streaming ejecuta los
+# agentes en otro hilo, al que CrewAI le copia el contexto.
+_observador: ContextVar[Optional[Callable]] = ContextVar("observador_herramientas", default=None)
+_SIN_SESION = object()
+_sesion: ContextVar = ContextVar("sesion_usuario", default=_SIN_SESION)
+
+
+@contextmanager
+def observar_herramientas(emitir):
+    """Durante el bloque, cada herramienta avisa a `emitir` al empezar y al terminar."""
+    marca = _observador.set(emitir)
+    try:
+        yield
+    finally:
+        _observador.reset(marca)
+
+
+@contextmanager
+def sesion_usuario(email_usuario: Optional[str]):
+    """
+    Durante el bloque, las herramientas que acceden a datos privados usan
+    este usuario y no el email que les pase el LLM.
+    """
+    marca = _sesion.set(email_usuario or None)
+    try:
+        yield
+    finally:
+        _sesion.reset(marca)
+
+
+def _observable(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        emitir = _observador.get()
+        if emitir:
+            emitir({"tipo": "herramienta_inicio", "nombre": func.__name__, "args": kwargs})
+        resultado = func(*args, **kwargs)
+        if emitir:
+            emitir({"tipo": "herramienta_fin", "nombre": func.__name__, "resultado": resultado})
+        return resultado
+    return wrapper
 
 
 @tool
+@_observable
 def consultar_calendario_tool(email_usuario: str) -> str:
     """Útil para consultar las citas o eventos futuros en el calendario del usuario."""
     try:
         path_token = obtener_token_usuario(email_usuario)
-        eventos = get_future_events(token_path=path_token)
+        ensure_synced(email_usuario, token_path=path_token)
+        eventos = get_mirrored_events(email_usuario)
         if not eventos:
             return "No hay eventos próximos en el calendario."
         
         resultado = "Eventos en Google Calendar:\n"
         for e in eventos:
-            inicio = e['start'].get('dateTime', e['start'].get('date'))
-            resumen = e.get('summary', 'Sin título')
-            resultado += f"- {resumen} ({inicio})\n"
+            resultado += f"- {e['resumen']} ({e['inicio']})\n"
         return resultado
     except Exception as e:
         return f"Error: {str(e)}"
     
 def obtener_token_usuario(email: str) -> str:
-    """Calcula la ruta exacta del token del usuario."""
-    return f"tokens/{email.replace('@', '_at_')}.json"
+    """Clave de las credenciales del usuario en el almacén (backend/credenciales.py)."""
+    return email
+
+
+def _aviso_solape(email_usuario: str, fecha: str, hora: str, excluir: tuple = ()) -> str:
+    """Texto de aviso si la franja ya está ocupada ("" si está libre)."""
+    ocupado = conflictos(email_usuario, fecha, hora, excluir=excluir)
+    if not ocupado:
+        return ""
+    solapes = ", ".join(f"{c['titulo']} ({c['inicio']}-{c['fin'][-5:]})" for c in ocupado)
+    desde = datetime.strptime(f"{fecha} {hora[:5]}", "%Y-%m-%d %H:%M")
+    alternativas = ", ".join(f"{f} a las {h}" for f, h in proximos_huecos(email_usuario, desde))
+    return (f"⚠️ No he agendado nada: el {fecha} a las {hora} ya tienes {solapes}. "
+            f"Huecos libres cercanos: {alternativas or 'ninguno en los próximos días'}.")
+
+@tool
+@_observable
+def consultar_disponibilidad_tool(fecha: str, email_usuario: str, duracion_minutos: int = 60) -> str:
+    """Útil para saber qué huecos libres tiene el usuario un día (fecha YYYY-MM-DD) antes de proponer o agendar una cita."""
+    try:
+        try:
+            ensure_synced(email_usuario, token_path=obtener_token_usuario(email_usuario))
+        except Exception as e:
+            print(f"⚠️ Disponibilidad sin sincronizar con Google: {e}")
+        huecos = huecos_libres(email_usuario, fecha, duracion=int(duracion_minutos))
+        if not huecos:
+            desde = max(datetime.strptime(fecha, "%Y-%m-%d"), ahora_local())
+            alternativas = ", ".join(f"{f} a las {h}" for f, h in proximos_huecos(email_usuario, desde))
+            return f"No hay huecos libres el {fecha}. Próximos huecos: {alternativas or 'ninguno'}."
+        return f"Huecos libres el {fecha}: " + ", ".join(f"de {a} a {b}" for a, b in huecos) + "."
+    except Exception as e:
+        return f"Error: {str(e)}"
 
 @tool
+@_observable
 def agendar_cita_tool(descripcion: str, fecha: str, hora: str, email_usuario: str) -> str:
     """Útil para agendar una nueva cita."""
     try:
         path_token = obtener_token_usuario(email_usuario)
+        aviso = _aviso_solape(email_usuario, fecha, hora)
+        if aviso:
+            return aviso
         
         appt = Appointment(
             email=email_usuario, servicio=descripcion, 
@@ -55,21 +144,24 @@ def agendar_cita_tool(descripcion: str, fecha: str, hora: str, email_usuario: st
         google_event_id = event.get('id')
         if google_event_id:
             set_event_id_for_appointment(new_id, google_event_id)
+            mirror_event(email_usuario, event)
             
         return f"✅ Cita '{descripcion}' agendada para {fecha} a las {hora}."
     except Exception as e:
         return f"Error al agendar: {str(e)}"
 
 @tool
-def consultar_pdf_tool(pregunta: str) -> str:
-    """Busca información en el PDF."""
-    DB_VECTOR_PATH = "./chroma_db_data"
-    if not os.path.exists(DB_VECTOR_PATH):
+@_observable
+def consultar_pdf_tool(pregunta: str, email_usuario: str) -> str:
+    """Busca información en los PDFs que ha subido el usuario."""
+    # El email del argumento lo escribe el LLM: solo cuenta el de la sesión
+    email_usuario = _sesion.get()
+    if email_usuario is _SIN_SESION:
+        return "No hay una sesión de usuario activa para consultar sus documentos."
+    if not usuario_tiene_documentos(email_usuario):
         return "No hay ningún documento PDF subido."
     try:
-        embeddings = OllamaEmbeddings(model="llama3.2:1b")
-        vectorstore = Chroma(persist_directory=DB_VECTOR_PATH, embedding_function=embeddings)
-        docs = vectorstore.similarity_search(pregunta, k=3)
+        docs = buscar_fragmentos(pregunta, k=3, usuario_id=email_usuario)
         
         if not docs:
             return "No encontré información."
@@ -80,6 +172,7 @@ def consultar_pdf_tool(pregunta: str) -> str:
         return f"Error: {str(e)}"
 
 @tool
+@_observable
 def modificar_cita_tool(descripcion_actual: str, nueva_fecha: str, nueva_hora: str, email_usuario: str) -> str:
     """Útil para cambiar fecha/hora de una cita existente."""
     try:
@@ -87,10 +180,15 @@ def modificar_cita_tool(descripcion_actual: str, nueva_fecha: str, nueva_hora: s
         cita = find_appointment(usuario_email=email_usuario, tipo=descripcion_actual)
         if not cita:
             return f"No encontré la cita '{descripcion_actual}' en tu agenda."
+        aviso = _aviso_solape(email_usuario, nueva_fecha, nueva_hora,
+                              excluir=(cita['id_cita'], cita.get('id_evento_google')))
+        if aviso:
+            return aviso
         
         id_google = cita.get('id_evento_google')
         if id_google:
-            update_event(event_id=id_google, new_date_iso=nueva_fecha, new_time_hhmm=nueva_hora, token_path=path_token)
+            event = update_event(event_id=id_google, new_date_iso=nueva_fecha, new_time_hhmm=nueva_hora, token_path=path_token)
+            mirror_event(email_usuario, event)
             
         update_appointment(email_usuario, cita['id_cita'], nueva_fecha, nueva_hora)
         return f"✅ Cita modificada al {nueva_fecha} a las {nueva_hora}."
@@ -98,6 +196,7 @@ def modificar_cita_tool(descripcion_actual: str, nueva_fecha: str, nueva_hora: s
         return f"Error al modificar: {str(e)}"
 
 @tool
+@_observable
 def eliminar_cita_tool(descripcion: str, email_usuario: str) -> str:
     """Útil para borrar una cita."""
     try:
@@ -108,11 +207,139 @@ def eliminar_cita_tool(descripcion: str, email_usuario: str) -> str:
             
         id_google = cita.get('id_evento_google')
         if id_google:
+            # Si Google falla la cita se mantiene, como en _eliminar_lote
+            # (un evento que ya no existe cuenta como borrado)
             try:
                 delete_event(id_google, token_path=path_token)
-            except: pass
+            except Exception as e:
+                return f"No se pudo borrar '{descripcion}' de Google Calendar ({e}); la cita se mantiene."
+            forget_event(email_usuario, id_google)
             
         delete_appointment(cita['id_cita'])
         return f"✅ La cita '{descripcion}' ha sido cancelada."
     except Exception as e:
-        return f"Error al eliminar: {str(e)}"
\ No newline at end of file
+        return f"Error al eliminar: {str(e)}"
+
+
+def _agendar_lote(items, email_usuario, path_token) -> str:
+    # Mismo control de solapes que agendar_cita_tool, también entre las citas del lote
+    libres, ocupadas, aceptadas = [], [], []
+    for i in items:
+        inicio = datetime.strptime(f"{i['fecha']} {i['hora'][:5]}", "%Y-%m-%d %H:%M")
+        choca_lote = any(abs((inicio - otra).total_seconds()) < DURACION_CITA * 60 for otra in aceptadas)
+        if choca_lote or conflictos(email_usuario, i["fecha"], i["hora"]):
+            ocupadas.append(f"- {i['descripcion']} ({i['fecha']} {i['hora']})")
+        else:
+            libres.append(i)
+            aceptadas.append(inicio)
+    if not libres:
+        return "⚠️ No he agendado nada: todas las franjas están ocupadas.\n" + "\n".join(ocupadas)
+    items = libres
+
+    appts = [
+        Appointment(email=email_usuario, servicio=i["descripcion"],
+                    fecha_iso=i["fecha"], hora_iso=i["hora"], observaciones="Vía IA (lote)")
+        for i in items
+    ]
+    ids = add_appointments_bulk(appts)
+    resultados = create_events_batch([
+        {"summary": i["descripcion"], "date_iso": i["fecha"], "time_hhmm": i["hora"]} for i in items
+    ], token_path=path_token)
+
+    ok = [(id_cita, r["event"]) for id_cita, r in zip(ids, resultados) if r["ok"]]
+    set_event_ids_bulk([(id_cita, ev["id"]) for id_cita, ev in ok])
+    mirror_events(email_usuario, [ev for _, ev in ok])
+
+    fallos = [f"- {i['descripcion']}: {r['error']}" for i, r in zip(items, resultados) if not r["ok"]]
+    texto = f"✅ {len(ok)} de {len(items) + len(ocupadas)} citas agendadas."
+    if fallos:
+        texto += "\nGuardadas solo en local (falló Google Calendar):\n" + "\n".join(fallos)
+    if ocupadas:
+        texto += "\nNo agendadas porque la franja ya está ocupada:\n" + "\n".join(ocupadas)
+    return texto
+
+
+def _modificar_lote(items, email_usuario, path_token) -> str:
+    encontradas, no_encontradas = [], []
+    for i in items:
+        cita = find_appointment(usuario_email=email_usuario, tipo=i["descripcion_actual"])
+        if cita:
+            encontradas.append((i, cita))
+        else:
+            no_encontradas.append(i["descripcion_actual"])
+
+    con_google = [(i, c) for i, c in encontradas if c.get("id_evento_google")]
+    resultados = update_events_batch([
+        {"event_id": c["id_evento_google"], "new_date_iso": i["nueva_fecha"], "new_time_hhmm": i["nueva_hora"]}
+        for i, c in con_google
+    ], token_path=path_token) if con_google else []
+    fallidas = {c["id_cita"] for (i, c), r in zip(con_google, resultados) if not r["ok"]}
+    mirror_events(email_usuario, [r["event"] for r in resultados if r["ok"]])
+
+    cambios = [
+        (email_usuario, c["id_cita"], i["nueva_fecha"], i["nueva_hora"])
+        for i, c in encontradas if c["id_cita"] not in fallidas
+    ]
+    update_appointments_bulk(cambios)
+
+    texto = f"✅ {len(cambios)} de {len(items)} citas modificadas."
+    if no_encontradas:
+        texto += f"\nNo encontradas: {', '.join(no_encontradas)}."
+    if fallidas:
+        texto += f"\n{len(fallidas)} no se pudieron mover en Google Calendar y no se han cambiado."
+    return texto
+
+
+def _eliminar_lote(items, email_usuario, path_token) -> str:
+    # Sin fecha ni descripción find_appointments devolvería toda la agenda
+    invalidos = [i for i in items if not (i.get("fecha") or i.get("descripcion"))]
+    if invalidos:
+        return "Cada cita a eliminar necesita 'descripcion' o 'fecha'; no se ha cancelado nada."
+
+    citas = {}
+    for i in items:
+        for c in find_appointments(email_usuario, fecha=i.get("fecha"), tipo=i.get("descripcion")):
+            citas[c["id_cita"]] = c
+    if not citas:
+        return "No encontré ninguna de esas citas en tu agenda."
+
+    con_google = [c for c in citas.values() if c.get("id_evento_google")]
+    fallidas = set()
+    if con_google:
+        resultados = delete_events_batch([c["id_evento_google"] for c in con_google], token_path=path_token)
+        fallidas = {c["id_cita"] for c, r in zip(con_google, resultados) if not r["ok"]}
+        forget_events(email_usuario, [
+            c["id_evento_google"] for c in con_google if c["id_cita"] not in fallidas
+        ])
+    borrar = [id_cita for id_cita in citas if id_cita not in fallidas]
+    delete_appointments_bulk(borrar)
+
+    texto = f"✅ {len(borrar)} citas canceladas."
+    if fallidas:
+        texto += f"\n{len(fallidas)} no se pudieron borrar de Google Calendar y se mantienen."
+    return texto
+
+
+@tool
+@_observable
+def gestionar_citas_lote_tool(operacion: str, citas_json: str, email_usuario: str) -> str:
+    """Útil para agendar, modificar o eliminar VARIAS citas a la vez.
+    operacion: "agendar", "modificar" o "eliminar".
+    citas_json: lista JSON. Para agendar [{"descripcion", "fecha", "hora"}];
+    para modificar [{"descripcion_actual", "nueva_fecha", "nueva_hora"}];
+    para eliminar [{"descripcion"}] o [{"fecha"}] (cancela todo ese día)."""
+    try:
+        items = json.loads(citas_json)
+        if isinstance(items, dict):
+            items = [items]
+        path_token = obtener_token_usuario(email_usuario)
+        operacion = operacion.strip().lower()
+        if operacion == "agendar":
+            return _agendar_lote(items, email_usuario, path_token)
+        if operacion == "modificar":
+            return _modificar_lote(items, email_usuario, path_token)
+        if operacion == "eliminar":
+            return _eliminar_lote(items, email_usuario, path_token)
+        return f"Operación desconocida: {operacion}. Usa agendar, modificar o eliminar."
+    except Exception as e:
+        return f"Error en la operación en lote: {str(e)}"
@@ -0,0 +1,233 @@
+# backend/vector_npy.py
+"""
+Vector store compacto en NumPy, alternativa ligera a Chroma para corpus
+pequeños (unos miles de chunks por clínica).
+
+Cada colección es un directorio con un subdirectorio por versión (v000001,
+v000002, ...) y un fichero `actual` con el nombre de la versión vigente.
+Cada versión contiene:
+- vectores.npy: matriz N x D en float16, o int8 cuantizada por filas,
+  abierta con np.load(mmap_mode="r") (el sistema solo carga lo que se lee).
+- escalas.npy: escala de cada fila (solo en int8).
+- chunks.json: ids, textos y metadatos de cada fila, en el mismo orden.
+
+Los vectores se guardan normalizados, así que la similitud es un producto
+escalar. upsert y delete se acumulan en memoria y flush() escribe una
+versión nueva completa y después cambia `actual` con os.replace: los
+lectores siempre ven los tres ficheros de una misma versión, y nunca se
+sobrescribe un fichero que otro proceso pueda tener mapeado (en Windows
+fallaría). services.py llama a flush() una vez por documento, así que la
+ingesta reescribe la colección una vez y no una por lote.
+
+Implementa la parte del interfaz de Chroma que usa services.py:
+upsert, delete y similarity_search_by_vector, más flush.
+"""
+import json
+import os
+import shutil
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+# Filas por bloque al buscar: acota la memoria temporal del producto escalar
+BLOQUE = 4096
+
+
+def _normalizar(vectores: np.ndarray) -> np.ndarray:
+    normas = np.linalg.norm(vectores, axis=1, keepdims=True)
+    return vectores / np.where(normas == 0, 1.0, normas)
+
+
+def _es_version(nombre: str) -> bool:
+    return nombre.startswith("v") and nombre[1:].isdigit()
+
+
+@dataclass(frozen=True)
+class _Instantanea:
+    """
+    Una versión cargada. Se sustituye entera tras cada flush(), así una
+    búsqueda en curso nunca mezcla los ids de una versión con la matriz
+    de otra.
+    """
+    version: Optional[str]
+    ids: List[str]
+    textos: List[str]
+    metadatos: List[Dict]
+    posicion: Dict[str, int]
+    id_docs: np.ndarray
+    vectores: Optional[np.ndarray]
+    escalas: Optional[np.ndarray]
+
+
+class NpyVectorStore:
+    def __init__(self, directorio: str, dtype: str = "float16"):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"dtype no soportado: {dtype}")
+        self.directorio = directorio
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        self._pendientes: Dict[str, tuple] = {}
+        self._borrados: set = set()
+        self._cargar()
+
+    # --- Lectura -----------------------------------------------------------
+
+    def _ruta(self, nombre: str) -> str:
+        return os.path.join(self.directorio, nombre)
+
+    def _version_actual(self) -> Optional[str]:
+        try:
+            with open(self._ruta("actual"), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _cargar(self):
+        version = self._version_actual()
+        # Sin `actual`: formato anterior, con los ficheros en el propio directorio
+        base = self._ruta(version) if version else self.directorio
+        try:
+            with open(os.path.join(base, "chunks.json"), encoding="utf-8") as f:
+                chunks = json.load(f)
+            vectores = np.load(os.path.join(base, "vectores.npy"), mmap_mode="r")
+            escalas = np.load(os.path.join(base, "escalas.npy")) if self.dtype == "int8" else None
+        except FileNotFoundError:
+            chunks, vectores, escalas = [], None, None
+        ids = [c["id"] for c in chunks]
+        metadatos = [c["metadata"] for c in chunks]
+        # Una sola asignación: los lectores ven la versión anterior o esta
+        self._datos = _Instantanea(
+            version=version,
+            ids=ids,
+            textos=[c["texto"] for c in chunks],
+            metadatos=metadatos,
+            posicion={cid: i for i, cid in enumerate(ids)},
+            id_docs=np.array([m.get("id_doc", -1) for m in metadatos], dtype=np.int64),
+            vectores=vectores,
+            escalas=escalas,
+        )
+
+    def __len__(self) -> int:
+        return len(self._datos.ids)
+
+    @staticmethod
+    def _puntuar(datos: _Instantanea, consulta: np.ndarray) -> np.ndarray:
+        puntos = np.empty(len(datos.ids), dtype=np.float32)
+        for inicio in range(0, len(datos.ids), BLOQUE):
+            bloque = np.asarray(datos.vectores[inicio:inicio + BLOQUE], dtype=np.float32)
+            puntos[inicio:inicio + BLOQUE] = bloque @ consulta
+        if datos.escalas is not None:
+            puntos *= datos.escalas
+        return puntos
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4,
+                                    filter: Optional[Dict] = None, **kwargs) -> List[Document]:
+        datos = self._datos
+        if not datos.ids:
+            return []
+        consulta = _normalizar(np.asarray([embedding], dtype=np.float32))[0]
+        puntos = self._puntuar(datos, consulta)
+        if filter and "id_doc" in filter:
+            puntos[datos.id_docs != filter["id_doc"]] = -np.inf
+        k = min(k, len(puntos))
+        mejores = np.argpartition(-puntos, k - 1)[:k]
+        mejores = mejores[np.argsort(-puntos[mejores])]
+        return [
+            Document(page_content=datos.textos[i], metadata=datos.metadatos[i])
+            for i in mejores if np.isfinite(puntos[i])
+        ]
+
+    # --- Escritura ---------------------------------------------------------
+
+    def _escribir(self, ids: List[str], textos: List[str], metadatos: List[Dict], matriz: np.ndarray):
+        """Escribe una versión nueva completa y la publica cambiando `actual`."""
+        os.makedirs(self.directorio, exist_ok=True)
+        numero = max([int(n[1:]) for n in os.listdir(self.directorio) if _es_version(n)] + [0]) + 1
+        version = f"v{numero:06d}"
+        destino = self._ruta(version)
+        os.makedirs(destino)
+        if self.dtype == "int8":
+            escalas = np.abs(matriz).max(axis=1) / 127.0 if len(matriz) else np.empty(0, dtype=np.float32)
+            escalas = np.where(escalas == 0, 1.0, escalas).astype(np.float32)
+            np.save(os.path.join(destino, "vectores.npy"), np.round(matriz / escalas[:, None]).astype(np.int8))
+            np.save(os.path.join(destino, "escalas.npy"), escalas)
+        else:
+            np.save(os.path.join(destino, "vectores.npy"), matriz.astype(np.float16))
+        with open(os.path.join(destino, "chunks.json"), "w", encoding="utf-8") as f:
+            json.dump([{"id": i, "texto": t, "metadata": m} for i, t, m in zip(ids, textos, metadatos)],
+                      f, ensure_ascii=False)
+
+        tmp = self._ruta("actual.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(tmp, self._ruta("actual"))
+        anterior = self._datos.version
+        self._cargar()
+        self._limpiar(conservar={version, anterior})
+
+    def _limpiar(self, conservar: set):
+        """
+        Borra las versiones antiguas. La inmediatamente anterior se conserva
+        para los lectores que aún la tengan abierta; si un fichero sigue
+        mapeado (Windows) se deja y se reintenta en la próxima escritura.
+        """
+        for nombre in os.listdir(self.directorio):
+            if _es_version(nombre) and nombre not in conservar:
+                shutil.rmtree(self._ruta(nombre), ignore_errors=True)
+
+    def upsert(self, ids: List[str], embeddings: List[List[float]], documents: List[str],
+               metadatas: List[Dict]):
+        """Acumula los chunks en memoria; se escriben en el próximo flush()."""
+        nuevos = _normalizar(np.asarray(embeddings, dtype=np.float32))
+        with self._lock:
+            for j, cid in enumerate(ids):
+                self._pendientes[cid] = (nuevos[j], documents[j], metadatas[j])
+                self._borrados.discard(cid)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs):
+        """Marca los ids para borrar en el próximo flush()."""
+        if not ids:
+            return
+        with self._lock:
+            for cid in ids:
+                self._pendientes.pop(cid, None)
+                self._borrados.add(cid)
+
+    def flush(self):
+        """Aplica los upsert y delete acumulados en una sola versión nueva."""
+        with self._lock:
+            datos = self._datos
+            if not self._pendientes and not (self._borrados & datos.posicion.keys()):
+                self._borrados.clear()
+                return
+            quedan = [i for i, cid in enumerate(datos.ids) if cid not in self._borrados]
+            ids_ = [datos.ids[i] for i in quedan]
+            textos = [datos.textos[i] for i in quedan]
+            metadatos = [datos.metadatos[i] for i in quedan]
+            if datos.vectores is not None and quedan:
+                matriz = np.asarray(datos.vectores[quedan], dtype=np.float32)
+                if datos.escalas is not None:
+                    matriz *= datos.escalas[quedan][:, None]
+            else:
+                dim = len(next(iter(self._pendientes.values()))[0]) if self._pendientes else 0
+                matriz = np.empty((0, dim), dtype=np.float32)
+
+            posicion = {cid: i for i, cid in enumerate(ids_)}
+            añadir = []
+            for cid, (vector, texto, metadata) in self._pendientes.items():
+                if cid in posicion:
+                    i = posicion[cid]
+                    matriz[i], textos[i], metadatos[i] = vector, texto, metadata
+                else:
+                    ids_.append(cid)
+                    textos.append(texto)
+                    metadatos.append(metadata)
+                    añadir.append(vector)
+            if añadir:
+                matriz = np.vstack([matriz, np.asarray(añadir, dtype=np.float32)])
+            self._escribir(ids_, textos, metadatos, matriz)
+            self._pendientes.clear()
+            self._borrados.clear()
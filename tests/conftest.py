@@ -0,0 +1,12 @@
+import pytest
+
+from backend import db
+
+
+@pytest.fixture
+def db_temporal(tmp_path, monkeypatch):
+    """botcitas.db vacía y migrada en un directorio temporal."""
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "botcitas.db"))
+    db.init_db()
+    yield db
+    db.close_connection()
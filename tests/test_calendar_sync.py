@@ -0,0 +1,37 @@
+from datetime import datetime
+
+import pytz
+
+from backend.calendar_sync import get_mirrored_events, mirror_events
+
+EMAIL = "ana@example.com"
+AHORA = datetime(2030, 1, 10, 10, 0, tzinfo=pytz.utc)
+
+
+def _evento(event_id, inicio, fin):
+    return {"id": event_id, "summary": event_id,
+            "start": {"dateTime": inicio}, "end": {"dateTime": fin}}
+
+
+def test_incluye_eventos_en_curso_y_ordena_por_inicio(db_temporal):
+    mirror_events(EMAIL, [
+        _evento("terminado", "2030-01-10T07:00:00Z", "2030-01-10T09:00:00Z"),
+        _evento("en_curso", "2030-01-10T09:00:00Z", "2030-01-10T11:00:00Z"),
+        _evento("futuro", "2030-01-10T12:00:00Z", "2030-01-10T13:00:00Z"),
+    ])
+
+    eventos = get_mirrored_events(EMAIL, AHORA)
+
+    assert [e["event_id"] for e in eventos] == ["en_curso", "futuro"]
+
+
+def test_el_limite_respeta_el_orden_por_inicio(db_temporal):
+    mirror_events(EMAIL, [
+        # Empezó antes y termina después que todos los demás
+        _evento("congreso", "2030-01-09T08:00:00Z", "2030-01-20T18:00:00Z"),
+        *[_evento(f"cita{i}", f"2030-01-1{i}T12:00:00Z", f"2030-01-1{i}T13:00:00Z") for i in range(1, 5)],
+    ])
+
+    eventos = get_mirrored_events(EMAIL, AHORA, limit=2)
+
+    assert [e["event_id"] for e in eventos] == ["congreso", "cita1"]
@@ -0,0 +1,56 @@
+from backend import db
+from backend.services import add_appointment, delete_appointment, update_appointment
+from models.appointment import Appointment
+
+EMAIL = "ana@example.com"
+
+
+def _cita(tipo="Dentista", fecha="2030-01-10"):
+    return add_appointment(Appointment(email=EMAIL, servicio=tipo, fecha_iso=fecha, hora_iso="10:00"))
+
+
+def test_migraciones_aplicadas_y_planes_con_indice(db_temporal):
+    assert db.get_schema_version() == db.MIGRATIONS[-1][0]
+    assert db.check_query_plans()
+
+
+def test_triggers_mantienen_las_estadisticas(db_temporal):
+    db.upsert_user_token(EMAIL, "Ana", EMAIL)
+    primera = _cita("Dentista")
+    _cita("Dentista", "2030-01-11")
+    _cita("Fisio")
+    update_appointment(EMAIL, primera, "2030-01-12", "11:00")
+    delete_appointment(primera)
+
+    assert db.verificar_estadisticas() == {}
+    assert db.dashboard_kpis() == {"usuarios": 1, "citas": 2, "promedio_citas_usuario": 2.0}
+    assert {r["tipo"]: r["total"] for r in db.dashboard_demanda_por_tipo()} == {"Dentista": 1, "Fisio": 1}
+
+
+def test_verificar_estadisticas_repara_la_deriva(db_temporal):
+    _cita()
+    db.execute_query("UPDATE stats_citas_tipo SET total = 7")
+
+    assert db.verificar_estadisticas(reparar=True) == {"stats_citas_tipo": {"Dentista": (7, 1)}}
+    assert db.verificar_estadisticas() == {}
+
+
+def test_cache_del_dashboard_solo_se_invalida_con_citas_o_usuarios(db_temporal, monkeypatch):
+    _cita()
+    llamadas = []
+    original = db._kpis
+    monkeypatch.setattr(db, "_kpis", lambda: llamadas.append(1) or original())
+
+    assert db.dashboard_kpis()["citas"] == 1
+    # Escrituras que no cambian el dashboard: no recalcula
+    db.registrar_turno(EMAIL, "hola", "hola")
+    db.execute_query("""
+        INSERT INTO jobs (clave, usuario_id, mensaje, opciones, estado, creado_en, actualizado_en)
+        VALUES ('c', ?, 'm', '{}', 'pendiente', datetime('now'), datetime('now'))
+    """, (EMAIL,))
+    assert db.dashboard_kpis()["citas"] == 1
+    assert len(llamadas) == 1
+
+    _cita("Fisio")
+    assert db.dashboard_kpis()["citas"] == 2
+    assert len(llamadas) == 2
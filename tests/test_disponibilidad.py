@@ -0,0 +1,92 @@
+from datetime import datetime
+
+import pytest
+
+from backend.calendar_sync import mirror_events
+from backend.disponibilidad import (
+    IndiceAgenda, conflictos, en_horario, huecos_libres, proximos_huecos
+)
+from backend.services import add_appointment
+from models.appointment import Appointment
+
+EMAIL = "ana@example.com"
+# Jueves 10 de enero de 2030; el sábado 12 no es laborable
+JUEVES, SABADO = "2030-01-10", "2030-01-12"
+ANTES = datetime(2030, 1, 1)
+
+
+@pytest.fixture(autouse=True)
+def zona(monkeypatch):
+    monkeypatch.setenv("TIMEZONE", "Europe/Madrid")
+
+
+def _cita(fecha, hora, tipo="Dentista"):
+    return add_appointment(Appointment(email=EMAIL, servicio=tipo, fecha_iso=fecha, hora_iso=hora))
+
+
+def test_indice_solapes_con_intervalo_largo_al_principio():
+    indice = IndiceAgenda([(20, 30, "b", 2, None), (0, 100, "largo", 1, None), (40, 50, "c", None, "ev")])
+
+    assert indice.solapes(35, 45) == [0, 2]
+    assert indice.solapes(35, 45, excluir=(1, "ev")) == []
+    assert indice.solapes(100, 120) == []
+    assert indice.huecos(0, 200, 30) == [(100, 200)]
+
+
+def test_indice_huecos_entre_intervalos():
+    indice = IndiceAgenda([(10, 20, "a", 1, None), (50, 60, "b", 2, None)])
+
+    assert indice.huecos(0, 100, 20) == [(20, 50), (60, 100)]
+    assert indice.huecos(0, 100, 31) == [(60, 100)]
+
+
+def test_en_horario():
+    assert en_horario("09:00")
+    assert en_horario("17:00")
+    assert not en_horario("17:30")
+    assert not en_horario("05:00")
+    assert en_horario("05:00", horario="05:00-06:00")
+
+
+def test_huecos_libres_con_citas_y_eventos_de_google(db_temporal):
+    _cita(JUEVES, "10:00")
+    # 13:00-14:30 en Madrid (UTC+1 en invierno)
+    mirror_events(EMAIL, [{"id": "comida", "summary": "Comida",
+                           "start": {"dateTime": "2030-01-10T12:00:00Z"},
+                           "end": {"dateTime": "2030-01-10T13:30:00Z"}}])
+
+    assert huecos_libres(EMAIL, JUEVES, desde=ANTES) == [
+        ("09:00", "10:00"), ("11:00", "13:00"), ("14:30", "18:00")
+    ]
+    assert [c["titulo"] for c in conflictos(EMAIL, JUEVES, "13:30")] == ["Comida"]
+    assert conflictos(EMAIL, JUEVES, "11:00") == []
+
+
+def test_huecos_libres_no_laborable_y_desde(db_temporal):
+    assert huecos_libres(EMAIL, SABADO, desde=ANTES) == []
+    assert huecos_libres(EMAIL, JUEVES, desde=datetime(2030, 1, 10, 16, 20)) == [("16:20", "18:00")]
+
+
+def test_conflictos_excluye_la_cita_que_se_mueve(db_temporal):
+    id_cita = _cita(JUEVES, "10:00")
+
+    assert [c["inicio"] for c in conflictos(EMAIL, JUEVES, "10:30")] == ["2030-01-10 10:00"]
+    assert conflictos(EMAIL, JUEVES, "10:30", excluir=(id_cita,)) == []
+
+
+def test_proximos_huecos_uno_por_tramo_redondeado_y_sin_fin_de_semana(db_temporal):
+    # Viernes 11: ocupado todo el día
+    for hora in ("09:00", "10:00", "11:00", "12:00", "13:00", "14:00", "15:00", "16:00", "17:00"):
+        _cita("2030-01-11", hora)
+
+    propuestas = proximos_huecos(EMAIL, datetime(2030, 1, 10, 16, 10), n=3)
+
+    assert propuestas == [("2030-01-10", "16:30"), ("2030-01-14", "09:00"), ("2030-01-15", "09:00")]
+
+
+def test_el_indice_se_reconstruye_al_cambiar_la_agenda(db_temporal):
+    assert huecos_libres(EMAIL, JUEVES, desde=ANTES) == [("09:00", "18:00")]
+
+    _cita(JUEVES, "09:00")
+
+    assert huecos_libres(EMAIL, JUEVES, desde=ANTES) == [("10:00", "18:00")]
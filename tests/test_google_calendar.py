@@ -0,0 +1,78 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from backend import google_calendar
+
+
+def _http_error(status):
+    return HttpError(httplib2.Response({"status": status}), b"{}")
+
+
+class _Peticion:
+    def __init__(self, event_id, errores):
+        self.event_id = event_id
+        self.errores = errores
+
+    def execute(self):
+        if self.event_id in self.errores:
+            raise self.errores[self.event_id]
+        return {}
+
+
+class _Batch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.peticiones = []
+
+    def add(self, peticion, request_id):
+        self.peticiones.append((request_id, peticion))
+
+    def execute(self):
+        for request_id, peticion in self.peticiones:
+            try:
+                self.callback(request_id, peticion.execute(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class _Servicio:
+    """Lo mínimo de googleapiclient que usan los borrados."""
+
+    def __init__(self, errores):
+        self.errores = errores
+
+    def events(self):
+        return self
+
+    def delete(self, calendarId, eventId, sendUpdates):
+        return _Peticion(eventId, self.errores)
+
+    def new_batch_http_request(self, callback):
+        return _Batch(callback)
+
+
+@pytest.fixture
+def servicio(monkeypatch):
+    def _con_errores(**errores):
+        servicio = _Servicio(errores)
+        monkeypatch.setattr(google_calendar, "get_service", lambda token_path=None: servicio)
+        return servicio
+    return _con_errores
+
+
+def test_batch_cuenta_404_y_410_como_borrados(servicio):
+    servicio(ya_no=_http_error(404), caducado=_http_error(410), roto=_http_error(500))
+
+    resultados = google_calendar.delete_events_batch(["bien", "ya_no", "caducado", "roto"])
+
+    assert [r["ok"] for r in resultados] == [True, True, True, False]
+    assert resultados[3]["status"] == 500
+
+
+def test_delete_event_ignora_evento_inexistente(servicio):
+    servicio(ya_no=_http_error(404), roto=_http_error(500))
+
+    assert google_calendar.delete_event("ya_no") is True
+    with pytest.raises(HttpError):
+        google_calendar.delete_event("roto")
@@ -0,0 +1,89 @@
+import io
+
+import pytest
+
+from backend import importacion
+from backend.importacion import escribir_ics, importar, iter_citas, leer_csv, leer_ics
+
+EMAIL = "ana@example.com"
+
+
+@pytest.fixture(autouse=True)
+def zona(monkeypatch):
+    monkeypatch.setenv("TIMEZONE", "Europe/Madrid")
+
+
+def _ics(*eventos):
+    cuerpo = "".join(f"BEGIN:VEVENT\r\n{e}END:VEVENT\r\n" for e in eventos)
+    return io.StringIO(f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n{cuerpo}END:VCALENDAR\r\n")
+
+
+def test_csv_normaliza_y_cuenta_errores(db_temporal):
+    fuente = io.StringIO(
+        "usuario_id,fecha,hora,tipo,descripcion,recordatorio,id_evento_google\n"
+        f"{EMAIL},10/01/2030,9:30,Dentista,,1 día antes,\n"
+        f"{EMAIL},2030-13-45x,10:00,Fisio,,,\n"
+        f",2030-01-11,10:00,Fisio,,,\n"
+        f"{EMAIL},2030-01-12,25:00,Fisio,,,\n"
+    )
+
+    resumen = importar(leer_csv(fuente))
+
+    assert resumen["importadas"] == 1
+    assert resumen["num_errores"] == 3
+    cita = next(iter_citas(EMAIL))
+    assert (cita["fecha"], cita["hora"], cita["recordatorio"]) == ("2030-01-10", "09:30", "1 día antes")
+
+
+def test_solo_se_guardan_los_primeros_errores(db_temporal):
+    registros = ({"usuario_id": EMAIL, "fecha": "mal"} for _ in range(500))
+
+    resumen = importar(registros)
+
+    assert resumen["num_errores"] == 500
+    assert len(resumen["errores"]) == importacion.MAX_ERRORES
+
+
+def test_ics_zonas_y_dia_completo(db_temporal):
+    fuente = _ics(
+        "SUMMARY:Dentista\r\nDTSTART:20300110T083000Z\r\n",
+        "SUMMARY:Fisio\r\nDTSTART;TZID=America/New_York:20300110T090000\r\n",
+        "SUMMARY:Congreso\r\nDTSTART;VALUE=DATE:20300111\r\n",
+        "SUMMARY:Windows\r\nDTSTART;TZID=Romance Standard Time:20300110T090000\r\n",
+        "SUMMARY:Descripci\r\n ón larga\r\nDTSTART:20300112T100000\r\n",
+    )
+
+    resumen = importar(leer_ics(fuente), usuario_id=EMAIL)
+
+    assert resumen["importadas"] == 4
+    assert resumen["num_errores"] == 1
+    assert "zona horaria desconocida" in resumen["errores"][0]
+    citas = {c["tipo"]: (c["fecha"], c["hora"]) for c in iter_citas(EMAIL)}
+    assert citas == {
+        "Dentista": ("2030-01-10", "09:30"),
+        "Fisio": ("2030-01-10", "15:00"),
+        "Congreso": ("2030-01-11", None),
+        "Descripción larga": ("2030-01-12", "10:00"),
+    }
+
+
+def test_exportar_ics_en_utc_y_reimportar(db_temporal):
+    importar(iter([
+        {"fecha": "2030-07-10", "hora": "10:00", "tipo": "Dentista, revisión", "descripcion": "línea 1\nlínea 2"},
+        {"fecha": "2030-07-11", "tipo": "Congreso"},
+    ]), usuario_id=EMAIL)
+
+    salida = io.StringIO()
+    assert escribir_ics(iter_citas(EMAIL), salida) == 2
+    texto = salida.getvalue()
+    # Verano en Madrid: UTC+2, y sin TZID que necesite VTIMEZONE
+    assert "DTSTART:20300710T080000Z" in texto
+    assert "TZID=" not in texto
+
+    db_temporal.execute_query("DELETE FROM citas")
+    importar(leer_ics(io.StringIO(texto)), usuario_id=EMAIL)
+    citas = {c["tipo"]: (c["fecha"], c["hora"], c["descripcion"]) for c in iter_citas(EMAIL)}
+    assert citas == {
+        "Dentista, revisión": ("2030-07-10", "10:00", "línea 1\nlínea 2"),
+        "Congreso": ("2030-07-11", None, None),
+    }
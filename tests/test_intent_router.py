@@ -0,0 +1,75 @@
+from datetime import datetime
+
+import pytest
+
+from backend.intent_router import clasificar
+from backend.services import add_appointment
+from models.appointment import Appointment
+
+EMAIL = "ana@example.com"
+# Lunes a media mañana
+AHORA = datetime(2030, 1, 7, 11, 0)
+
+
+@pytest.fixture
+def agenda(db_temporal):
+    add_appointment(Appointment(email=EMAIL, servicio="Dentista", fecha_iso="2030-01-10", hora_iso="10:00"))
+    return db_temporal
+
+
+def _clasificar(mensaje):
+    return clasificar(f"- user: {mensaje}", EMAIL, ahora=AHORA)
+
+
+def test_consultar(agenda):
+    assert _clasificar("¿Qué citas tengo?").tipo == "CONSULTAR"
+
+
+def test_eliminar_cita_existente(agenda):
+    intencion = _clasificar("Borra la cita del dentista")
+    assert intencion.tipo == "ELIMINAR"
+    assert intencion.datos == {"descripcion": "Dentista"}
+
+
+def test_eliminar_cita_inexistente_va_al_crew(agenda):
+    assert _clasificar("Borra la cita del fisio") is None
+
+
+def test_agendar_completo(agenda):
+    intencion = _clasificar("Agenda una cita de fisioterapia el jueves a las 10")
+    assert intencion.tipo == "AGENDAR"
+    assert intencion.datos == {"descripcion": "Fisioterapia", "fecha": "2030-01-10", "hora": "10:00"}
+
+
+def test_agendar_de_la_tarde(agenda):
+    intencion = _clasificar("Reserva una cita con el dentista mañana a las 4 de la tarde")
+    assert intencion.datos["fecha"] == "2030-01-08"
+    assert intencion.datos["hora"] == "16:00"
+
+
+@pytest.mark.parametrize("mensaje", [
+    "¿Qué citas tengo y borra la del dentista?",
+    "Agenda una cita de fisio el jueves a las 10 y otra el viernes a las 11",
+    "Agenda una cita de fisio el jueves y el viernes a las 10",
+    "Agenda una cita de fisio el jueves a las 10 o a las 12",
+])
+def test_varias_peticiones_van_al_crew(agenda, mensaje):
+    assert _clasificar(mensaje) is None
+
+
+@pytest.mark.parametrize("mensaje", [
+    # 05:00, fuera del horario de atención
+    "Agenda una cita de fisio el jueves a las 5",
+    # Antes de la hora actual
+    "Agenda una cita de fisio hoy a las 10",
+    # Sin hora
+    "Agenda una cita de fisio el jueves",
+])
+def test_horas_invalidas_van_al_crew(agenda, mensaje):
+    assert _clasificar(mensaje) is None
+
+
+def test_hora_con_dos_lecturas_en_horario_va_al_crew(agenda, monkeypatch):
+    monkeypatch.setattr("backend.disponibilidad.HORARIO", "08:00-22:00")
+    assert _clasificar("Agenda una cita de fisio el jueves a las 9") is None
+    assert _clasificar("Agenda una cita de fisio el jueves a las 21").datos["hora"] == "21:00"
@@ -0,0 +1,34 @@
+import pytest
+
+from backend import crew_manager, jobs
+
+EMAIL = "ana@example.com"
+
+
+@pytest.fixture
+def turno_falso(monkeypatch):
+    """ejecutar_turno que emite la respuesta en trozos, sin LLM."""
+    def _ejecutar_turno(mensaje, email_usuario, emitir=None, **opciones):
+        trozos = [f"{mensaje}-{i} " for i in range(50)]
+        for trozo in trozos:
+            emitir({"tipo": "token", "texto": trozo})
+        return {"respuesta": "".join(trozos), "ruta": "crew", "tokens": 0}
+
+    monkeypatch.setattr(crew_manager, "ejecutar_turno", _ejecutar_turno)
+
+
+def test_el_job_terminado_guarda_todo_el_parcial(db_temporal, turno_falso):
+    job = jobs.esperar_job(jobs.submit_turno("hola", EMAIL), timeout=10)
+
+    assert job["estado"] == "terminado"
+    assert job["parcial"] == job["resultado"]
+
+
+def test_reenviar_un_mensaje_terminado_lo_ejecuta_otra_vez(db_temporal, turno_falso):
+    primero = jobs.submit_turno("hola", EMAIL)
+    jobs.esperar_job(primero, timeout=10)
+
+    segundo = jobs.submit_turno("hola", EMAIL)
+
+    assert segundo != primero
+    assert jobs.esperar_job(segundo, timeout=10)["estado"] == "terminado"
@@ -0,0 +1,72 @@
+import chromadb
+import pytest
+
+from backend import services
+
+VECTOR = [0.1, 0.2, 0.3]
+
+
+@pytest.fixture
+def vectores_temporales(tmp_path, monkeypatch):
+    """Directorio de Chroma vacío y estado del proceso sin colecciones abiertas."""
+    ruta = str(tmp_path / "chroma")
+    monkeypatch.setattr(services, "DB_VECTOR_PATH", ruta)
+    monkeypatch.setattr(services, "VERSION_FILE", str(tmp_path / "chroma" / ".version_{coleccion}"))
+    monkeypatch.setattr(services, "RAG_BACKEND", "chroma")
+    monkeypatch.setattr(services, "_legado_revisado", False)
+    monkeypatch.setattr(services, "_vectorstores", {})
+    monkeypatch.setattr(services, "_versiones", {})
+    return chromadb.PersistentClient(path=ruta)
+
+
+def _coleccion_legado(cliente, *textos):
+    legado = cliente.create_collection(services.COLECCION_LEGADO)
+    legado.add(
+        ids=[f"viejo{i}" for i in range(len(textos))],
+        embeddings=[VECTOR] * len(textos),
+        documents=list(textos),
+        metadatas=[{"source": "temp_analitica.pdf", "page": i} for i in range(len(textos))],
+    )
+
+
+def _textos(cliente, usuario_id):
+    return sorted(cliente.get_collection(services.coleccion_usuario(usuario_id)).get()["documents"])
+
+
+def test_chunks_sin_registro_se_copian_a_los_usuarios(db_temporal, vectores_temporales):
+    for email in ("ana@example.com", "luis@example.com"):
+        db_temporal.upsert_user_token(email, email, email)
+    _coleccion_legado(vectores_temporales, "colesterol 180", "glucosa 90")
+
+    assert services.migrar_coleccion_legado(lote=1) == 4
+
+    nombres = [getattr(c, "name", c) for c in vectores_temporales.list_collections()]
+    assert services.COLECCION_LEGADO not in nombres
+    for email in ("ana@example.com", "luis@example.com"):
+        assert _textos(vectores_temporales, email) == ["colesterol 180", "glucosa 90"]
+        assert services.usuario_tiene_documentos(email)
+        doc = db_temporal.query_one("SELECT titulo, num_chunks FROM documentos_pdf WHERE usuario_id = ?", (email,))
+        assert (doc["titulo"], doc["num_chunks"]) == ("analitica.pdf", 2)
+        assert [d.page_content for d in services._buscar_bm25("glucosa", 5, email, None)] == ["glucosa 90"]
+
+
+def test_migracion_interrumpida_sigue_donde_se_quedo(db_temporal, vectores_temporales, monkeypatch):
+    db_temporal.upsert_user_token("ana@example.com", "Ana", "ana@example.com")
+    _coleccion_legado(vectores_temporales, "colesterol 180", "glucosa 90")
+    escribir = services._escribir_lote
+    llamadas = []
+
+    def _falla_en_el_segundo_lote(vectorstore, chunks, vectores):
+        llamadas.append(1)
+        if len(llamadas) == 2:
+            raise RuntimeError("disco lleno")
+        escribir(vectorstore, chunks, vectores)
+
+    monkeypatch.setattr(services, "_escribir_lote", _falla_en_el_segundo_lote)
+    # El fallo se avisa, no se propaga al arranque de la app
+    assert services.migrar_coleccion_legado(lote=1) == 1
+
+    monkeypatch.setattr(services, "_legado_revisado", False)
+    assert services.migrar_coleccion_legado(lote=1) == 1
+    assert _textos(vectores_temporales, "ana@example.com") == ["colesterol 180", "glucosa 90"]
+    assert db_temporal.query_one("SELECT COUNT(*) AS n FROM documentos_pdf")["n"] == 1
@@ -0,0 +1,45 @@
+import json
+
+from backend import google_calendar, tools_openai
+from backend.services import add_appointment, find_appointments, set_event_id_for_appointment
+from models.appointment import Appointment
+from tests.test_google_calendar import _Servicio, _http_error
+
+EMAIL = "ana@example.com"
+
+
+def _cita(servicio, fecha, event_id=None):
+    id_cita = add_appointment(Appointment(email=EMAIL, servicio=servicio, fecha_iso=fecha, hora_iso="10:00"))
+    if event_id:
+        set_event_id_for_appointment(id_cita, event_id)
+    return id_cita
+
+
+def _eliminar(monkeypatch, items, **errores):
+    monkeypatch.setattr(google_calendar, "get_service", lambda token_path=None: _Servicio(errores))
+    return tools_openai.gestionar_citas_lote_tool.run(
+        operacion="eliminar", citas_json=json.dumps(items), email_usuario=EMAIL
+    )
+
+
+def test_eliminar_lote_sin_criterio_no_borra_nada(db_temporal, monkeypatch):
+    _cita("Dentista", "2030-01-10")
+
+    respuesta = _eliminar(monkeypatch, [{"hora": "10:00"}])
+
+    assert "no se ha cancelado nada" in respuesta
+    assert len(find_appointments(EMAIL)) == 1
+
+
+def test_eliminar_lote_mantiene_solo_los_errores_reales(db_temporal, monkeypatch):
+    _cita("Dentista", "2030-01-10", "ev_bien")
+    _cita("Fisio", "2030-01-10", "ev_ya_no")
+    _cita("Oculista", "2030-01-10", "ev_roto")
+
+    respuesta = _eliminar(
+        monkeypatch, [{"fecha": "2030-01-10"}],
+        ev_ya_no=_http_error(410), ev_roto=_http_error(500),
+    )
+
+    assert "2 citas canceladas" in respuesta
+    assert [c["tipo"] for c in find_appointments(EMAIL)] == ["Oculista"]
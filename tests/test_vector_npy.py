@@ -0,0 +1,105 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from backend.vector_npy import NpyVectorStore
+
+
+def _vectores(n, dim=8, semilla=0):
+    return np.random.default_rng(semilla).random((n, dim)).tolist()
+
+
+def _upsert(store, ids, vectores, id_doc=1):
+    store.upsert(ids, vectores, [f"texto {i}" for i in ids], [{"id_doc": id_doc} for _ in ids])
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_busqueda_devuelve_el_mas_parecido(tmp_path, dtype):
+    store = NpyVectorStore(str(tmp_path), dtype=dtype)
+    vectores = _vectores(50)
+    _upsert(store, [f"c{i}" for i in range(50)], vectores)
+    store.flush()
+
+    docs = store.similarity_search_by_vector(vectores[7], k=3)
+    assert docs[0].page_content == "texto c7"
+    assert len(docs) == 3
+
+
+def test_upsert_no_es_visible_hasta_flush(tmp_path):
+    store = NpyVectorStore(str(tmp_path))
+    _upsert(store, ["a"], _vectores(1))
+    assert len(store) == 0
+    store.flush()
+    assert len(store) == 1
+
+
+def test_delete_y_reemplazo(tmp_path):
+    store = NpyVectorStore(str(tmp_path))
+    vectores = _vectores(3)
+    _upsert(store, ["a", "b", "c"], vectores)
+    store.flush()
+
+    store.delete(["b"])
+    store.upsert(["a"], [vectores[2]], ["nuevo a"], [{"id_doc": 1}])
+    store.flush()
+
+    assert len(store) == 2
+    textos = [d.page_content for d in store.similarity_search_by_vector(vectores[2], k=2)]
+    assert sorted(textos) == ["nuevo a", "texto c"]
+
+
+def test_filtro_por_documento(tmp_path):
+    store = NpyVectorStore(str(tmp_path))
+    vectores = _vectores(4)
+    _upsert(store, ["a", "b"], vectores[:2], id_doc=1)
+    _upsert(store, ["c", "d"], vectores[2:], id_doc=2)
+    store.flush()
+
+    docs = store.similarity_search_by_vector(vectores[0], k=4, filter={"id_doc": 2})
+    assert {d.metadata["id_doc"] for d in docs} == {2}
+
+
+def test_flush_publica_una_version_y_otra_instancia_la_lee(tmp_path):
+    store = NpyVectorStore(str(tmp_path))
+    for n in range(3):
+        _upsert(store, [f"{n}-{i}" for i in range(5)], _vectores(5, semilla=n))
+        store.flush()
+
+    versiones = sorted(n for n in os.listdir(tmp_path) if n.startswith("v"))
+    # Se conservan la vigente y la anterior
+    assert len(versiones) == 2
+    assert (tmp_path / "actual").read_text() == versiones[-1]
+    assert len(NpyVectorStore(str(tmp_path))) == 15
+
+
+def test_busquedas_durante_flush_ven_una_version_coherente(tmp_path):
+    store = NpyVectorStore(str(tmp_path))
+    errores, fin = [], threading.Event()
+
+    def buscar():
+        consulta = _vectores(1)[0]
+        while not fin.is_set():
+            try:
+                store.similarity_search_by_vector(consulta, k=3)
+            except Exception as e:
+                errores.append(e)
+
+    hilos = [threading.Thread(target=buscar) for _ in range(4)]
+    for hilo in hilos:
+        hilo.start()
+    try:
+        for n in range(20):
+            ids = [f"{n}-{i}" for i in range(300)]
+            _upsert(store, ids, _vectores(300, semilla=n))
+            store.flush()
+            if n % 3 == 0:
+                store.delete(ids[:100])
+                store.flush()
+    finally:
+        fin.set()
+        for hilo in hilos:
+            hilo.join()
+
+    assert errores == []